@@ -0,0 +1,104 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+import torch
+
+from topaz.algorithms import non_maximum_suppression, match_coordinates
+from topaz.utils.data.loader import load_image
+from topaz.predict import score_coarse_to_fine
+import topaz.cuda
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser('Script for reporting the accuracy and run time of coarse to fine scoring against dense scoring on held-out micrographs')
+    parser.add_argument('paths', nargs='+', help='held-out micrographs to score')
+    parser.add_argument('-m', '--model', default='resnet16', help='path to trained classifier (default: resnet16)')
+    parser.add_argument('-r', '--radius', type=int, required=True, help='extraction radius, also used for matching coarse to fine picks to dense picks')
+    parser.add_argument('-t', '--threshold', type=float, default=-6, help='extraction threshold (default: -6)')
+    parser.add_argument('--coarse-thresholds', type=float, nargs='+', default=[-12, -10, -8, -6], help='coarse thresholds to benchmark (default: -12 -10 -8 -6)')
+    parser.add_argument('--refine-margin', type=int, help='pixels around each coarse candidate to score at full resolution (default: model stride)')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size for scoring refinement tiles (default: 1)')
+    parser.add_argument('-d', '--device', type=int, default=-1, help='which device to use, <0 corresponds to CPU (default: CPU)')
+    return parser.parse_args()
+
+
+def timeit(f, *args, **kwargs):
+    tic = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - tic, result
+
+
+def score_dense(model, image, use_cuda=False):
+    model.fill()
+    try:
+        with torch.no_grad():
+            x = torch.from_numpy(image).unsqueeze(0).unsqueeze(0)
+            if use_cuda:
+                x = x.cuda()
+            return model(x)[0,0].cpu().numpy()
+    finally:
+        model.unfill()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    use_cuda = topaz.cuda.set_device(args.device)
+    from topaz.model.factory import load_model
+    model = load_model(args.model)
+    model.eval()
+    if use_cuda:
+        model.cuda()
+
+    radius = args.radius
+    threshold = args.threshold
+
+    dense_time = 0
+    totals = {t: {'time': 0, 'refined': 0, 'matched': 0, 'picks': 0} for t in args.coarse_thresholds}
+    num_dense = 0
+    for path in args.paths:
+        image = load_image(path).astype(np.float32, copy=False)
+
+        t,score = timeit(score_dense, model, image, use_cuda=use_cuda)
+        dense_time += t
+        _,dense_coords = non_maximum_suppression(score, radius, threshold=threshold)
+        num_dense += len(dense_coords)
+
+        for coarse_threshold in args.coarse_thresholds:
+            t,(score,refined) = timeit(score_coarse_to_fine, model, image, coarse_threshold
+                                      , margin=args.refine_margin, use_cuda=use_cuda
+                                      , batch_size=args.batch_size)
+            _,coords = non_maximum_suppression(score, radius, threshold=threshold)
+            assignment,_ = match_coordinates(dense_coords, coords, radius)
+
+            total = totals[coarse_threshold]
+            total['time'] += t
+            total['refined'] += refined
+            total['matched'] += int(assignment.sum())
+            total['picks'] += len(coords)
+
+        print('# {}: dense picks={}'.format(path, len(dense_coords)), file=sys.stderr)
+
+    rows = []
+    for coarse_threshold in args.coarse_thresholds:
+        total = totals[coarse_threshold]
+        rows.append({'coarse_threshold': coarse_threshold
+                    , 'refined_fraction': total['refined']/len(args.paths)
+                    , 'picks': total['picks'], 'dense_picks': num_dense
+                    , 'recall': total['matched']/max(num_dense, 1)
+                    , 'precision': total['matched']/max(total['picks'], 1)
+                    , 'time': total['time'], 'dense_time': dense_time
+                    , 'speedup': dense_time/total['time']})
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sys.stdout, sep='\t', index=False, float_format='%.4f')
+
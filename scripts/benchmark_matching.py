@@ -0,0 +1,94 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from topaz.algorithms import match_coordinates
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser('Script for benchmarking coordinate matching against the number of predictions per micrograph')
+    parser.add_argument('--num-preds', type=int, nargs='+', default=[500, 1000, 2500, 5000, 10000], help='numbers of predicted particles to benchmark (default: 500 1000 2500 5000 10000)')
+    parser.add_argument('--num-targets', type=int, default=300, help='number of target particles per micrograph (default: 300)')
+    parser.add_argument('--size', type=int, default=1024, help='micrograph size in pixels (default: 1024)')
+    parser.add_argument('-r', '--radius', type=int, default=14, help='match radius (default: 14)')
+    parser.add_argument('--dense-max-preds', type=int, default=5000, help='largest number of predictions at which to also time the dense assignment (default: 5000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic coordinates')
+    return parser.parse_args()
+
+
+def dense_match_coordinates(targets, preds, radius):
+    """ the original dense cost matrix implementation, kept for comparison """
+    d2 = np.sum((preds[:,np.newaxis] - targets[np.newaxis])**2, 2)
+    cost = d2 - radius*radius
+    cost[cost > 0] = 0
+
+    pred_index,target_index = linear_sum_assignment(cost)
+
+    cost = cost[pred_index, target_index]
+    dist = np.zeros(len(preds))
+    dist[pred_index] = np.sqrt(d2[pred_index, target_index])
+
+    pred_index = pred_index[cost < 0]
+    assignment = np.zeros(len(preds), dtype=np.float32)
+    assignment[pred_index] = 1
+
+    return assignment, dist
+
+
+def synthetic_coordinates(num_preds, num_targets, size, radius, random=np.random):
+    """ targets spread over the micrograph, with a jittered prediction near most targets plus false positives """
+    targets = random.uniform(0, size, size=(num_targets, 2))
+    n = min(num_preds, num_targets)
+    near = targets[:n] + random.normal(scale=radius/3, size=(n, 2))
+    far = random.uniform(0, size, size=(num_preds - n, 2))
+    preds = np.round(np.concatenate([near, far], 0)).astype(int)
+    return np.round(targets).astype(int), preds
+
+
+def timeit(f, *args, **kwargs):
+    tic = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - tic, result
+
+
+def objective(assignment, dist, radius):
+    return np.sum(radius*radius - dist[assignment==1]**2)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random = np.random.RandomState(args.seed)
+    radius = args.radius
+
+    rows = []
+    for num_preds in args.num_preds:
+        targets,preds = synthetic_coordinates(num_preds, args.num_targets, args.size, radius, random=random)
+
+        t,(assignment,dist) = timeit(match_coordinates, targets, preds, radius)
+        t_greedy,(greedy_assignment,greedy_dist) = timeit(match_coordinates, targets, preds, radius, greedy=True)
+
+        t_dense = np.nan
+        match = '-'
+        if num_preds <= args.dense_max_preds:
+            t_dense,(dense_assignment,dense_dist) = timeit(dense_match_coordinates, targets, preds, radius)
+            match = np.isclose(objective(assignment, dist, radius), objective(dense_assignment, dense_dist, radius))
+
+        rows.append({'preds': num_preds, 'targets': len(targets), 'matched': int(assignment.sum())
+                    , 'greedy_matched': int(greedy_assignment.sum())
+                    , 'time': t, 'greedy_time': t_greedy, 'dense_time': t_dense
+                    , 'speedup': t_dense/t, 'match': match})
+        print('# preds={}, targets={}, time={:.4f}s'.format(num_preds, len(targets), t), file=sys.stderr)
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sys.stdout, sep='\t', index=False, float_format='%.4f')
+
@@ -0,0 +1,102 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter
+
+from topaz.algorithms import non_maximum_suppression
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser('Script for benchmarking non maximum suppression over micrograph size and extraction radius')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096], help='micrograph sizes to benchmark (default: 512 1024 2048 4096)')
+    parser.add_argument('--radii', type=int, nargs='+', default=[7, 14, 28], help='extraction radii to benchmark (default: 7 14 28)')
+    parser.add_argument('-t', '--threshold', type=float, default=-6, help='extraction threshold (default: -6)')
+    parser.add_argument('--legacy-max-size', type=int, default=1024, help='largest size at which to also time the set based implementation (default: 1024)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic score maps')
+    return parser.parse_args()
+
+
+def legacy_non_maximum_suppression(x, r, threshold=-np.inf):
+    """ the original set based implementation, kept for comparison """
+    width = r
+    ii,jj = np.meshgrid(np.arange(-width,width+1), np.arange(-width,width+1))
+    mask = (ii**2 + jj**2) <= r*r
+    ii = ii[mask]
+    jj = jj[mask]
+    major_axis = x.shape[1]
+
+    A = x.ravel()
+    I = np.argsort(A, axis=None)[::-1]
+    S = set()
+
+    scores = np.zeros(len(A), dtype=np.float32)
+    coords = np.zeros((len(A),2), dtype=np.int32)
+
+    j = 0
+    for i in I:
+        if A[i] <= threshold:
+            break
+        if i not in S:
+            xx = i % major_axis
+            yy = i // major_axis
+            scores[j] = A[i]
+            coords[j,0] = xx
+            coords[j,1] = yy
+            j += 1
+            y_coords = np.clip(yy + ii, 0, x.shape[0]-1)
+            x_coords = np.clip(xx + jj, 0, x.shape[1]-1)
+            for y_coord,x_coord in zip(y_coords, x_coords):
+                S.add(y_coord*major_axis + x_coord)
+
+    return scores[:j], coords[:j]
+
+
+def synthetic_scores(size, radius, random=np.random):
+    """ smooth log-likelihood-like score map with blobs roughly radius apart """
+    x = random.randn(size, size)
+    x = gaussian_filter(x, max(radius/4, 1))
+    x = 6*x/x.std() - 4
+    return x.astype(np.float32)
+
+
+def timeit(f, *args, **kwargs):
+    tic = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - tic, result
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random = np.random.RandomState(args.seed)
+
+    rows = []
+    for size in args.sizes:
+        for radius in args.radii:
+            x = synthetic_scores(size, radius, random=random)
+            t,(scores,coords) = timeit(non_maximum_suppression, x, radius, threshold=args.threshold)
+
+            t_legacy = np.nan
+            match = '-'
+            if size <= args.legacy_max_size:
+                t_legacy,(legacy_scores,legacy_coords) = timeit(legacy_non_maximum_suppression, x, radius
+                                                              , threshold=args.threshold)
+                match = np.array_equal(np.sort(scores), np.sort(legacy_scores)) \
+                        and len(coords) == len(legacy_coords)
+
+            rows.append({'size': size, 'radius': radius, 'peaks': len(scores)
+                        , 'time': t, 'legacy_time': t_legacy, 'speedup': t_legacy/t
+                        , 'match': match})
+            print('# size={}, radius={}, peaks={}, time={:.3f}s'.format(size, radius, len(scores), t), file=sys.stderr)
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sys.stdout, sep='\t', index=False, float_format='%.4f')
+
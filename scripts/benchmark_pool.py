@@ -0,0 +1,75 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+
+from topaz.commands.extract import nms_iterator
+from topaz.utils.pipeline import process_pool
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser('Script for benchmarking particle extraction with a multiprocessing pool, sending score maps to the workers pickled or through shared memory')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of pool workers to benchmark (default: 1 2 4 8)')
+    parser.add_argument('-n', '--num-maps', type=int, default=16, help='number of score maps to extract from (default: 16)')
+    parser.add_argument('--size', type=int, default=4096, help='size of the random score maps (default: 4096)')
+    parser.add_argument('-r', '--radius', type=int, default=20, help='extraction radius (default: 20)')
+    parser.add_argument('-t', '--threshold', type=float, default=2, help='extraction threshold on the unit variance score maps (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the score maps')
+    return parser.parse_args()
+
+
+def extract(scores, radius, threshold, pool=None, shared=True, depth=2):
+    tic = time.time()
+    count = 0
+    if pool is not None and not shared:
+        from topaz.commands.extract import NonMaximumSuppression
+        from topaz.utils.pipeline import pool_map
+        process = NonMaximumSuppression(radius, threshold)
+        particles = pool_map(process, scores, pool, depth=depth)
+    else:
+        particles = nms_iterator(scores, radius, threshold, pool=pool, depth=depth)
+    for _,score,_ in particles:
+        count += len(score)
+    return time.time() - tic, count
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random = np.random.RandomState(args.seed)
+
+    ## smooth noise gives score maps with realistic numbers of peaks
+    x = random.randn(args.size, args.size).astype(np.float32)
+    x = scipy.ndimage.gaussian_filter(x, 4)
+    x = x/x.std()
+    scores = [(str(i), np.roll(x, 17*i, axis=1)) for i in range(args.num_maps)]
+
+    t_serial,expected = extract(scores, args.radius, args.threshold)
+    print('# serial: {:.3f}s, particles={}'.format(t_serial, expected), file=sys.stderr)
+
+    rows = []
+    for num_workers in args.workers:
+        pool = process_pool(num_workers)
+        try:
+            for shared in [False, True]:
+                t,count = extract(scores, args.radius, args.threshold, pool=pool, shared=shared
+                                 , depth=2*num_workers)
+                assert count == expected
+                rows.append({'workers': num_workers, 'transport': 'shared' if shared else 'pickle'
+                            , 'time': t, 'speedup': t_serial/t})
+                print('# workers={}, shared={}, {:.3f}s'.format(num_workers, shared, t), file=sys.stderr)
+        finally:
+            pool.close()
+            pool.join()
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sys.stdout, sep='\t', index=False, float_format='%.4f')
+
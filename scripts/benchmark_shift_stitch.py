@@ -0,0 +1,73 @@
+from __future__ import print_function,division
+
+import os
+import sys
+import time
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+import torch
+
+from topaz.model.classifier import LinearClassifier
+from topaz.model.factory import get_feature_extractor
+from topaz.predict import score_shift_stitch
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser('Script for benchmarking shift and stitch against filled (dilated) dense scoring')
+    parser.add_argument('-m', '--model', help='path to trained classifier. if not given, randomly initialized models of each --arch are used')
+    parser.add_argument('--arch', nargs='+', default=['resnet8', 'resnet16'], help='feature extractors to benchmark with random weights (default: resnet8 resnet16)')
+    parser.add_argument('--units', type=int, default=32, help='units of the random models (default: 32)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048], help='micrograph sizes to benchmark (default: 512 1024 2048)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the models and micrographs')
+    return parser.parse_args()
+
+
+def timeit(f, *args, **kwargs):
+    tic = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - tic, result
+
+
+def score_fill(model, image):
+    model.fill()
+    try:
+        with torch.no_grad():
+            return model(torch.from_numpy(image).unsqueeze(0).unsqueeze(0))[0,0].numpy()
+    finally:
+        model.unfill()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    random = np.random.RandomState(args.seed)
+
+    if args.model is not None:
+        from topaz.model.factory import load_model
+        models = [(args.model, load_model(args.model))]
+    else:
+        models = [(arch, LinearClassifier(get_feature_extractor(arch, units=args.units, bn=False)))
+                  for arch in args.arch]
+
+    rows = []
+    for name,model in models:
+        model.eval()
+        for size in args.sizes:
+            image = random.randn(size, size).astype(np.float32)
+            t_fill,expected = timeit(score_fill, model, image)
+            t,score = timeit(score_shift_stitch, model, image)
+            rows.append({'model': name, 'size': size, 'fill_time': t_fill, 'stitch_time': t
+                        , 'speedup': t_fill/t, 'max_abs_diff': np.abs(expected - score).max()})
+            print('# model={}, size={}, fill={:.3f}s, stitch={:.3f}s'.format(name, size, t_fill, t), file=sys.stderr)
+
+    table = pd.DataFrame(rows)
+    table.to_csv(sys.stdout, sep='\t', index=False, float_format='%.4g')
+
@@ -4,6 +4,11 @@ import numpy as np
 import pandas as pd
 import sys
 import os
+here = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+
+from topaz.algorithms import match_coordinates
 
 def parse_args():
     import argparse
@@ -11,29 +16,10 @@ def parse_args():
     parser.add_argument('path', help='path to predictions')
     parser.add_argument('-r', '--radius', type=int, help='maximum match radius')
     parser.add_argument('--targets', help='path to test particles')
+    parser.add_argument('--greedy', action='store_true', help='match particles greedily in order of increasing distance instead of solving the optimal assignment')
     parser.add_argument('-o', '--output', help='output path')
     return parser.parse_args()
 
-def match_regions(targets, preds, radius):                                                          
-    from scipy.optimize import linear_sum_assignment
-
-    d2 = np.sum((preds[:,np.newaxis] - targets[np.newaxis])**2, 2)
-    cost = d2 - radius*radius
-    cost[cost > 0] = 0
-
-    pred_index,target_index = linear_sum_assignment(cost)
-
-    cost = cost[pred_index, target_index]
-    dist = np.zeros(len(preds))
-    dist[pred_index] = np.sqrt(d2[pred_index, target_index])
-
-    pred_index = pred_index[cost < 0]
-    assignment = np.zeros(len(preds), dtype=np.float32)
-    assignment[pred_index] = 1
-
-
-    return assignment, dist
-
 if __name__ == '__main__':
     args = parse_args()
 
@@ -43,16 +29,19 @@ if __name__ == '__main__':
         sys.exit(0)
     targets = pd.read_csv(args.targets, sep='\t')
     names = targets.image_name.unique()
+    target_groups = dict(list(targets.groupby('image_name')))
+    predict_groups = dict(list(predicts.groupby('image_name')))
 
     matches = []
     scores = []
     dists = []
 
     for name in names:
-        target_coords = targets.loc[targets.image_name==name][['x_coord','y_coord']].values
-        predict_coords = predicts.loc[predicts.image_name==name][['x_coord','y_coord']].values
-        score = predicts.loc[predicts.image_name==name].score.values.astype(np.float32)
-        match,dist = match_regions(target_coords, predict_coords, args.radius)
+        target_coords = target_groups[name][['x_coord','y_coord']].values
+        predict = predict_groups.get(name, predicts.iloc[:0])
+        predict_coords = predict[['x_coord','y_coord']].values
+        score = predict.score.values.astype(np.float32)
+        match,dist = match_coordinates(target_coords, predict_coords, args.radius, greedy=args.greedy)
         
         matches.append(match)
         scores.append(score)
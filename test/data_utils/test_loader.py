@@ -2,10 +2,15 @@ import os
 from logging import root
 
 import numpy as np
-from topaz.utils.data.loader import (ImageDirectoryLoader, ImageTree,
+import pytest
+from PIL import Image
+from topaz.utils.data.loader import (CachedImage, ImageCache,
+                                     ImageDirectoryLoader, ImageTree,
                                      LabeledImageCropDataset,
                                      LabeledRegionsDataset,
-                                     SegmentedImageDataset, load_image,
+                                     SegmentedImageDataset, cache_images_from_list,
+                                     crop, decoded_dtype, index_directory,
+                                     load_image,
                                      load_images_from_directory,
                                      load_images_from_list, load_jpeg,
                                      load_mrc, load_pil, load_png, load_tiff)
@@ -27,6 +32,43 @@ class TestImageTree():
         pass
 
 
+class TestImageCache():
+    def test_get(self, tmp_path):
+        paths = []
+        for i in range(3):
+            path = str(tmp_path / '{}.tiff'.format(i))
+            Image.fromarray(np.full((8, 16), i, dtype=np.float32)).save(path)
+            paths.append(path)
+
+        ## room for two 16x8 float32 images
+        cache = ImageCache(2*16*8*4)
+        images = [CachedImage(path, 16, 8, cache) for path in paths]
+        assert images[0].shape == (8, 16)
+        assert len(cache.images) == 0
+
+        assert np.asarray(images[0]).mean() == 0
+        assert np.asarray(images[1]).mean() == 1
+        assert np.asarray(images[0]).dtype == np.float32
+        assert cache.hits == 1 and cache.misses == 2
+
+        ## the least recently used image is evicted
+        assert np.asarray(images[2]).mean() == 2
+        assert paths[0] in cache and paths[1] not in cache
+        assert cache.nbytes == 2*16*8*4
+
+    def test_nbytes(self):
+        cache = ImageCache(2**20)
+        ## integer mrc and tiff images are cached in their own dtype, the others as float32
+        images = cache_images_from_list(['a', 'b', 'c', 'd'], ['a.mrc', 'b.tiff', 'c.mrc', 'd.png']
+                                       , [16]*4, [8]*4, cache
+                                       , dtypes=['uint16', 'uint8', 'float16', 'uint8'])
+        assert [images[name].nbytes for name in 'abcd'] == [16*8*2, 16*8, 16*8*4, 16*8*4]
+
+        ## missing catalog dtypes and standardized images are float32
+        assert decoded_dtype('a.mrc', float('nan')) == np.float32
+        assert decoded_dtype('a.mrc', 'uint16', standardize=True) == np.float32
+
+
 class TestLabeledImageCropDataset():
     def test_init(self):
         pass
@@ -35,7 +77,45 @@ class TestLabeledImageCropDataset():
         pass
 
     def test_get_item(self):
-        pass
+        x = np.arange(1, 7*9 + 1, dtype=np.float32).reshape(7, 9)
+        y = np.zeros((7, 9), dtype=np.uint8)
+        y[0,8] = 1
+        dataset = LabeledImageCropDataset([[x]], [[y]], 5)
+
+        ## crops are centered on the coordinate, zero padded past the corner
+        im,label = dataset[0*2**56 + 0*2**32 + 8]
+        assert label.item() == 1
+        assert im.shape == (5, 5)
+        assert np.array_equal(im[2:, :3], x[:3, 6:])
+        assert (im[:2] == 0).all() and (im[:, 3:] == 0).all()
+
+        im,label = dataset[4*9 + 4]
+        assert label.item() == 0 and np.array_equal(im, x[2:7, 2:7])
+
+
+def test_crop():
+    x = np.arange(1, 5*6 + 1, dtype=np.float32).reshape(5, 6)
+    ## inside the image the region is a view
+    region = crop(x, 1, 2, 4, 5)
+    assert np.shares_memory(region, x) and np.array_equal(region, x[2:5, 1:4])
+
+    ## past each edge the region is padded with zeros
+    region = crop(x, -2, -1, 3, 2)
+    assert region.shape == (3, 5) and region.dtype == x.dtype
+    assert np.array_equal(region[1:, 2:], x[:2, :3])
+    assert (region[0] == 0).all() and (region[:, :2] == 0).all()
+
+    region = crop(x, 4, 3, 8, 7)
+    assert np.array_equal(region[:2, :2], x[3:, 4:])
+    assert region[2:].sum() == 0 and region[:, 2:].sum() == 0
+
+    ## regions entirely outside the image are all zeros
+    assert not crop(x, 10, 10, 13, 12).any()
+
+    ## trailing channel dimensions are kept
+    x = np.ones((4, 4, 3))
+    region = crop(x, -1, -1, 2, 2)
+    assert region.shape == (3, 3, 3) and region[0].sum() == 0 and region[1:, 1:].all()
 
 
 class TestLabeledRegionsDataset():
@@ -105,30 +185,58 @@ def test_load_image():
     pass
 
 
-def test_load_images_from_directory():
-    # names = os.listdir('test/test_data/EMPIAR-10025/rawdata/micrographs/')
-    # #remove extensions
-    # names = [name.split('.')[0] for name in names]
-    # rootdir = 'test/test_data/EMPIAR-10025/rawdata/micrographs/'
-    # images = load_images_from_directory(names, rootdir)
-    
-    # for im in images.values():
-    #     assert im is not None
-    #     array = np.asarray(im)
-    #     assert len(array.shape) == 2
-    pass
-
-
-def test_load_images_from_list():
-    # rootdir = 'test/test_data/EMPIAR-10025/rawdata/micrographs/'
-    # names = os.listdir(rootdir)
-    # #remove extensions
-    # names = [name.split('.')[0] for name in names]
-    # paths = [os.path.join(rootdir, file) for file in os.listdir(rootdir)]    
-    # images = load_images_from_list(names, paths)
-    
-    # for im in images.values():
-    #     assert im is not None
-    #     array = np.asarray(im)
-    #     assert len(array.shape) == 2
-    pass
\ No newline at end of file
+def write_images(rootdir, names, ext='.tiff'):
+    paths = []
+    for i,name in enumerate(names):
+        path = os.path.join(str(rootdir), name + ext)
+        Image.fromarray(np.full((4, 6), i, dtype=np.float32)).save(path, format='tiff')
+        paths.append(path)
+    return paths
+
+
+def test_index_directory(tmp_path):
+    write_images(tmp_path, ['a', 'b.1', 'c.d.e'])
+    write_images(tmp_path, ['a'], ext='.tif')
+    (tmp_path / 'notes').write_text('no extension')
+
+    index = index_directory(str(tmp_path))
+    ## names keep their dots up to the extension
+    assert sorted(index) == ['a', 'b.1', 'c.d.e']
+    assert index['a'] == [str(tmp_path / 'a.tif'), str(tmp_path / 'a.tiff')]
+    assert index['c.d.e'] == [str(tmp_path / 'c.d.e.tiff')]
+
+    ## ext is a pattern for the extension
+    assert index_directory(str(tmp_path), ext='tif') == {'a': [str(tmp_path / 'a.tif')]}
+    assert sorted(index_directory(str(tmp_path), ext='tif*')['a']) == index['a']
+    assert index_directory(str(tmp_path), ext='mrc') == {}
+
+
+def test_load_images_from_directory(tmp_path):
+    names = ['x.1', 'y', 'z']
+    write_images(tmp_path, names)
+    images = load_images_from_directory(['z', 'x.1'], str(tmp_path), num_workers=2)
+    assert list(images) == ['z', 'x.1']
+    assert images['z'].mean() == 2 and images['x.1'].mean() == 0
+
+    (tmp_path / 's').mkdir()
+    write_images(tmp_path / 's', ['w'])
+    images = load_images_from_directory(['w', 'y'], str(tmp_path), sources=['s', ''])
+    assert images['s']['w'].shape == (4, 6) and images['']['y'].mean() == 1
+
+    ## a missing image is named in the error
+    with pytest.raises(Exception, match='Image not found: no file named missing'):
+        load_images_from_directory(['y', 'missing'], str(tmp_path))
+
+
+def test_load_images_from_list(tmp_path):
+    names = ['m{}'.format(i) for i in range(12)][::-1]
+    paths = write_images(tmp_path, names)
+    ## images are returned in input order, whichever worker finishes first
+    for num_workers in [0, 4]:
+        images = load_images_from_list(names, paths, num_workers=num_workers)
+        assert list(images) == names
+        assert [im.mean() for im in images.values()] == list(range(12))
+
+    images = load_images_from_list(names, paths, sources=[i % 2 for i in range(12)], num_workers=4)
+    assert list(images[1]) == names[1::2]
+    assert [im.mean() for im in images[1].values()] == list(range(1, 12, 2))
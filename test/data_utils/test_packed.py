@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from topaz.commands import pack
+from topaz.commands.train import load_data, load_packed
+from topaz.utils.data.packed import PackedFile, PackWriter
+
+
+def test_pack_roundtrip(tmp_path):
+    path = str(tmp_path / 'data.pack')
+    x = np.random.randn(5, 7).astype(np.float32)
+    y = (x > 0).astype(np.uint8)
+    xy = np.zeros((0, 2), dtype=np.int32)
+
+    with PackWriter(path) as writer:
+        entries = [writer.add(a) for a in [x, y, xy]]
+        writer.close({'arrays': entries})
+
+    packed = PackedFile(path)
+    entries = packed.index['arrays']
+    assert all(entry['offset'] % 64 == 0 for entry in entries)
+    for entry,a in zip(entries, [x, y, xy]):
+        b = packed.array(entry)
+        assert b.dtype == a.dtype
+        assert np.array_equal(a, b)
+
+    ## arrays are copy on write views of the file
+    packed.array(entries[0])[:] = 0
+    assert np.array_equal(PackedFile(path).array(entries[0]), x)
+
+
+def write_dataset(root, sources=('s0', 's1'), n=9):
+    random = np.random.RandomState(0)
+    images = []
+    coords = []
+    for source in sources:
+        for j in range(n):
+            name = 'm{}'.format(j)
+            path = str(root / (source + '_' + name + '.tiff'))
+            ## the fill value identifies the micrograph
+            Image.fromarray(np.full((40, 40), len(images), dtype=np.float32)).save(path)
+            images.append((source, name, path))
+            for _ in range(random.randint(1, 8)):
+                coords.append((source, name, random.randint(40), random.randint(40)))
+    image_list = str(root / 'images.txt')
+    pd.DataFrame(images, columns=['source', 'image_name', 'path']).to_csv(image_list, sep='\t', index=False)
+    targets = str(root / 'coords.txt')
+    pd.DataFrame(coords, columns=['source', 'image_name', 'x_coord', 'y_coord']).to_csv(targets, sep='\t', index=False)
+    return image_list, targets
+
+
+def split_ids(images):
+    return [sorted(int(np.asarray(im).flat[0]) for im in source) for source in images]
+
+
+def label_counts(images, labels):
+    return {int(np.asarray(im).flat[0]): int(y.sum()) for source,source_labels in zip(images, labels)
+            for im,y in zip(source, source_labels)}
+
+
+def test_packed_folds_match_load_data(tmp_path):
+    image_list, targets = write_dataset(tmp_path)
+    path = str(tmp_path / 'data.pack')
+    args = pack.add_arguments().parse_args(['-o', path, '--train-images', image_list
+                                           , '--train-targets', targets, '-r', '2', '-k', '3'
+                                           , '--num-readers', '2'])
+    pack.main(args)
+
+    for fold in range(3):
+        packed = load_packed(path, 2, fold=fold)
+        loaded = load_data(image_list, targets, None, None, 2, k_fold=3, fold=fold
+                          , cross_validation_seed=42, num_readers=2)
+        ## the same micrographs are held out, with the same labels
+        assert split_ids(packed[2]) == split_ids(loaded[2])
+        assert split_ids(packed[0]) == split_ids(loaded[0])
+        assert all(len(source) == 3 for source in packed[2])
+        assert label_counts(*packed[:2]) == label_counts(*loaded[:2])
+        assert label_counts(*packed[2:]) == label_counts(*loaded[2:])
+
+    with pytest.raises(Exception, match='Fold must be between 0 and 2'):
+        load_packed(path, 2, fold=3)
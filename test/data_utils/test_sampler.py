@@ -1,22 +1,93 @@
 import os
 
 import numpy as np
+import torch
 from PIL import Image
-from topaz.utils.data.sampler import (RandomImageTransforms, ShuffledSampler,
+from topaz.utils.data.loader import CachedImage, ImageCache
+from topaz.utils.data.sampler import (CachedCoordinateSampler,
+                                      CoordinateSampler, RandomImageTransforms,
+                                      ShuffledSampler,
                                       StratifiedCoordinateSampler,
                                       enumerate_pn_coordinates,
-                                      enumerate_pu_coordinates)
+                                      enumerate_pu_coordinates,
+                                      positive_coordinates, rotate_crop)
+
+
+def test_rotate_crop():
+    random = np.random.RandomState(0)
+    for shape in [(40, 40), (33, 48), (48, 33)]:
+        x = random.randn(*shape).astype(np.float32)
+        n,m = shape
+        i,j = np.mgrid[:n, :m]
+        ## PIL treats pixels next to the border differently, compare the inscribed disk
+        disk = (i - (n-1)/2)**2 + (j - (m-1)/2)**2 < (min(n, m)/2 - 1)**2
+        for angle in [0, 17.5, 90, 123.4, 270, 359]:
+            expected = np.array(Image.fromarray(x).rotate(angle, resample=Image.BILINEAR))
+            y = rotate_crop(x, angle)
+            assert y.shape == x.shape
+            assert np.abs(y - expected)[disk].max() < 1.5e-5
+
+            ## a box is the same region of the full rotation
+            assert np.array_equal(rotate_crop(x, angle, box=(5, 3, 20, 17)), y[3:17, 5:20])
+
+    ## nearest keeps label values
+    y = rotate_crop((random.rand(20, 20) > 0.5).astype(np.float32), 33, mode='nearest')
+    assert set(np.unique(y)) <= {0, 1}
 
 
 class TestRandomImageTransforms():
-    def test_init(self):
-        pass
+    def make_data(self, n=3):
+        random = np.random.RandomState(0)
+        data = []
+        for _ in range(n):
+            x = random.randn(24, 30).astype(np.float32)
+            data.append((x, (x > 0).astype(np.uint8)))
+        return data
+
+    def expected(self, random, x, box, rotate=True, flip=True, mode='bilinear'):
+        if rotate:
+            x = rotate_crop(x, random.uniform(0, 360), box=box, mode=mode)
+        else:
+            xmi,ymi,xma,yma = box
+            x = x[ymi:yma, xmi:xma]
+        if flip:
+            if random.uniform() > 0.5:
+                x = x[:, ::-1]
+            if random.uniform() > 0.5:
+                x = x[::-1]
+        return x
 
     def test_len(self):
-        pass
+        assert len(RandomImageTransforms(self.make_data(5))) == 5
 
     def test_get_item(self):
-        pass
+        data = self.make_data()
+        box = ((30-16)//2, (24-16)//2, (30-16)//2 + 16, (24-16)//2 + 16)
+        for rotate in [False, True]:
+            for flip in [False, True]:
+                transforms = RandomImageTransforms(data, rotate=rotate, flip=flip, crop=16)
+                transforms.random = np.random.RandomState(1)
+                transforms.seeded = True
+                ## the same random draws give the expected transforms of image and label
+                random = np.random.RandomState(1)
+                for i,(x,y) in enumerate(data):
+                    X,Y = transforms[i]
+                    state = random.get_state()
+                    assert np.array_equal(X, self.expected(random, x, box, rotate=rotate, flip=flip))
+                    random.set_state(state)
+                    assert np.array_equal(Y, self.expected(random, y, box, rotate=rotate, flip=flip
+                                                         , mode='nearest'))
+                    assert X.shape == Y.shape == (16, 16)
+                    assert X.flags.c_contiguous and Y.flags.c_contiguous
+
+    def test_to_tensor(self):
+        ## labels that are not images pass through untransformed
+        data = [(np.ones((8, 8), dtype=np.float32), 1), (np.ones((8, 8), dtype=np.float32), np.ones((8, 8)))]
+        transforms = RandomImageTransforms(data, crop=4, to_tensor=True)
+        X,Y = transforms[0]
+        assert isinstance(X, torch.Tensor) and X.shape == (4, 4) and Y == 1
+        X,Y = transforms[1]
+        assert isinstance(Y, torch.Tensor) and Y.dtype == torch.float32
 
 
 
@@ -35,6 +106,24 @@ class TestShuffledSampler():
 
 
 
+class TestCoordinateSampler():
+    def test_next(self):
+        random = np.random.RandomState(0)
+        Y = [(random.rand(6, 5) < 0.3).astype(np.uint8) for _ in range(3)]
+        _,N = enumerate_pn_coordinates(Y)
+
+        sampler = CoordinateSampler([y.size for y in Y], exclude=positive_coordinates(Y)
+                                   , random=random)
+        assert len(sampler) == len(N)
+
+        ## draws cover exactly the negative coordinates
+        draws = set((int(i), int(c)) for i,c in (next(sampler) for _ in range(5000)))
+        assert draws == set((int(i), int(c)) for i,c in N)
+
+        i,c = sampler.sample(1)
+        assert i == 1 and Y[1].ravel()[c] == 0
+
+
 class TestStratifiedCoordinateSampler():
     def test_init(self):
         pass
@@ -50,6 +139,68 @@ class TestStratifiedCoordinateSampler():
 
 
 
+def make_labels(random, n=(7, 5), shape=(6, 5), p=0.2):
+    labels = []
+    for m in n:
+        Y = [(random.rand(*shape) < p).astype(np.uint8) for _ in range(m)]
+        ## micrographs without particles only have coordinates in the negative groups
+        Y[0][:] = 0
+        Y[1][:] = 0
+        labels.append(Y)
+    return labels
+
+
+def decode(h):
+    return h//2**56, (h//2**32) % 2**24, h % 2**32
+
+
+class TestCachedCoordinateSampler():
+    def test_windows(self):
+        random = np.random.RandomState(0)
+        labels = make_labels(random)
+        sampler = CachedCoordinateSampler(labels, 3, size=100, random=random)
+
+        for _ in range(3):
+            sampler.make_windows()
+            ## the draws of a pass add up to size and each micrograph is in one window
+            assert sum(count for count,_ in sampler.windows) == sampler.size
+            seen = [(source, j) for _,w in sampler.windows for source in w for j in w[source]]
+            assert sorted(seen) == [(source, j) for source in range(2) for j in range(len(labels[source]))]
+            assert all(sum(map(len, w.values())) <= 3 for _,w in sampler.windows)
+
+    def test_next(self):
+        random = np.random.RandomState(0)
+        labels = make_labels(random)
+        sampler = CachedCoordinateSampler(labels, 3, size=100, random=random)
+
+        positive = 0
+        for _ in range(1000):
+            h = next(sampler)
+            source,j,c = decode(h)
+            ## draws never leave the current window
+            assert j in sampler.window[source]
+            positive += int(labels[source][j].ravel()[c])
+        ## windows without particles are balanced out by the others
+        assert abs(positive/1000 - 0.5) < 0.05
+
+    def test_cache_hits(self, tmp_path):
+        random = np.random.RandomState(0)
+        labels = make_labels(random, n=(12,))
+        cache = ImageCache(3*6*5*4)
+        images = []
+        for j,y in enumerate(labels[0]):
+            path = str(tmp_path / '{}.tiff'.format(j))
+            Image.fromarray(y.astype(np.float32)).save(path)
+            images.append(CachedImage(path, 5, 6, cache))
+
+        sampler = CachedCoordinateSampler(labels, 3, size=200, random=random)
+        for _ in range(200):
+            _,j,_ = decode(next(sampler))
+            images[j].load()
+        ## each micrograph is read once per pass
+        assert cache.misses == 12 and cache.hits == 188
+
+
 def test_enum_pn_coordinates():
     pass
 
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from topaz.model.classifier import LinearClassifier
+from topaz.model.compiled import (CompiledClassifier, artifact_key, artifact_path,
+                                  load_filled_model, save_compiled)
+from topaz.model.factory import load_model
+from topaz.model.features.resnet import ResNet8
+from topaz.utils.scores import hash_model
+
+
+def make_model(path, seed=0):
+    torch.manual_seed(seed)
+    model = LinearClassifier(ResNet8(units=8, bn=False))
+    torch.save(model, path)
+    return str(path)
+
+
+def test_compiled_scores(tmp_path):
+    path = make_model(tmp_path / 'model.sav')
+    cache_dir = str(tmp_path / 'compiled')
+    eager = load_filled_model(path, cache_dir=cache_dir)
+    assert not isinstance(eager, CompiledClassifier)
+
+    save_compiled(load_model(path), artifact_path(path, cache_dir=cache_dir))
+    compiled = load_filled_model(path, cache_dir=cache_dir)
+    assert isinstance(compiled, CompiledClassifier)
+    assert compiled.width == eager.width
+    assert hash_model(compiled) == hash_model(load_model(path))
+
+    ## the reloaded artifact scores micrographs of any size like the eager model
+    x = torch.from_numpy(np.random.RandomState(0).randn(1, 1, 70, 93).astype(np.float32))
+    with torch.no_grad():
+        expected = eager(x)
+        y = compiled(x)
+    assert y.shape == expected.shape and y.dtype == torch.float32
+    assert torch.allclose(y, expected, atol=1e-4)
+
+    ## the compiled artifact is skipped when not wanted
+    assert not isinstance(load_filled_model(path, cache_dir=cache_dir, compiled=False), CompiledClassifier)
+
+
+def test_artifact_key(tmp_path):
+    path = make_model(tmp_path / 'model.sav')
+    key = artifact_key(path, num_threads=1)
+    assert artifact_key(path, num_threads=1) == key
+    assert artifact_key(path, dtype='bfloat16', num_threads=1) != key
+    assert artifact_key(path, num_threads=2) != key
+    assert artifact_key('resnet8', num_threads=1) != key
+
+    ## retraining the model in place changes the key
+    make_model(tmp_path / 'model.sav', seed=1)
+    assert artifact_key(path, num_threads=1) != key
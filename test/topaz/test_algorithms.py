@@ -2,15 +2,92 @@ import numpy as np
 from scipy.optimize import linear_sum_assignment
 
 from topaz.algorithms import (match_coordinates, non_maximum_suppression,
-                              non_maximum_suppression_3d)
+                              non_maximum_suppression_3d,
+                              non_maximum_suppression_sweep)
 
 def test_match_coordinates():
-    pass
+    random = np.random.RandomState(0)
+    radius = 14
+    preds = random.randint(0, 400, size=(600, 2))
+    targets = random.randint(0, 400, size=(150, 2))
+
+    ## dense assignment over the full cost matrix
+    d2 = np.sum((preds[:,np.newaxis] - targets[np.newaxis])**2, 2)
+    cost = np.minimum(d2 - radius*radius, 0)
+    pred_index,target_index = linear_sum_assignment(cost)
+    expected = -cost[pred_index, target_index].sum()
+
+    assignment,dist = match_coordinates(targets, preds, radius)
+    assert np.all(dist[assignment==1] < radius)
+    assert np.all(dist[assignment==0] == 0)
+    assert np.isclose(np.sum(radius*radius - dist[assignment==1]**2), expected)
+
+    greedy_assignment,greedy_dist = match_coordinates(targets, preds, radius, greedy=True)
+    assert np.all(greedy_dist[greedy_assignment==1] < radius)
+    assert np.sum(radius*radius - greedy_dist[greedy_assignment==1]**2) <= expected + 1e-6
+
+
+def greedy_nms(x, r, threshold=-np.inf):
+    """ reference greedy NMS, visiting pixels in order of decreasing score """
+    I = np.argsort(x, axis=None, kind='stable')[::-1]
+    scores = []
+    coords = []
+    for i in I:
+        yy,xx = np.unravel_index(i, x.shape)
+        if x[yy,xx] <= threshold:
+            break
+        if all((xx-c[0])**2 + (yy-c[1])**2 > r*r for c in coords):
+            scores.append(x[yy,xx])
+            coords.append((xx,yy))
+    return np.array(scores, dtype=np.float32), np.array(coords, dtype=np.int32).reshape(-1, 2)
 
 
 def test_nms():
-    pass
+    random = np.random.RandomState(0)
+    for shape,r,threshold in [((40,53), 3, -np.inf), ((64,64), 7, 0.5), ((31,20), 0, 0.0)]:
+        x = random.randn(*shape).astype(np.float32)
+        scores,coords = non_maximum_suppression(x, r, threshold=threshold)
+        expected_scores,expected_coords = greedy_nms(x, r, threshold=threshold)
+        assert np.array_equal(scores, expected_scores)
+        assert np.array_equal(coords, expected_coords)
+
+        ## stopping after max_peaks gives the highest scoring peaks
+        top_scores,top_coords = non_maximum_suppression(x, r, threshold=threshold, max_peaks=5)
+        assert np.array_equal(top_scores, expected_scores[:5])
+        assert np.array_equal(top_coords, expected_coords[:5])
+
+
+def test_nms_sweep():
+    random = np.random.RandomState(1)
+    x = random.randn(50, 61).astype(np.float32)
+    radii = [0, 2, 3, 5, 8]
+    for r,(scores,coords) in zip(radii, non_maximum_suppression_sweep(x, radii, threshold=0.2)):
+        expected_scores,expected_coords = non_maximum_suppression(x, r, threshold=0.2)
+        assert np.array_equal(scores, expected_scores)
+        assert np.array_equal(coords, expected_coords)
+
+
+def test_nms_3d(tmpdir):
+    random = np.random.RandomState(0)
+    x = random.randn(12, 17, 15).astype(np.float32)
+    r = 2.5
+    scores,coords = non_maximum_suppression_3d(x, 2*r, threshold=0.5)
 
+    ## reference greedy NMS
+    expected = []
+    for i in np.argsort(x, axis=None, kind='stable')[::-1]:
+        zz,yy,xx = np.unravel_index(i, x.shape)
+        if x[zz,yy,xx] <= 0.5:
+            break
+        if all((xx-c[0])**2 + (yy-c[1])**2 + (zz-c[2])**2 > r*r for c in expected):
+            expected.append((xx,yy,zz))
+    assert np.array_equal(coords, np.array(expected))
+    assert np.array_equal(scores, x[coords[:,2], coords[:,1], coords[:,0]])
 
-def test_nms_3d():
-    pass
\ No newline at end of file
+    ## slab by slab over a memory-mapped volume gives the same peaks
+    path = str(tmpdir.join('scores.npy'))
+    np.save(path, x)
+    x = np.load(path, mmap_mode='r')
+    slab_scores,slab_coords = non_maximum_suppression_3d(x, 2*r, threshold=0.5, slab_size=4)
+    assert np.array_equal(slab_scores, scores)
+    assert np.array_equal(slab_coords, coords)
\ No newline at end of file
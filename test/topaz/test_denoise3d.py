@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch.nn as nn
+
+import topaz.mrc as mrc
+from topaz.commands import denoise3d
+
+
+def identity_model():
+    model = nn.Conv3d(1, 1, 1)
+    model.weight.data[:] = 1
+    model.bias.data[:] = 0
+    return model
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.uint16, np.float16, np.float32])
+def test_denoise_memory_mapped(tmp_path, monkeypatch, dtype):
+    x = np.random.RandomState(0).randint(0, 200, size=(10, 12, 9)).astype(dtype)
+    path = str(tmp_path / 'tomo.mrc')
+    with mrc.MRCWriter(path, dtype=None) as writer:
+        writer.write(x)
+
+    ## patches are read from the memory map in the mode of the file
+    tomos = []
+    class RecordingPatchDataset(denoise3d.PatchDataset):
+        def __init__(self, tomo, *args):
+            tomos.append(tomo)
+            super(RecordingPatchDataset, self).__init__(tomo, *args)
+    monkeypatch.setattr(denoise3d, 'PatchDataset', RecordingPatchDataset)
+
+    for out_dtype in ['float32', 'float16']:
+        denoise3d.denoise(identity_model(), path, str(tmp_path), '.' + out_dtype, patch_size=4
+                         , padding=2, batch_size=3, dtype=out_dtype)
+        y,header,_ = mrc.open_mmap(str(tmp_path / ('tomo.' + out_dtype + '.mrc')))
+        assert y.dtype == np.dtype(out_dtype)
+        assert np.allclose(y, x.astype(np.float32), rtol=1e-3, atol=1e-3)
+
+    assert isinstance(tomos[0], np.memmap) and tomos[0].dtype == dtype
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from topaz.commands import extract
+from topaz.commands.extract import watch_micrographs
+
+
+def test_watch_waits_for_settle(tmp_path):
+    path = str(tmp_path / 'a.mrc')
+    done = threading.Event()
+    def grow():
+        with open(path, 'wb') as f:
+            for _ in range(6):
+                f.write(b'\0'*64)
+                f.flush()
+                time.sleep(0.1)
+        done.set()
+    thread = threading.Thread(target=grow)
+    thread.start()
+
+    ## picked once, only after the file stopped growing
+    paths = []
+    for found in watch_micrographs(str(tmp_path), poll=0.02, settle=0.3, timeout=0.2):
+        assert done.is_set() and os.path.getsize(found) == 6*64
+        paths.append(found)
+    thread.join()
+    assert paths == [path]
+
+
+def test_watch_skips_processed(tmp_path):
+    paths = []
+    for name in ['a.mrc', 'b.mrc', 'c.tiff']:
+        paths.append(str(tmp_path / name))
+        open(paths[-1], 'wb').close()
+
+    found = list(watch_micrographs(str(tmp_path), processed=[paths[0]], poll=0.02, settle=0.05
+                                  , timeout=0.1))
+    assert found == [paths[1]]
+
+
+def write_scores(path, peaks):
+    x = np.full((32, 40), -10, dtype=np.float32)
+    for i,j in peaks:
+        x[j,i] = 10
+    Image.fromarray(x).save(path)
+
+
+def run_watch(directory, output):
+    parser = extract.add_arguments()
+    args = parser.parse_args(['-m', 'none', '-r', '3', '-t', '0', '-o', output, '--watch', directory
+                             , '--watch-pattern', '*.tiff', '--poll-interval', '0.02'
+                             , '--settle-time', '0.05', '--watch-timeout', '0.2'])
+    extract.main(args)
+
+
+def test_watch_journal_restart(tmp_path):
+    directory = tmp_path / 'micrographs'
+    directory.mkdir()
+    output = str(tmp_path / 'particles.txt')
+    write_scores(str(directory / 'a.tiff'), [(5, 6)])
+    write_scores(str(directory / 'b.tiff'), [(20, 12), (30, 20)])
+    run_watch(str(directory), output)
+
+    ## after a restart, only the new micrograph is picked and appended
+    write_scores(str(directory / 'c.tiff'), [(8, 25)])
+    run_watch(str(directory), output)
+
+    with open(output) as f:
+        lines = [line.split('\t')[:3] for line in f.read().splitlines()]
+    assert lines[0] == ['image_name', 'x_coord', 'y_coord']
+    assert sorted(lines[1:]) == [['a', '5', '6'], ['b', '20', '12'], ['b', '30', '20'], ['c', '8', '25']]
+    assert lines[-1] == ['c', '8', '25']
+
+    with open(output + '.journal') as f:
+        journal = f.read().splitlines()
+    assert sorted(journal) == [str(directory / name) for name in ['a.tiff', 'b.tiff', 'c.tiff']]
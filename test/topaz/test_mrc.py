@@ -1,3 +1,4 @@
+import os
 from topaz.mrc import get_mode, make_header, parse, write
 
 
@@ -10,7 +11,10 @@ def test_parse():
     pass
 
 def test_get_mode():
-    pass
+    import numpy as np
+    assert get_mode(np.float32) == 2
+    assert get_mode(np.float16) == 12
+    assert get_mode(np.dtype('int16')) == 1
 
 
 def test_make_header():
@@ -18,4 +22,67 @@ def test_make_header():
 
 
 def test_write():
-    pass
\ No newline at end of file
+    pass
+
+def test_open(tmp_path):
+    import numpy as np
+    import topaz.mrc as mrc
+
+    x = np.random.randn(4, 32, 48).astype(np.float32)
+    path = str(tmp_path / 'stack.mrc')
+    with open(path, 'wb') as f:
+        write(f, x, extended_header=b'\x01'*16)
+
+    array, header, extended_header = mrc.open_mmap(path)
+    assert isinstance(array, np.memmap)
+    assert array.shape == x.shape
+    assert extended_header == b'\x01'*16
+    assert np.array_equal(array[2], x[2])
+    assert np.array_equal(array[1:3, 8:16], x[1:3, 8:16])
+
+    with open(path, 'rb') as f:
+        expected, expected_header, _ = parse(f.read())
+    assert header == expected_header
+    assert np.array_equal(array, expected)
+
+
+def test_mrc_writer(tmp_path):
+    import numpy as np
+    import topaz.mrc as mrc
+
+    x = np.random.randn(5, 16, 24)
+    path = str(tmp_path / 'stream.mrc')
+    with mrc.MRCWriter(path) as writer:
+        writer.write(x[0]) # section
+        writer.write(x[1:]) # slab
+
+    array, header, _ = mrc.open_mmap(path)
+    assert array.dtype == np.float32
+    assert header.nz == 5 and header.ny == 16 and header.nx == 24
+    assert np.allclose(array, x.astype(np.float32))
+    assert np.isclose(header.amin, x.min()) and np.isclose(header.amax, x.max())
+    assert np.isclose(header.amean, x.mean(), atol=1e-6)
+    assert np.isclose(header.rms, x.std(), atol=1e-6)
+
+    ## the statistics stay accurate for data far from zero
+    x = (1e7 + 4*np.random.randn(4, 64, 64)).astype(np.float32)
+    with mrc.MRCWriter(path) as writer:
+        for section in x:
+            writer.write(section)
+    _, header, _ = mrc.open_mmap(path)
+    assert np.isclose(header.rms, x.astype(np.float64).std(), rtol=1e-5)
+
+    ## nothing is left behind when writing fails
+    try:
+        with mrc.MRCWriter(path) as writer:
+            writer.write(x[0])
+            raise ValueError()
+    except ValueError:
+        pass
+    assert not os.path.exists(path)
+
+    ## keep the dtype of the data
+    with mrc.MRCWriter(path, dtype=None) as writer:
+        writer.write(np.arange(16*24, dtype=np.int16).reshape(16, 24))
+    array, header, _ = mrc.open_mmap(path)
+    assert array.dtype == np.int16 and header.mode == 1
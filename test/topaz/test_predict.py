@@ -1,15 +1,95 @@
+import numpy as np
 import torch
 
-from topaz.predict import batches, score, score_stream
+from topaz.model.classifier import LinearClassifier
+from topaz.model.features.resnet import ResNet8
+from topaz.predict import (Scorer, batches, bucketed_batches, score, score_stream, score_tiled
+                          , score_coarse_to_fine, score_shift_stitch, scoring_pool)
+from topaz.utils.pipeline import pool_map
+
+
+def mixed_images(random=np.random):
+    shapes = [(16,24), (20,20), (16,24), (16,24), (20,20), (8,8), (16,24)]
+    return [random.randn(*shape).astype(np.float32) for shape in shapes]
 
 
 def test_batches():
-    pass
+    images = mixed_images(np.random.RandomState(0))
+    stacked = list(batches(images, batch_size=2))
+    assert sum(len(x) for x in stacked) == len(images)
+    flat = [x for batch in stacked for x in batch.numpy()]
+    for x,y in zip(images, flat):
+        assert np.array_equal(x, y)
+
+    seen = []
+    for indices,batch in bucketed_batches(images, batch_size=2, max_pending=3):
+        assert len(batch) == len(indices) <= 2
+        for i,x in zip(indices, batch.numpy()):
+            assert np.array_equal(images[i], x)
+        seen.extend(indices)
+    assert sorted(seen) == list(range(len(images)))
 
 
 def test_score_stream():
-    pass
+    images = mixed_images(np.random.RandomState(1))
+    torch.manual_seed(0)
+    model = torch.nn.Conv2d(1, 1, 3, padding=1)
+    model.eval()
+
+    expected = score(model, images, batch_size=1)
+    for batch_size in [2, 3, 16]:
+        scores = list(score_stream(model, images, batch_size=batch_size, max_pending=batch_size))
+        assert len(scores) == len(expected)
+        for x,y in zip(expected, scores):
+            assert x.shape == y.shape
+            assert np.allclose(x, y, atol=1e-5)
 
 
 def test_score(): 
-    pass
\ No newline at end of file
+    torch.manual_seed(0)
+    model = LinearClassifier(ResNet8(units=4, bn=False))
+    model.eval()
+    model.fill()
+
+    x = np.random.RandomState(2).randn(90, 77).astype(np.float32)
+    expected, = score(model, [x])
+    for tile_size in [16, 40, 100]:
+        y = score_tiled(model, x, tile_size=tile_size, batch_size=2)
+        assert np.allclose(expected, y, atol=1e-5)
+
+    model.unfill()
+    y = score_shift_stitch(model, x)
+    assert np.allclose(expected, y, atol=1e-5)
+
+    ## refined tiles of the coarse to fine score map match the dense scores
+    threshold = np.percentile(expected, 99)
+    y,refined = score_coarse_to_fine(model, x, threshold, tile_size=16, batch_size=2)
+    mask = np.isfinite(y)
+    assert mask.any()
+    assert np.allclose(expected[mask], y[mask], atol=1e-5)
+
+
+def test_scorer_pool(tmp_path):
+    torch.manual_seed(0)
+    model = LinearClassifier(ResNet8(units=4, bn=False))
+    path = str(tmp_path / 'model.sav')
+    torch.save(model, path)
+    model.eval()
+    model.fill()
+
+    images = mixed_images(np.random.RandomState(3)) + [np.random.RandomState(4).randn(150, 130).astype(np.float32)]
+    expected = score(model, images)
+
+    ## workers load their own copy of the model and return the scores in order
+    scorer = Scorer(path, compiled=False)
+    pool = scoring_pool(2, num_threads=1)
+    try:
+        results = list(pool_map(scorer, enumerate(images + [None]), pool, depth=4, shared=True))
+    finally:
+        pool.terminate()
+    assert scorer._model is None
+    assert [name for name,_ in results] == list(range(len(images) + 1))
+    assert results[-1][1] is None
+    for x,(_,y) in zip(expected, results):
+        assert x.shape == y.shape
+        assert np.allclose(x, y, atol=1e-5)
@@ -0,0 +1,146 @@
+import os
+import threading
+
+import numpy as np
+import torch.nn as nn
+from PIL import Image
+
+from topaz.server import InferenceWorker, make_server, request, run_job
+
+
+class Identity(nn.Module):
+    def forward(self, x):
+        return x
+
+
+class StubWorker(InferenceWorker):
+    """ worker with identity models, recording the number of jobs scored together """
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        self.loading = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        super(StubWorker, self).__init__(*args, **kwargs)
+
+    def load(self, kind, name):
+        self.loading.set()
+        self.release.wait()
+        return Identity()
+
+    def _pick(self, model, jobs):
+        self.batches.append(len(jobs))
+        super(StubWorker, self)._pick(model, jobs)
+
+
+def make_image(path, peak=(20, 12)):
+    x = np.zeros((32, 40), dtype=np.float32)
+    x[peak[1], peak[0]] = 10
+    Image.fromarray(x).save(path)
+    return str(path)
+
+
+def collect(job, worker, **kwargs):
+    results = []
+    run_job(job, worker, results.append, **kwargs)
+    return results
+
+
+def test_pick(tmp_path):
+    worker = StubWorker(picker='stub')
+    path = make_image(tmp_path / 'a.tiff')
+    results = collect({'command': 'pick', 'paths': [path], 'radius': 3, 'threshold': 5}, worker)
+
+    assert results[-1]['done'] and results[-1]['count'] == 1
+    assert results[0]['image_name'] == 'a'
+    assert results[0]['x_coord'] == [20] and results[0]['y_coord'] == [12]
+
+
+def test_bad_path(tmp_path):
+    worker = StubWorker(picker='stub')
+    good = make_image(tmp_path / 'a.tiff')
+    bad = str(tmp_path / 'missing.tiff')
+    results = collect({'command': 'pick', 'paths': [bad, good], 'radius': 3}, worker)
+
+    assert results[0]['path'] == bad and 'error' in results[0]
+    assert results[1]['path'] == good and 'error' not in results[1]
+    assert results[-1]['count'] == 2
+
+
+def test_denoise(tmp_path):
+    worker = StubWorker(denoiser='stub')
+    path = make_image(tmp_path / 'a.tiff')
+    root = tmp_path / 'out'
+    job = {'command': 'denoise', 'paths': [path], 'output': 'sub', 'format': 'tiff'
+          , 'patch_size': -1, 'padding': 0}
+    results = collect(job, worker, output_root=str(root))
+
+    assert results[0]['output'] == str(root / 'sub' / 'a.tiff')
+    x = np.array(Image.open(results[0]['output']))
+    assert np.allclose(x, np.array(Image.open(path)), atol=1e-4)
+
+
+def test_rejected_jobs(tmp_path):
+    worker = StubWorker(picker='stub', denoiser='stub')
+    path = make_image(tmp_path / 'a.tiff')
+
+    ## models that were not configured are never loaded
+    results = collect({'command': 'pick', 'paths': [path], 'radius': 3, 'model': str(path)}, worker)
+    assert len(results) == 1 and 'not allowed' in results[0]['error']
+    assert not worker.loading.is_set()
+
+    ## denoised micrographs are only written inside the output root
+    root = str(tmp_path / 'out')
+    for job in [{'output': '../elsewhere'}, {'output': str(tmp_path)}, {'suffix': '/../x'}]:
+        job.update({'command': 'denoise', 'paths': [path]})
+        results = collect(job, worker, output_root=root)
+        assert len(results) == 1 and 'error' in results[0]
+    results = collect({'command': 'denoise', 'paths': [path]}, worker)
+    assert len(results) == 1 and 'error' in results[0]
+    assert not os.path.exists(root)
+
+
+def test_unix_socket(tmp_path, capsys):
+    worker = StubWorker(picker='stub')
+    path = make_image(tmp_path / 'a.tiff')
+    socket_path = str(tmp_path / 'topaz.sock')
+    server = make_server(worker, socket_path=socket_path, verbose=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        results = list(request({'command': 'pick', 'paths': [path], 'radius': 3, 'threshold': 5}
+                              , socket_path))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert results[0]['x_coord'] == [20]
+    assert results[-1] == dict(results[-1], done=True, count=1)
+    assert 'pick job with 1 paths' in capsys.readouterr().err
+
+
+def test_concurrent_jobs_batch(tmp_path):
+    worker = StubWorker(picker='stub', batch_size=8)
+    paths = [make_image(tmp_path / '{}.tiff'.format(i)) for i in range(3)]
+
+    ## hold the worker in the model load of the first job while the others queue up
+    worker.release.clear()
+    first = worker.submit('pick', 'stub', np.zeros((32, 40), dtype=np.float32), {})
+    worker.loading.wait()
+
+    results = {}
+    def run(i):
+        results[i] = collect({'command': 'pick', 'paths': [paths[i]], 'radius': 3}, worker)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(1, 3)]
+    for thread in threads:
+        thread.start()
+    while worker.jobs.qsize() < 2:
+        threading.Event().wait(0.01)
+    worker.release.set()
+    for thread in threads:
+        thread.join()
+
+    first.result()
+    assert worker.batches == [1, 2]
+    assert all(results[i][-1]['count'] == 1 for i in results)
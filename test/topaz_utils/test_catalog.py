@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+import topaz.mrc as mrc
+from topaz.utils.catalog import load_catalog, read_info, scan
+
+
+def write_mrc(path, shape=(2, 6, 5), ax=5.0):
+    with open(path, 'wb') as f:
+        mrc.write(f, np.zeros(shape, dtype=np.float32), ax=ax)
+    return str(path)
+
+
+def write_tiff(path, shape=(6, 5)):
+    Image.fromarray(np.zeros(shape, dtype=np.float32)).save(path)
+    return str(path)
+
+
+def test_read_info(tmp_path):
+    ## MRC files are recognized by .mrc or .mrcs in any case
+    for name in ['a.mrc', 'b.MRC', 'c.mrcs']:
+        info = read_info(write_mrc(tmp_path / name))
+        assert (info.width, info.height, info.depth) == (5, 6, 2)
+        assert info.dtype == 'float32' and info.mode == '2'
+        assert info.pixel_size == 5.0
+        assert info.size == os.path.getsize(info.path)
+
+    info = read_info(write_tiff(tmp_path / 'd.tiff'))
+    assert (info.width, info.height, info.depth) == (5, 6, 1)
+    assert info.dtype == 'float32' and info.mode == 'F'
+    assert np.isnan(info.pixel_size)
+
+
+def test_scan_catalog(tmp_path, monkeypatch):
+    paths = [write_mrc(tmp_path / 'a.mrc'), write_tiff(tmp_path / 'b.tiff')]
+    catalog = str(tmp_path / 'catalog.txt')
+    table = scan(paths, num_workers=2, catalog=catalog)
+    assert list(table.path) == paths
+    assert list(table.width) == [5, 5] and list(table.depth) == [2, 1]
+    assert sorted(load_catalog(catalog).path) == sorted(paths)
+
+    read = []
+    def counted(path):
+        read.append(path)
+        return read_info(path)
+    monkeypatch.setattr('topaz.utils.catalog.read_info', counted)
+
+    ## unchanged images are catalog hits
+    assert scan(paths, catalog=catalog).equals(table)
+    assert read == []
+
+    ## a new size or modification time is a miss
+    write_mrc(tmp_path / 'a.mrc', shape=(1, 6, 5))
+    st = os.stat(paths[1])
+    os.utime(paths[1], (st.st_atime, st.st_mtime + 10))
+    table = scan(paths, catalog=catalog)
+    assert sorted(read) == sorted(paths)
+    assert list(table.depth) == [1, 1]
+    assert load_catalog(catalog).loc[paths[1], 'mtime'] == st.st_mtime + 10
@@ -0,0 +1,133 @@
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from topaz.utils.pipeline import (AsyncWriter, SharedArray, StageStats, _receive, pool_map,
+                                  process_pool, share, thread_map)
+
+
+def slow_square(x):
+    ## later items finish first
+    time.sleep(0.01*(5 - x % 5))
+    return x*x
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError('bad item')
+    return x
+
+
+def fail_on_name_three(args):
+    name,x = args
+    return fail_on_three(name), x
+
+
+def scale_array(args):
+    name,x = args
+    time.sleep(0.01*(3 - name % 3))
+    return name, x*2
+
+
+def shm_names():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = process_pool(3)
+    yield pool
+    pool.terminate()
+
+
+@pytest.mark.parametrize('num_workers', [0, 1, 4])
+def test_thread_map_order(num_workers):
+    stats = StageStats('square')
+    y = list(thread_map(slow_square, range(12), num_workers=num_workers, depth=4, stats=stats))
+    assert y == [x*x for x in range(12)]
+    assert stats.count == 12
+
+
+def test_thread_map_error():
+    y = thread_map(fail_on_three, range(6), num_workers=2)
+    assert [next(y) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(y)
+
+
+def test_pool_map_order(pool):
+    y = list(pool_map(slow_square, range(12), pool, depth=4))
+    assert y == [x*x for x in range(12)]
+
+
+def test_pool_map_error(pool):
+    with pytest.raises(ValueError):
+        list(pool_map(fail_on_three, range(6), pool, depth=3))
+
+
+def test_pool_map_shared(pool):
+    before = shm_names()
+    random = np.random.RandomState(0)
+    ## arrays above and below the sharing threshold
+    images = [(i, random.randn(128, 128 if i % 2 else 4).astype(np.float32)) for i in range(8)]
+    results = list(pool_map(scale_array, iter(images), pool, depth=4, shared=True))
+    assert [name for name,_ in results] == list(range(8))
+    for (_,x),(_,y) in zip(images, results):
+        assert type(y) is np.ndarray and np.array_equal(y, x*2)
+    assert shm_names() == before
+
+    ## results still in flight are freed when the consumer stops early
+    results = pool_map(scale_array, iter(images), pool, depth=4, shared=True)
+    next(results)
+    results.close()
+    assert shm_names() == before
+
+
+def test_pool_map_shared_error(pool):
+    before = shm_names()
+    images = [(i, np.zeros((128, 128), dtype=np.float32)) for i in range(6)]
+    with pytest.raises(ValueError):
+        list(pool_map(fail_on_name_three, iter(images), pool, depth=3, shared=True))
+    assert shm_names() == before
+
+
+def test_receive_releases():
+    x = np.arange(2**15, dtype=np.float32)
+    handle = share(x)
+    assert isinstance(handle, SharedArray)
+    assert share(x[:10]) is not None and not isinstance(share(x[:10]), SharedArray)
+
+    name,y = _receive(('a', handle))
+    assert name == 'a' and np.array_equal(y, x)
+    ## the shared memory is unlinked once the result is copied out
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=handle.name)
+
+
+def test_async_writer():
+    written = []
+    def write(x):
+        time.sleep(0.001*(x % 3))
+        written.append(x)
+    with AsyncWriter(write, depth=2) as writer:
+        for x in range(10):
+            writer.put(x)
+    assert written == list(range(10))
+
+
+def test_async_writer_error():
+    written = []
+    def write(x):
+        if x == 2:
+            raise IOError('disk full')
+        written.append(x)
+    writer = AsyncWriter(write, depth=1)
+    with pytest.raises(IOError):
+        for x in range(100):
+            writer.put(x)
+        writer.close()
+    ## nothing is written after the error
+    assert written == [0, 1]
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from topaz.model.classifier import LinearClassifier
+from topaz.model.features.resnet import ResNet8
+from topaz.predict import score, score_coarse_to_fine
+from topaz.utils.scores import ScoreMaps, ScoreStore, hash_file, hash_model
+
+
+def test_roundtrip(tmp_path):
+    store = ScoreStore(str(tmp_path))
+    score = np.random.RandomState(0).randn(16, 20).astype(np.float32)
+    key = store.add('a', score, model_hash='m', image_hash='i')
+
+    assert store.lookup('m', 'i') == key
+    assert key in store and len(store) == 1
+    x = store.load(key)
+    assert x.dtype == np.float32 and np.array_equal(x, score)
+
+    ## adding the same map again keeps the stored one
+    assert store.add('a', score + 1, model_hash='m', image_hash='i') == key
+    assert np.array_equal(store.load(key), score)
+
+    maps = ScoreMaps(store, {'a': key})
+    assert list(maps) == ['a'] and np.array_equal(maps['a'], score)
+
+
+@pytest.mark.parametrize('dtype,atol', [('float16', 1e-2), ('uint8', None)])
+def test_quantization(tmp_path, dtype, atol):
+    store = ScoreStore(str(tmp_path), dtype=dtype)
+    score = np.random.RandomState(0).uniform(-8, 4, size=(16, 20)).astype(np.float32)
+    x = store.load(store.add('a', score))
+
+    assert x.dtype == np.float32 if dtype == 'uint8' else x.dtype == np.float16
+    if atol is None:
+        ## within half a quantization step of the range of the map
+        atol = (score.max() - score.min())/254/2*(1 + 1e-5)
+        assert x.min() == pytest.approx(score.min()) and x.max() == pytest.approx(score.max())
+    assert np.abs(x - score).max() <= atol
+
+
+def test_constant_uint8(tmp_path):
+    store = ScoreStore(str(tmp_path), dtype='uint8')
+    score = np.full((4, 5), -3, dtype=np.float32)
+    assert np.array_equal(store.load(store.add('a', score)), score)
+
+
+def test_coarse_to_fine_uint8(tmp_path):
+    torch.manual_seed(0)
+    model = LinearClassifier(ResNet8(units=4, bn=False))
+    model.eval()
+    x = np.random.RandomState(2).randn(200, 200).astype(np.float32)
+    model.fill()
+    dense, = score(model, [x])
+    model.unfill()
+    scores,_ = score_coarse_to_fine(model, x, np.percentile(dense, 99.9), tile_size=16)
+    mask = np.isfinite(scores)
+    assert mask.any() and not mask.all()
+
+    ## pixels that were not refined stay -inf, refined ones keep their scores
+    store = ScoreStore(str(tmp_path), dtype='uint8')
+    y = store.load(store.add('a', scores))
+    assert np.array_equal(np.isfinite(y), mask)
+    assert (y[~mask] == -np.inf).all()
+    step = (scores[mask].max() - scores[mask].min())/254
+    assert np.abs(y[mask] - scores[mask]).max() <= step/2*(1 + 1e-5)
+
+    ## maps without any finite score
+    y = store.load(store.add('b', np.full((3, 3), -np.inf, dtype=np.float32)))
+    assert (y == -np.inf).all()
+
+
+def test_reload_index(tmp_path):
+    store = ScoreStore(str(tmp_path), dtype='uint8')
+    score = np.random.RandomState(0).randn(8, 8).astype(np.float32)
+    a = store.add('a', score, model_hash='m', image_hash='i')
+    b = store.add('b', score, model_hash='m', image_hash='j')
+    (tmp_path / (b + '.npy')).unlink()
+
+    ## maps whose files are missing are dropped, the others keep their quantization
+    store = ScoreStore(str(tmp_path))
+    assert store.lookup('m', 'i') == a and store.lookup('m', 'j') is None
+    assert np.abs(store.load(a) - score).max() <= (score.max() - score.min())/254
+
+
+def test_key_miss(tmp_path):
+    store = ScoreStore(str(tmp_path))
+    path = tmp_path / 'image.mrc'
+    path.write_bytes(b'\0'*100)
+    model = nn.Conv2d(1, 1, 3)
+    model_hash,image_hash = hash_model(model), hash_file(str(path))
+    store.add('image', np.zeros((4, 4), dtype=np.float32), model_hash=model_hash, image_hash=image_hash)
+    assert store.lookup(model_hash, image_hash) is not None
+
+    ## changing the micrograph or the model parameters misses
+    path.write_bytes(b'\0'*99 + b'\1')
+    assert store.lookup(model_hash, hash_file(str(path))) is None
+    model.bias.data += 1
+    assert store.lookup(hash_model(model), image_hash) is None
+
+    ## maps without an image hash are keyed by name
+    store.add('b', np.zeros((4, 4), dtype=np.float32))
+    assert store.lookup(image_name='b') is not None and store.lookup(image_name='c') is None
+
+
+def test_bad_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        ScoreStore(str(tmp_path), dtype='int8')
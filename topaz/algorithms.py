@@ -2,109 +2,430 @@ from __future__ import absolute_import, print_function, division
 
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 
-def match_coordinates(targets, preds, radius):
-    d2 = np.sum((preds[:,np.newaxis] - targets[np.newaxis])**2, 2)
-    cost = d2 - radius*radius
-    cost[cost > 0] = 0
+def _match_pairs_optimal(i, j, d2, num_preds, num_targets, radius):
+    """ maximum weight matching of the candidate pairs, solved per connected component """
+    graph = coo_matrix((np.ones(len(i)), (i, num_preds + j)), shape=(num_preds+num_targets,)*2)
+    _,labels = connected_components(graph, directed=False)
+    component = labels[i]
 
-    pred_index,target_index = linear_sum_assignment(cost)
+    ## components with a single pair are matched directly
+    counts = np.bincount(component)
+    single = counts[component] == 1
+    matched = [np.flatnonzero(single)]
 
-    cost = cost[pred_index, target_index]
-    dist = np.zeros(len(preds))
-    dist[pred_index] = np.sqrt(d2[pred_index, target_index])
+    ## solve the assignment problem within each larger component
+    multi = np.flatnonzero(~single)
+    multi = multi[np.argsort(component[multi], kind='stable')]
+    bounds = np.flatnonzero(np.diff(component[multi])) + 1
+    for group in np.split(multi, bounds):
+        if len(group) == 0:
+            continue
+        rows,ii = np.unique(i[group], return_inverse=True)
+        cols,jj = np.unique(j[group], return_inverse=True)
+        cost = np.zeros((len(rows), len(cols)))
+        cost[ii,jj] = d2[group] - radius*radius
+        pair = -np.ones((len(rows), len(cols)), dtype=int)
+        pair[ii,jj] = group
+
+        row_index,col_index = linear_sum_assignment(cost)
+        keep = cost[row_index, col_index] < 0
+        matched.append(pair[row_index[keep], col_index[keep]])
+
+    return np.concatenate(matched)
+
+
+def _match_pairs_greedy(i, j, d2):
+    """ match the candidate pairs in order of increasing distance """
+    order = np.lexsort((j, i, d2))
+    used_preds = set()
+    used_targets = set()
+    matched = []
+    for k in order:
+        if i[k] not in used_preds and j[k] not in used_targets:
+            used_preds.add(i[k])
+            used_targets.add(j[k])
+            matched.append(k)
+    return np.array(matched, dtype=int)
+
+
+def match_coordinates(targets, preds, radius, greedy=False):
+    """
+    Match predicted coordinates to target coordinates. Only pairs closer than
+    radius can be matched and the matching maximizes the total of radius^2 - d^2
+    over the matched pairs, where d is the distance between matched coordinates.
+
+    Candidate pairs are found with a KD-tree and the assignment problem is solved
+    separately within each connected component of the candidate pair graph, so
+    the cost scales with the number of nearby pairs rather than preds x targets.
+    If greedy is set, pairs are instead matched in order of increasing distance.
+
+    Returns a 0/1 assignment for each prediction and the distance from each
+    prediction to its matched target (0 for unmatched predictions).
+    """
+    preds = np.asarray(preds, dtype=np.float64).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
 
-    pred_index = pred_index[cost < 0]
     assignment = np.zeros(len(preds), dtype=np.float32)
-    assignment[pred_index] = 1
+    dist = np.zeros(len(preds))
+    if len(preds) == 0 or len(targets) == 0 or radius <= 0:
+        return assignment, dist
+
+    pairs = cKDTree(preds).sparse_distance_matrix(cKDTree(targets), radius, output_type='ndarray')
+    i = pairs['i']
+    j = pairs['j']
+    d2 = np.sum((preds[i] - targets[j])**2, 1)
+    within = d2 < radius*radius
+    i = i[within]
+    j = j[within]
+    d2 = d2[within]
+
+    if greedy:
+        matched = _match_pairs_greedy(i, j, d2)
+    else:
+        matched = _match_pairs_optimal(i, j, d2, len(preds), len(targets), radius)
+
+    assignment[i[matched]] = 1
+    dist[i[matched]] = np.sqrt(d2[matched])
 
     return assignment, dist
 
 
-def non_maximum_suppression(x, r, threshold=-np.inf):
-    ## enumerate coordinate deltas within d
-    width = r
-    ii,jj = np.meshgrid(np.arange(-width,width+1), np.arange(-width,width+1))
-    mask = (ii**2 + jj**2) <= r*r
-    ii = ii[mask]
-    jj = jj[mask]
-    major_axis = x.shape[1]
-    coord_deltas = ii*major_axis + jj
+def _ball_mask(r, ndim):
+    """ boolean mask of the offsets within distance r of the center of a (2w+1)^ndim box """
+    width = max(int(np.ceil(r)), 0)
+    grid = np.arange(-width, width+1)
+    d2 = np.zeros((2*width+1,)*ndim)
+    for axis in range(ndim):
+        shape = [1]*ndim
+        shape[axis] = -1
+        d2 = d2 + grid.reshape(shape)**2
+    return d2 <= r*r
 
-    A = x.ravel()
-    I = np.argsort(A, axis=None)[::-1] # reverse to sort in descending order
 
-    S = set()
-    #S = np.zeros(len(A), dtype=np.int8) # the set of suppressed coordinates
-    #S = np.zeros(x.shape, dtype=np.int8)
+def _window_max(x, size, axis):
+    """ max over every window of size consecutive entries along axis (valid windows only) """
+    n = x.shape[axis]
+    def take(a, start, stop):
+        index = [slice(None)]*a.ndim
+        index[axis] = slice(start, stop)
+        return a[tuple(index)]
+    ## doubling: after each step m[j] is the max of x[j:j+k]
+    m = x
+    k = 1
+    while 2*k <= size:
+        m = np.maximum(take(m, 0, n-2*k+1), take(m, k, n-k+1))
+        k *= 2
+    if k == size:
+        return m
+    return np.maximum(take(m, 0, n-size+1), take(m, size-k, n-k+1))
 
-    scores = np.zeros(len(A), dtype=np.float32)
-    coords = np.zeros((len(A),2), dtype=np.int32)
 
-    j = 0
-    for i in I:
-        if A[i] <= threshold:
+def _box_max(x, width, axis):
+    """ max over the 2*width+1 entries centered on each entry along axis """
+    pad = [(0,0)]*x.ndim
+    pad[axis] = (width, width)
+    x = np.pad(x, pad, mode='constant', constant_values=-np.inf)
+    return _window_max(x, 2*width+1, axis)
+
+
+def _punctured_box_max(x, width):
+    """ max over the (2*width+1)^d box around each entry, excluding the entry itself """
+    ## the punctured box is the union, over each axis k, of the two half boxes
+    ## strictly before and after the entry along axis k that span the full box
+    ## along the axes after k and only the entry itself along the axes before k
+    m = None
+    full = x
+    for axis in reversed(range(x.ndim)):
+        n = x.shape[axis]
+        pad = [(0,0)]*x.ndim
+        pad[axis] = (width, width)
+        h = np.pad(full, pad, mode='constant', constant_values=-np.inf)
+        h = _window_max(h, width, axis)
+        ## windows starting at i cover the entries before i,
+        ## windows starting at i+width+1 cover the entries after i
+        before = [slice(None)]*x.ndim
+        after = [slice(None)]*x.ndim
+        before[axis] = slice(0, n)
+        after[axis] = slice(width+1, width+1+n)
+        h = np.maximum(h[tuple(before)], h[tuple(after)])
+        m = h if m is None else np.maximum(m, h)
+        if axis > 0:
+            full = _box_max(full, width, axis)
+    return m
+
+
+def strict_local_maxima(x, r):
+    """
+    Mask of the entries of x that are strictly greater than every other entry
+    within a box of half-width ceil(r). Because the box contains the radius r
+    ball, these entries are always accepted by greedy non maximum suppression.
+    """
+    width = max(int(np.ceil(r)), 0)
+    if width < 1:
+        return np.ones(x.shape, dtype=bool)
+    return x > _punctured_box_max(x, width)
+
+
+def _suppress(S, center, mask):
+    """ mark the entries of S covered by mask centered at center, clipping at the edges """
+    width = mask.shape[0]//2
+    block = []
+    mask_block = []
+    for c,n in zip(center, S.shape):
+        lo = max(c - width, 0)
+        hi = min(c + width + 1, n)
+        block.append(slice(lo, hi))
+        mask_block.append(slice(lo - c + width, hi - c + width))
+    S[tuple(block)] |= mask[tuple(mask_block)]
+
+
+def _slabs(n, size):
+    for start in range(0, n, size):
+        yield start, min(start+size, n)
+
+
+def _greedy_suppression(x, mask, threshold, slab_size=None):
+    """
+    Greedy non maximum suppression of x using mask as the neighborhood of each peak.
+    Returns the flat indices of the accepted peaks in order of decreasing score,
+    with ties visited in reverse raster order.
+
+    If slab_size is given, x is only read slab_size entries at a time along
+    the first axis, so x can be a memory-mapped array larger than RAM.
+    Only the boolean suppression map is held in memory in full.
+    """
+    n = x.shape[0]
+    if slab_size is None:
+        slab_size = n
+    stride = int(np.prod(x.shape[1:]))
+    width = mask.shape[0]//2
+    S = np.zeros(x.shape, dtype=bool)
+
+    def active(lo, hi):
+        return (x[lo:hi] > threshold) & ~S[lo:hi]
+
+    def gather(lo, hi, keep):
+        index = np.flatnonzero(keep) + lo*stride
+        return index, np.asarray(x[lo:hi]).ravel()[index - lo*stride]
+
+    if mask.size == 1: # nothing to suppress, every candidate is a peak
+        index,values = zip(*[gather(lo, hi, active(lo, hi)) for lo,hi in _slabs(n, slab_size)])
+        index = np.concatenate(index)
+        values = np.concatenate(values)
+        return index[np.argsort(values, kind='stable')[::-1]]
+
+    ## an unsuppressed candidate that is a strict local maximum among the
+    ## unsuppressed candidates is accepted regardless of the visiting order,
+    ## so accept these in vectorized rounds until few candidates remain
+    peaks = []
+    remaining = 1
+    while remaining > 0:
+        found = []
+        for lo,hi in _slabs(n, slab_size):
+            ## extend the slab by the neighborhood width on both sides
+            a = max(lo - width, 0)
+            b = min(hi + width, n)
+            act = active(a, b)
+            y = np.where(act, x[a:b], -np.inf)
+            strict = act & strict_local_maxima(y, width)
+            found.append(np.flatnonzero(strict[lo-a:hi-a]) + lo*stride)
+        found = np.concatenate(found)
+        for center in zip(*np.unravel_index(found, x.shape)):
+            _suppress(S, center, mask)
+        peaks.append(found)
+        remaining = sum(active(lo, hi).sum() for lo,hi in _slabs(n, slab_size))
+        if len(found) == 0 or remaining < S.size//8:
             break
-        if i not in S:
-            ## coordinate i is next center
-            xx = i % major_axis
-            yy = i // major_axis
-            scores[j] = A[i]
-            coords[j,0] = xx
-            coords[j,1] = yy
-            j += 1
-            ## add coordinates within d of i to the suppressed set
-            y_coords = np.clip(yy + ii, 0, x.shape[0])
-            x_coords = np.clip(xx + jj, 0, x.shape[1]) 
-            for y_coord,x_coord in zip(y_coords, x_coords):
-                S.add(y_coord*major_axis + x_coord)
-    
-    return scores[:j], coords[:j]
-
-
-def non_maximum_suppression_3d(x, d, scale=1.0, threshold=-np.inf):
-    ## enumerate coordinate deltas within d
-    r = scale*d/2
-    width = int(np.ceil(r))
-    A = np.arange(-width,width+1)
-    ii,jj,kk = np.meshgrid(A, A, A)
-    mask = (ii**2 + jj**2 + kk**2) <= r*r
-    ii = ii[mask]
-    jj = jj[mask]
-    kk = kk[mask]
-    zstride = x.shape[1]*x.shape[2]
-    ystride = x.shape[2]
-    coord_deltas = ii*zstride + jj*ystride + kk
-    
+    peaks = np.concatenate(peaks)
+
+    ## visit the remaining candidates in sorted order
+    I,values = zip(*[gather(lo, hi, active(lo, hi)) for lo,hi in _slabs(n, slab_size)])
+    I = np.concatenate(I)
+    I = I[np.argsort(np.concatenate(values), kind='stable')[::-1]]
+    S_flat = S.ravel()
+    accepted = []
+    for i in I:
+        if not S_flat[i]:
+            accepted.append(i)
+            _suppress(S, np.unravel_index(i, x.shape), mask)
+
+    index = np.concatenate([peaks, np.array(accepted, dtype=peaks.dtype)])
+    values = np.asarray(x.ravel()[index])
+    order = np.lexsort((index, values))[::-1]
+    return index[order]
+
+
+def _greedy_suppression_topk(x, mask, threshold, max_peaks):
+    """
+    Greedy non maximum suppression of x that stops once max_peaks peaks are accepted.
+    Candidates are visited in blocks of the highest remaining scores selected with
+    argpartition, so only the blocks actually examined are sorted.
+    Returns the same flat indices as the first max_peaks of _greedy_suppression.
+    """
     A = x.ravel()
-    I = np.argsort(A, axis=None)[::-1] # reverse to sort in descending order
-    S = set() # the set of suppressed coordinates
+    candidates = np.flatnonzero(A > threshold)
+    values = A[candidates]
+    S_flat = np.zeros(A.size, dtype=bool)
+    S = S_flat.reshape(x.shape)
 
-    scores = np.zeros(len(A), dtype=np.float32)
-    coords = np.zeros((len(A),3), dtype=np.int32)
+    ## roughly the number of pixels examined per accepted peak is the neighborhood size
+    block = max_peaks*mask.sum()
+    rest = np.arange(len(candidates))
+    accepted = []
+    while len(accepted) < max_peaks and len(rest) > 0:
+        if block < len(rest):
+            part = np.argpartition(values[rest], len(rest)-block)
+            top = rest[part[len(rest)-block:]]
+            rest = rest[part[:len(rest)-block]]
+            ## keep scores tied with the smallest selected score in the same block
+            tied = values[rest] == values[top].min()
+            top = np.concatenate([top, rest[tied]])
+            rest = rest[~tied]
+        else:
+            top = rest
+            rest = rest[:0]
+        top = np.sort(top)
+        top = top[np.argsort(values[top], kind='stable')[::-1]]
 
-    j = 0
-    for i in I:
-        if A[i] <= threshold:
+        for i in candidates[top]:
+            if not S_flat[i]:
+                accepted.append(i)
+                _suppress(S, np.unravel_index(i, x.shape), mask)
+                if len(accepted) >= max_peaks:
+                    break
+        block *= 4
+
+    return np.array(accepted, dtype=candidates.dtype)
+
+
+def non_maximum_suppression(x, r, threshold=-np.inf, max_peaks=None):
+    """
+    Greedily extract peaks from x in order of decreasing score, suppressing
+    all coordinates within radius r of each extracted peak. Extraction
+    terminates at scores <= threshold or once max_peaks peaks are extracted.
+
+    Returns the peak scores and their (x,y) coordinates.
+    """
+    x = np.asarray(x)
+    mask = _ball_mask(r, 2)
+    if max_peaks is not None and max_peaks*mask.sum() < x.size//4:
+        index = _greedy_suppression_topk(x, mask, threshold, max_peaks)
+    else:
+        index = _greedy_suppression(x, mask, threshold)
+        if max_peaks is not None:
+            index = index[:max_peaks]
+
+    scores = x.ravel()[index].astype(np.float32)
+    coords = np.zeros((len(index),2), dtype=np.int32)
+    coords[:,1], coords[:,0] = np.unravel_index(index, x.shape)
+
+    return scores, coords
+
+
+def _greedy_suppression_sweep(x, masks, threshold):
+    """
+    Greedy non maximum suppression of x for each neighborhood in masks (at most 64)
+    in a single pass over the sorted candidates. The suppressed neighborhoods are
+    tracked as one bit per mask in an integer map. Returns a list with the flat
+    indices of the accepted peaks for each mask, ordered as in _greedy_suppression.
+    """
+    A = x.ravel()
+    k = len(masks)
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if np.dtype(dtype).itemsize*8 >= k:
             break
-        if i not in S:
-            ## coordinate i is next center
-            zz,yy,xx = np.unravel_index(i, x.shape)
-            scores[j] = A[i]
-            coords[j,0] = xx
-            coords[j,1] = yy
-            coords[j,2] = zz
-            j += 1
-            ## add coordinates within d of i to the suppressed set
-            for delta in coord_deltas:
-                S.add(i + delta)
-    
-    return scores[:j], coords[:j]
+    full = (1 << k) - 1
+    bits = [mask.astype(dtype) << dtype(j) for j,mask in enumerate(masks)]
+    B = np.zeros(x.shape, dtype=dtype)
+    candidates = x > threshold
+
+    ## strict local maxima within the widest neighborhood are accepted for every mask
+    width = max(mask.shape[0]//2 for mask in masks)
+    peaks = np.flatnonzero(candidates & strict_local_maxima(np.where(candidates, x, -np.inf), width))
+    for center in zip(*np.unravel_index(peaks, x.shape)):
+        for b in bits:
+            _suppress(B, center, b)
+
+    ## visit the remaining candidates in sorted order, accepting each
+    ## for the masks under which it is not yet suppressed
+    I = np.flatnonzero(candidates & (B != dtype(full)))
+    I = I[np.argsort(A[I], kind='stable')[::-1]]
+    B_flat = B.ravel()
+    accepted = [[] for _ in masks]
+    for i in I:
+        free = full & ~int(B_flat[i])
+        if free == 0:
+            continue
+        center = np.unravel_index(i, x.shape)
+        while free:
+            j = (free & -free).bit_length() - 1
+            free &= free - 1
+            accepted[j].append(i)
+            _suppress(B, center, bits[j])
 
+    results = []
+    for j in range(k):
+        index = np.concatenate([peaks, np.array(accepted[j], dtype=peaks.dtype)])
+        order = np.lexsort((index, A[index]))[::-1]
+        results.append(index[order])
+    return results
 
 
+def non_maximum_suppression_sweep(x, radii, threshold=-np.inf):
+    """
+    Non maximum suppression of x at every radius in radii with a single sort
+    and a single pass over the candidate peaks.
 
+    Returns a list with the (scores, coords) that non_maximum_suppression
+    gives for each radius.
+    """
+    x = np.asarray(x)
+    masks = [_ball_mask(r, 2) for r in radii]
 
+    ## radii below one suppress nothing, so only sweep over the others
+    index = [None]*len(masks)
+    sweep = []
+    for j,mask in enumerate(masks):
+        if mask.size == 1:
+            index[j] = _greedy_suppression(x, mask, threshold)
+        else:
+            sweep.append(j)
+    for start in range(0, len(sweep), 64):
+        chunk = sweep[start:start+64]
+        for j,idx in zip(chunk, _greedy_suppression_sweep(x, [masks[j] for j in chunk], threshold)):
+            index[j] = idx
+
+    results = []
+    for idx in index:
+        scores = x.ravel()[idx].astype(np.float32)
+        coords = np.zeros((len(idx),2), dtype=np.int32)
+        coords[:,1], coords[:,0] = np.unravel_index(idx, x.shape)
+        results.append((scores, coords))
+    return results
+
+
+def non_maximum_suppression_3d(x, d, scale=1.0, threshold=-np.inf, slab_size=None):
+    """
+    Greedily extract peaks from the volume x in order of decreasing score,
+    suppressing all coordinates within radius scale*d/2 of each extracted peak.
+    Extraction terminates at scores <= threshold.
+
+    x can be a memory-mapped volume (e.g. np.load(path, mmap_mode='r')), in
+    which case slab_size sets how many z-sections are read at once.
+
+    Returns the peak scores and their (x,y,z) coordinates.
+    """
+    r = scale*d/2
+    mask = _ball_mask(r, 3)
+    index = _greedy_suppression(x, mask, threshold, slab_size=slab_size)
 
+    scores = np.asarray(x.ravel()[index]).astype(np.float32)
+    coords = np.zeros((len(index),3), dtype=np.int32)
+    coords[:,2], coords[:,1], coords[:,0] = np.unravel_index(index, x.shape)
 
+    return scores, coords
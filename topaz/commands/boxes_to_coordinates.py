@@ -34,8 +34,7 @@ def main(args):
             impath = os.path.join(args.imagedir, image_name) + '.' + args.image_ext
             # use glob incase image_ext is '*'
             impath = glob.glob(impath)[0]
-            im = load_image(impath)
-            shape = (im.height,im.width)
+            shape = load_image(impath).shape
 
         box = pd.read_csv(path, sep='\t', header=None).values
 
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import sys
+import argparse
+
+from topaz.model.compiled import artifact_path, save_compiled
+
+name = 'compile-model'
+help = 'compile a trained classifier for faster CPU scoring in segment and extract'
+
+def add_arguments(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser('Script for compiling a trained classifier into a cached TorchScript artifact.')
+
+    parser.add_argument('-m', '--model', default='resnet16', help='path to trained classifier. uses the pretrained resnet16 model by default.')
+    parser.add_argument('--cache-dir', help='directory of compiled models (default: $TOPAZ_CACHE_DIR/compiled or ~/.cache/topaz/compiled)')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'bfloat16'], help='precision of the compiled model (default: float32)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch the artifact is compiled for. segment and extract use it when run with the same number of threads. 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+
+    return parser
+
+
+def main(args):
+    from topaz.torch import set_num_threads
+    set_num_threads(args.num_threads)
+
+    from topaz.model.factory import load_model
+    model = load_model(args.model)
+
+    path = artifact_path(args.model, cache_dir=args.cache_dir, dtype=args.dtype)
+    save_compiled(model, path, dtype=args.dtype)
+    print('# saved compiled model:', path, file=sys.stderr)
+    print(path)
+
+
+if __name__ == '__main__':
+    parser = add_arguments()
+    args = parser.parse_args()
+    main(args)
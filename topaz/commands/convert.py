@@ -10,7 +10,7 @@ import argparse
 import topaz.utils.star as star
 import topaz.utils.files as file_utils
 from topaz.utils.conversions import mirror_y_axis
-from topaz.utils.data.loader import load_image
+from topaz.utils.catalog import scan
 
 
 name = 'convert'
@@ -47,6 +47,7 @@ def add_arguments(parser=None):
     parser.add_argument('--invert-y', action='store_true', help='invert (mirror) the y-axis particle coordinates. requires also specifying --imagedir.')
     parser.add_argument('--imagedir', help='directory of images. only required to invert the y-axis - sometimes necessary for particles picked on .tiff images')
     parser.add_argument('--image-ext', default='.mrc', help='image file extension. required for converting to STAR and BOX formats and to find images when --invert-y is set. (default=.mrc)')
+    parser.add_argument('--catalog', help='path to a persistent catalog of image header metadata, used to find image heights for --invert-y without scanning unchanged images again (default: none)')
     parser.add_argument('--boxsize', default=0, type=int, help='size of particle boxes. required for converting to BOX format.')
 
     # verbose output?
@@ -201,14 +202,18 @@ def main(args):
             if args.imagedir is None:
                 print('Error: --imagedir must specify the directory of images in order to mirror the y-axis coordinates', file=sys.stderr)
                 sys.exit(1)
-            dfs = []
-            for image_name,group in coords.groupby('image_name'):
+            groups = list(coords.groupby('image_name'))
+            impaths = []
+            for image_name,_ in groups:
                 impath = os.path.join(args.imagedir, image_name) + '.' + args.image_ext
                 # use glob incase image_ext is '*'
                 impath = glob.glob(impath)[0]
-                im = load_image(impath)
-                height = im.height
+                impaths.append(impath)
+            # only the image heights are needed, which are read from the image headers
+            heights = scan(impaths, catalog=args.catalog).height.values
 
+            dfs = []
+            for (image_name,group),height in zip(groups, heights):
                 group = mirror_y_axis(group, height)
                 dfs.append(group)
             coords = pd.concat(dfs, axis=0)
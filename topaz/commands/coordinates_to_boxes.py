@@ -49,8 +49,7 @@ def main(args):
             impath = os.path.join(args.imagedir, image_name) + '.' + args.image_ext
             # use glob incase image_ext is '*'
             impath = glob.glob(impath)[0]
-            im = load_image(impath)
-            shape = (im.height,im.width)
+            shape = load_image(impath).shape
         
         xy = group[['x_coord', 'y_coord']].values.astype(np.int32)
 
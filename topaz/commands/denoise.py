@@ -34,6 +34,7 @@ def add_arguments(parser=None):
     parser.add_argument('-o', '--output', help='directory to save denoised micrographs')
     parser.add_argument('--suffix', default='', help='add this suffix to each output file name. if no output directory is specified, denoised micrographs are written to the same location as the input with a default suffix of ".denoised" (default: none)')
     parser.add_argument('--format', dest='format_', default='mrc', help='output format for the images (default: mrc)')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'], help='data type of mrc output. float16 (mode 12) halves the size of the files (default: float32)')
     parser.add_argument('--normalize', action='store_true', help='normalize the micrographs')
 
     parser.add_argument('--stack', action='store_true', help='denoise a MRC stack rather than list of micorgraphs')
@@ -502,33 +503,30 @@ def main(args):
 
     # we are denoising a single MRC stack
     if args.stack:
-        with open(args.micrographs[0], 'rb') as f:
-            content = f.read()
-        stack,_,_ = mrc.parse(content)
+        ## sections are read from the file as they are denoised and written
+        ## to the output as they are done
+        stack,_,_ = mrc.open_mmap(args.micrographs[0])
         print('# denoising stack with shape:', stack.shape, file=sys.stderr)
         total = len(stack)
 
-        denoised = np.zeros_like(stack)
-        for i in range(len(stack)):
-            mic = stack[i]
-            # process and denoise the micrograph
-            mic = denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
-                               , inv_gaus=inv_gaus, deconvolve=deconvolve
-                               , deconv_patch=deconv_patch
-                               , patch_size=ps, padding=padding, normalize=normalize
-                               , use_cuda=use_cuda
-                               )
-            denoised[i] = mic
-
-            count += 1
-            print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
-
-        print('', file=sys.stderr)
-        # write the denoised stack
         path = args.output
         print('# writing', path, file=sys.stderr)
-        with open(path, 'wb') as f:
-            mrc.write(f, denoised)
+        with mrc.MRCWriter(path, dtype=args.dtype) as writer:
+            for i in range(len(stack)):
+                mic = stack[i]
+                # process and denoise the micrograph
+                mic = denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
+                                   , inv_gaus=inv_gaus, deconvolve=deconvolve
+                                   , deconv_patch=deconv_patch
+                                   , patch_size=ps, padding=padding, normalize=normalize
+                                   , use_cuda=use_cuda
+                                   )
+                writer.write(mic)
+
+                count += 1
+                print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
+
+        print('', file=sys.stderr)
     
     else:
         # stream the micrographs and denoise them
@@ -543,7 +541,7 @@ def main(args):
 
         for path in args.micrographs:
             name,_ = os.path.splitext(os.path.basename(path))
-            mic = np.array(load_image(path), copy=False).astype(np.float32)
+            mic = load_image(path).astype(np.float32, copy=False)
 
             # process and denoise the micrograph
             mic = denoise_image(mic, models, lowpass=lowpass, cutoff=cutoff, gaus=gaus
@@ -562,7 +560,7 @@ def main(args):
                 outpath = no_ext + suffix + '.' + format_
             else:
                 outpath = args.output + os.sep + name + suffix + '.' + format_
-            save_image(mic, outpath) #, mi=None, ma=None)
+            save_image(mic, outpath, dtype=args.dtype) #, mi=None, ma=None)
 
             count += 1
             print('# {} of {} completed.'.format(count, total), file=sys.stderr, end='\r')
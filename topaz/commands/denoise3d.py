@@ -34,6 +34,7 @@ def add_arguments(parser=None):
     parser.add_argument('volumes', nargs='*', help='volumes to denoise')
     parser.add_argument('-o', '--output', help='directory to save denoised volumes')
     parser.add_argument('--suffix', help='optional suffix to append to file paths. if not output is specfied, denoised volumes are written to the same location as the input with the suffix appended to the name (default .denoised)')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'], help='data type of the denoised volumes, which are written slab by slab for any input mode. float16 (mode 12) halves the size of the files (default: float32)')
 
     parser.add_argument('-m', '--model', default='unet-3d', help='use pretrained denoising model. accepts path to a previously saved model or one of the provided pretrained models. pretrained model options are: unet-3d, unet-3d-10a, unet-3d-20a (default: unet-3d)')
 
@@ -65,7 +66,7 @@ def add_arguments(parser=None):
 
     ## denoising parameters
     parser.add_argument('-g', '--gaussian', type=float, default=0, help='standard deviation of Gaussian filter postprocessing, 0 means no postprocessing (default: 0)')
-    parser.add_argument('-s', '--patch-size', type=int, default=96, help='denoises volumes in patches of this size. not used if <1 (default: 96)')
+    parser.add_argument('-s', '--patch-size', type=int, default=96, help='denoises volumes in patches of this size, reading only the patches being denoised into memory whatever the mode of the volume. if <1, the whole volume is denoised at once (default: 96)')
     parser.add_argument('-p', '--patch-padding', type=int, default=48, help='padding around each patch to remove edge artifacts (default: 48)')
 
     ## other parameters
@@ -201,9 +202,7 @@ class TrainingDataset3D(torch.utils.data.Dataset):
             sys.exit(2)
 
     def load_mrc(self, path):
-        with open(path, 'rb') as f:
-            content = f.read()
-        tomo,_,_ = mrc.parse(content)
+        tomo,_,_ = mrc.open_mmap(path)
         tomo = tomo.astype(np.float32)
         return tomo
     
@@ -636,36 +635,64 @@ class PatchDataset:
         skc = padding - k + sk
         ekc = skc + (ek - sk)
 
-        x[sic:eic,sjc:ejc,skc:ekc] = tomo[si:ei,sj:ej,sk:ek]
+        ## only this patch of the tomogram is read and converted to float32
+        x[sic:eic,sjc:ejc,skc:ekc] = tomo[si:ei,sj:ej,sk:ek].astype(np.float32)
         return np.array((i,j,k), dtype=int),x
 
 
 def denoise(model, path, outdir, suffix, patch_size=128, padding=128, batch_size=1
-           , volume_num=1, total_volumes=1):
-    with open(path, 'rb') as f:
-        content = f.read()
-    tomo,header,extended_header = mrc.parse(content)
-    tomo = tomo.astype(np.float32)
+           , volume_num=1, total_volumes=1, dtype='float32'):
+    ## the tomogram stays memory mapped in its own mode, slabs and patches
+    ## are read and converted to float as they are used
+    tomo,header,extended_header = mrc.open_mmap(path)
     name = os.path.basename(path)
 
-    mu = tomo.mean()
-    std = tomo.std()
+    ## accumulate the statistics slab by slab so that only one slab is
+    ## converted to float64 at a time
+    stats = mrc.RunningStats()
+    slab = max(1, 2**22//max(1, tomo[0].size))
+    for i in range(0, len(tomo), slab):
+        stats.update(tomo[i:i+slab])
+    mu = stats.mean
+    std = float(stats.std)
+
+    ## the denoised tomogram is written next to the input unless outdir is given
+    if outdir is None:
+        # write denoised tomogram to same location as input, but add the suffix
+        if suffix is None: # use default
+            suffix = '.denoised'
+        no_ext,ext = os.path.splitext(path)
+        outpath = no_ext + suffix + ext
+    else:
+        if suffix is None:
+            suffix = ''
+        no_ext,ext = os.path.splitext(name)
+        outpath = outdir + os.sep + no_ext + suffix + ext
+
+    # use the read header except for a few fields, the mode and statistics
+    # are filled in by the writer
+
     # denoise in patches
     d = next(iter(model.parameters())).device
-    denoised = np.zeros_like(tomo)
 
-    with torch.no_grad():
+    with torch.no_grad(), mrc.MRCWriter(outpath, header=header, extended_header=extended_header
+                                       , dtype=dtype) as writer:
         if patch_size < 1:
-            x = (tomo - mu)/std
+            x = (tomo.astype(np.float32) - mu)/std
             x = torch.from_numpy(x).to(d)
             x = model(x.unsqueeze(0).unsqueeze(0)).squeeze().cpu().numpy()
             x = std*x + mu
-            denoised[:] = x
+            writer.write(x)
         else:
             patch_data = PatchDataset(tomo, patch_size, padding)
             total = len(patch_data)
             count = 0
 
+            ## patches come in order along z, so each slab of patch_size
+            ## sections is written out as soon as all of its patches are done
+            slab = None
+            slab_start = 0
+
             batch_iterator = torch.utils.data.DataLoader(patch_data, batch_size=batch_size)
             for index,x in batch_iterator:
                 x = x.to(d)
@@ -679,44 +706,30 @@ def denoise(model, path, outdir, suffix, patch_size=128, padding=128, batch_size
                 # restore original statistics
                 x = std*x + mu
 
-                # stitch into denoised volume
+                # stitch into denoised slab
                 for b in range(len(x)):
-                    i,j,k = index[b]
+                    i,j,k = (int(v) for v in index[b])
                     xb = x[b]
 
-                    patch = denoised[i:i+patch_size,j:j+patch_size,k:k+patch_size]
+                    if slab is None or i != slab_start:
+                        if slab is not None:
+                            writer.write(slab)
+                        slab_start = i
+                        slab = np.zeros((min(patch_size, tomo.shape[0]-i),) + tomo.shape[1:], dtype=np.float32)
+
+                    patch = slab[:,j:j+patch_size,k:k+patch_size]
                     pz,py,px = patch.shape
 
                     xb = xb[padding:padding+pz,padding:padding+py,padding:padding+px]
-                    denoised[i:i+patch_size,j:j+patch_size,k:k+patch_size] = xb
+                    slab[:,j:j+patch_size,k:k+patch_size] = xb
 
                     count += 1
                     print('# [{}/{}] {:.2%}'.format(volume_num, total_volumes, count/total), name, file=sys.stderr, end='\r')
 
-            print(' '*100, file=sys.stderr, end='\r')
-
-
-    ## save the denoised tomogram
-    if outdir is None:
-        # write denoised tomogram to same location as input, but add the suffix
-        if suffix is None: # use default
-            suffix = '.denoised'
-        no_ext,ext = os.path.splitext(path)
-        outpath = no_ext + suffix + ext
-    else:
-        if suffix is None:
-            suffix = ''
-        no_ext,ext = os.path.splitext(name)
-        outpath = outdir + os.sep + no_ext + suffix + ext
+            if slab is not None:
+                writer.write(slab)
 
-    # use the read header except for a few fields
-    header = header._replace(mode=2) # 32-bit real
-    header = header._replace(amin=denoised.min())
-    header = header._replace(amax=denoised.max())
-    header = header._replace(amean=denoised.mean())
-
-    with open(outpath, 'wb') as f:
-        mrc.write(f, denoised, header=header, extended_header=extended_header)
+            print(' '*100, file=sys.stderr, end='\r')
 
 
 def main(args):
@@ -776,6 +789,7 @@ def main(args):
                    , batch_size=batch_size
                    , volume_num=count
                    , total_volumes=total
+                   , dtype=args.dtype
                    )
 
 
@@ -24,9 +24,7 @@ def add_arguments(parser=None):
 def main(args):
     ## load image
     path = args.file
-    im = load_image(path)
-    # convert PIL image to array
-    im = np.array(im, copy=False).astype(np.float32)
+    im = load_image(path).astype(np.float32, copy=False)
 
     scale = args.scale # how much to downscale by
     small = downsample(im, scale)
@@ -3,19 +3,30 @@ from __future__ import print_function, division
 
 import os
 import sys
+import glob
+import time
 
 import numpy as np
 import pandas as pd
 import multiprocessing
 import argparse
+import atexit
+import functools
+import shutil
+import tempfile
+from collections import deque
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from topaz.utils.data.loader import load_image
+from topaz.utils.image import downsample
+from topaz.stats import normalize
 import topaz.utils.files as file_utils
-from topaz.algorithms import non_maximum_suppression, match_coordinates
+from topaz.utils.scores import ScoreStore, ScoreMaps, hash_file, hash_model
+from topaz.utils.pipeline import PipelineStats, AsyncWriter, thread_map, pool_map, process_pool, timed
+from topaz.algorithms import non_maximum_suppression, non_maximum_suppression_sweep, match_coordinates
 from topaz.metrics import average_precision
 import topaz.predict
 import topaz.cuda
@@ -34,6 +45,7 @@ def add_arguments(parser=None):
     ## extraction parameter arguments
     parser.add_argument('-r', '--radius', type=int, help='radius of the regions to extract')
     parser.add_argument('-t', '--threshold', default=-6, type=float, help='log-likelihood score threshold at which to terminate region extraction, -6 is p>=0.0025 (default: -6)')
+    parser.add_argument('--max-particles', type=int, help='maximum number of particles to extract per micrograph. extraction stops once this many particles are found, which is much faster than extracting all particles above the threshold (default: no limit)')
 
     
     ## coordinate scaling arguments
@@ -41,8 +53,21 @@ def add_arguments(parser=None):
     parser.add_argument('-x', '--up-scale', type=float, default=1, help='UP-scale coordinates by this factor. output coordinates will be coord_out = (x/s)*coord. (default: 1)')
 
     parser.add_argument('--num-workers', type=int, default=0, help='number of processes to use for extracting in parallel, 0 uses main process, -1 uses all CPUs (default: 0)')
-    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores. with --score-workers, the number of threads of each scoring worker, where 0 divides the cores evenly among the workers (default: 0)')
+    parser.add_argument('--score-workers', type=int, default=0, help='number of processes scoring micrographs in parallel on the CPU, each with its own copy of the model. particles are still written in input order (default: 0, score in the main process)')
     parser.add_argument('--batch-size', type=int, default=1, help='batch size for scoring micrographs with model (default: 1)')
+    parser.add_argument('--tile-size', type=int, help='score micrographs in tiles of this size, batched by --batch-size, to bound memory use on large micrographs. results are identical to whole micrograph scoring (default: whole micrographs)')
+    parser.add_argument('--memory-budget', type=float, help='choose the tile size so that a batch of tiles is expected to fit in this many GB (default: none)')
+    parser.add_argument('--dense-mode', default='fill', choices=['fill', 'stitch'], help='how to score every pixel with the strided model. fill dilates the model, stitch runs the strided model on every shifted copy of the micrograph and interleaves the outputs, which gives the same scores and is often faster on CPU. --tile-size and --memory-budget apply to fill only (default: fill)')
+    parser.add_argument('--no-compiled', action='store_true', help='do not use a compiled model from topaz compile-model, even if one is cached for this model and number of threads')
+    parser.add_argument('--compiled-dtype', default='float32', choices=['float32', 'bfloat16'], help='precision of the cached compiled model to use (default: float32)')
+    parser.add_argument('--coarse-threshold', type=float, help='score micrographs coarse to fine. the strided model first scores a grid of points and the full resolution model then scores only tiles around points scoring above this threshold, which should be looser than --threshold (default: score every pixel)')
+    parser.add_argument('--refine-margin', type=int, help='pixels around each coarse candidate to score at full resolution (default: model stride)')
+    parser.add_argument('--score-cache', help='directory of cached score maps keyed by model and micrograph. micrographs already scored by the model are read from the cache instead of being scored again and new score maps are added to it (default: none)')
+    parser.add_argument('--cache-dtype', default='float32', choices=['float32', 'float16', 'uint8'], help='storage type for new score maps in the cache. uint8 quantizes each score map between its minimum and maximum finite score (default: float32)')
+    parser.add_argument('--num-readers', type=int, default=1, help='number of threads loading micrographs ahead of scoring, 0 loads them in the main process (default: 1)')
+    parser.add_argument('--queue-size', type=int, default=4, help='maximum number of micrographs buffered between the load, score, extract and write stages (default: 4)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='report throughput and queue depth for each stage when done')
 
 
     ## radius selection arguments
@@ -63,34 +88,54 @@ def add_arguments(parser=None):
     parser.add_argument('--format', choices=['coord', 'csv', 'star', 'json', 'box'], default='coord'
                     , help='file format of the OUTPUT files (default: coord)')
 
+    ## watch mode arguments
+    parser.add_argument('--watch', metavar='DIR', help='watch this directory and pick each micrograph as soon as it is completely written, for picking during collection. particles are appended to the output and a journal of processed micrographs is kept so that restarting skips them')
+    parser.add_argument('--watch-pattern', default='*.mrc', help='pattern of micrograph file names to pick in the watched directory (default: *.mrc)')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds between checks of the watched directory (default: 1)')
+    parser.add_argument('--settle-time', type=float, default=2, help='seconds the size and modification time of a micrograph must be unchanged before it is considered complete (default: 2)')
+    parser.add_argument('--watch-timeout', type=float, help='stop watching once no new micrograph has arrived for this many seconds (default: watch until interrupted)')
+    parser.add_argument('--journal', help='file listing the micrographs already processed in watch mode (default: OUTPUT.journal, or topaz_extract.journal in the watched directory)')
+    parser.add_argument('--preprocess', type=int, metavar='SCALE', help='downsample raw micrographs by this factor and normalize them as topaz preprocess does before scoring (default: micrographs are already preprocessed)')
+
 
     return parser
 
 class NonMaximumSuppression:
-    def __init__(self, radius, threshold):
+    def __init__(self, radius, threshold, max_peaks=None):
         self.radius = radius
         self.threshold = threshold
+        self.max_peaks = max_peaks
 
     def __call__(self, args):
         name,score = args
-        score,coords = non_maximum_suppression(score, self.radius, threshold=self.threshold)
+        score,coords = non_maximum_suppression(score, self.radius, threshold=self.threshold
+                                              , max_peaks=self.max_peaks)
         return name, score, coords
 
-def nms_iterator(scores, radius, threshold, pool=None):
-    process = NonMaximumSuppression(radius, threshold)
+def nms_iterator(scores, radius, threshold, pool=None, max_peaks=None, depth=2, stats=None):
+    """ extract particles from each (name, score) pair, yielding results in input order """
+    process = NonMaximumSuppression(radius, threshold, max_peaks=max_peaks)
     if pool is not None:
-        for name,score,coords in pool.imap_unordered(process, scores):
-            yield name,score,coords
-    else:
-        for name,score in scores:
-            score,coords = non_maximum_suppression(score, radius, threshold=threshold)
-            yield name,score,coords
+        return pool_map(process, scores, pool, depth=depth, stats=stats, shared=True)
+    return thread_map(process, scores, num_workers=0, stats=stats)
 
 def iterate_score_target_pairs(scores, targets):
+    ## index the target coordinates by image once instead of scanning the table per image
+    target_index = {name: group[['x_coord', 'y_coord']].values for name,group in targets.groupby('image_name')}
+    empty = np.zeros((0,2), dtype=targets[['x_coord', 'y_coord']].values.dtype)
     for image_name,score in scores.items():
-        target = targets.loc[targets.image_name == image_name][['x_coord', 'y_coord']].values
+        target = target_index.get(image_name, empty)
         yield score,target
 
+def summarize_matches(hits, preds, mse, N):
+    hits = np.concatenate(hits, 0)
+    preds = np.concatenate(preds, 0)
+    auprc = average_precision(hits, preds, N=N)
+
+    rmse = np.sqrt(mse/hits.sum())
+
+    return auprc, rmse, int(hits.sum()), N
+
 class ExtractMatches:
     def __init__(self, radius, threshold, match_radius):
         self.radius = radius
@@ -111,96 +156,290 @@ class ExtractMatches:
         
         return assignment, score, mse, len(target)
 
-def extract_auprc(targets, scores, radius, threshold, match_radius=None, pool=None):
+def extract_auprc(targets, scores, radius, threshold, match_radius=None, pool=None, depth=2):
     N = 0
     mse = 0
     hits = []
     preds = []
 
+    process = ExtractMatches(radius, threshold, match_radius)
+    iterator = iterate_score_target_pairs(scores, targets)
     if pool is not None:
-        process = ExtractMatches(radius, threshold, match_radius)
-        iterator = iterate_score_target_pairs(scores, targets)
-        for assignment,score,this_mse,n in pool.imap_unordered(process, iterator):
-            mse += this_mse
-            hits.append(assignment)
-            preds.append(score)
-            N += n
+        ## score maps go to the workers through shared memory or their files
+        results = pool_map(process, iterator, pool, depth=depth, shared=True)
     else:
-        for score,target in iterate_score_target_pairs(scores, targets):
-            score,coords = non_maximum_suppression(score, radius, threshold=threshold)
-            if match_radius is None:
-                assignment, dist = match_coordinates(target, coords, radius)
-            else:
-                assignment, dist = match_coordinates(target, coords, match_radius)
-            mse += np.sum(dist[assignment==1]**2)
-            hits.append(assignment)
-            preds.append(score)
-            N += len(target)
-
-    hits = np.concatenate(hits, 0)
-    preds = np.concatenate(preds, 0)
-    auprc = average_precision(hits, preds, N=N)
-
-    rmse = np.sqrt(mse/hits.sum())
-
-    return auprc, rmse, int(hits.sum()), N
-
-class Process:
-    def __init__(self, targets, target_scores, threshold, match_radius):
-        self.targets = targets
-        self.target_scores = target_scores
+        results = map(process, iterator)
+    for assignment,score,this_mse,n in results:
+        mse += this_mse
+        hits.append(assignment)
+        preds.append(score)
+        N += n
+
+    return summarize_matches(hits, preds, mse, N)
+
+class ExtractSweepMatches:
+    def __init__(self, radii, threshold, match_radius):
+        self.radii = radii
         self.threshold = threshold
         self.match_radius = match_radius
 
-    def __call__(self, r):
-        auprc, rmse, recall, n = extract_auprc(self.targets, self.target_scores, r, self.threshold
-                                              , match_radius=self.match_radius)
-        return r, auprc, rmse, recall, n
+    def __call__(self, args):
+        score,target = args
 
-def find_opt_radius(targets, target_scores, threshold, lo=0, hi=200, step=10
-                   , match_radius=None, pool=None):
+        ## one sort and one pass over the score map gives the peaks for every radius
+        matches = []
+        peaks = non_maximum_suppression_sweep(score, self.radii, threshold=self.threshold)
+        for radius,(score,coords) in zip(self.radii, peaks):
+            match_radius = radius if self.match_radius is None else self.match_radius
+            assignment, dist = match_coordinates(target, coords, match_radius)
+            mse = np.sum(dist[assignment==1]**2)
+            matches.append((assignment, score, mse))
 
-    auprc = np.zeros(hi+1) - 1
-    process = Process(targets, target_scores, threshold, match_radius)
+        return matches, len(target)
 
+def find_opt_radius(targets, target_scores, threshold, lo=0, hi=200, step=10
+                   , match_radius=None, pool=None, depth=2):
+
+    radii = list(range(lo, hi+1, step))
+    process = ExtractSweepMatches(radii, threshold, match_radius)
+    iterator = iterate_score_target_pairs(target_scores, targets)
     if pool is not None:
-        for r,au,rmse,recall,n in pool.imap_unordered(process, range(lo, hi+1, step)):
-            auprc[r] = au
-            print('# radius={}, auprc={}, rmse={}, recall={}, targets={}'.format(r, au, rmse, recall, n))
+        ## score maps go to the workers through shared memory or their files
+        results = pool_map(process, iterator, pool, depth=depth, shared=True)
     else:
-        for r in range(lo, hi+1, step):
-            _,au,rmse,recall,n = process(r)
-            auprc[r] = au
-            print('# radius={}, auprc={}, rmse={}, recall={}, targets={}'.format(r, au, rmse, recall, n))
+        results = map(process, iterator)
 
-    r = np.argmax(auprc)
-    return r, auprc[r]
+    ## accumulate the matches for all radii in a single sweep over the images
+    N = 0
+    mse = np.zeros(len(radii))
+    hits = [[] for _ in radii]
+    preds = [[] for _ in radii]
+    for matches,n in results:
+        for i,(assignment,score,this_mse) in enumerate(matches):
+            mse[i] += this_mse
+            hits[i].append(assignment)
+            preds[i].append(score)
+        N += n
 
+    auprc = np.zeros(hi+1) - 1
+    for i,r in enumerate(radii):
+        au,rmse,recall,n = summarize_matches(hits[i], preds[i], mse[i], N)
+        auprc[r] = au
+        print('# radius={}, auprc={}, rmse={}, recall={}, targets={}'.format(r, au, rmse, recall, n))
 
-def stream_images(paths):
-    for path in paths:
-        image = load_image(path)
-        image = np.array(image, copy=False)
-        yield image
+    r = np.argmax(auprc)
+    return r, auprc[r]
 
 
-def score_images(model, paths, device=-1, batch_size=1):
+class Preprocess:
+    """ downsample and normalize a micrograph like topaz preprocess with default settings """
+    def __init__(self, scale, affine=False):
+        self.scale = scale
+        self.affine = affine
+
+    def __call__(self, x):
+        x = x.astype(np.float32)
+        if self.scale > 1:
+            x = downsample(x, self.scale)
+        method = 'affine' if self.affine else 'gmm'
+        x,_ = normalize(x, method=method, sample=10)
+        return x
+
+
+def load_micrograph(path, preprocess=None):
+    image = load_image(path)
+    if preprocess is not None:
+        image = preprocess(image)
+    return path, image
+
+
+def stream_images(paths, num_workers=0, depth=2, stats=None, preprocess=None):
+    """ load images in order, prefetching with num_workers threads """
+    load = functools.partial(load_micrograph, preprocess=preprocess)
+    return thread_map(load, paths, num_workers=num_workers, depth=depth, stats=stats)
+
+
+def lookup_micrograph(path, store=None, model_hash='', preprocess=None):
+    """ find the score map of a micrograph in the store, loading the micrograph only if it is missing """
+    image_hash = hash_file(path)
+    key = store.lookup(model_hash, image_hash)
+    image = None
+    if key is None:
+        _,image = load_micrograph(path, preprocess=preprocess)
+    return path, image_hash, key, image
+
+
+def watch_micrographs(directory, pattern='*.mrc', processed=(), poll=1.0, settle=2.0, timeout=None):
+    """
+    Yield the paths of micrographs matching pattern in directory as they are
+    completed, skipping those in processed. A micrograph is complete once
+    its size and modification time have not changed for settle seconds.
+    The directory is polled every poll seconds. Stops once no new
+    micrograph has been completed for timeout seconds, or never if timeout
+    is None.
+    """
+    done = set(processed)
+    changing = {} # path -> (size, mtime), time first seen with them
+    last = time.time()
+    while True:
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            if path in done:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError: # removed or renamed while listing
+                continue
+            stat = (st.st_size, st.st_mtime)
+            if path not in changing or changing[path][0] != stat:
+                changing[path] = (stat, now)
+            elif now - changing[path][1] >= settle:
+                del changing[path]
+                done.add(path)
+                last = now
+                yield path
+        if timeout is not None and len(changing) == 0 and time.time() - last > timeout:
+            return
+        time.sleep(poll)
+
+
+def score_images(model, paths, device=-1, batch_size=1, num_workers=0, depth=2
+                , load_stats=None, score_stats=None, tile_size=None, memory_budget=None
+                , store=None, coarse_threshold=None, refine_margin=None, dense_mode='fill'
+                , compiled=True, compiled_dtype='float32', preprocess=None
+                , score_workers=0, threads_per_worker=0):
+    """
+    Yield (path, score) for each micrograph in order. If a ScoreStore is
+    given and a model is used, yield (path, key) instead, where key locates
+    the score map in the store. Only micrographs without a stored score map
+    for this model are scored, and their score maps are added to the store.
+
+    With a coarse_threshold, micrographs are scored coarse to fine with
+    topaz.predict.score_coarse_to_fine. Otherwise, dense_mode='stitch'
+    scores them with topaz.predict.score_shift_stitch instead of the
+    filled model. For dense scoring with the filled model, a compiled
+    artifact from `topaz compile-model` is used if one is cached.
+
+    If given, preprocess is applied to each micrograph before scoring.
+
+    With score_workers > 0, micrographs are scored on the CPU by that many
+    worker processes, each with its own copy of the model and
+    threads_per_worker pytorch threads (default: the cores divided evenly
+    among the workers).
+    """
     if model is not None and model != 'none': # score each image with the model
         ## set the device
         use_cuda = topaz.cuda.set_device(device)
-        ## load the model
-        from topaz.model.factory import load_model
-        model = load_model(model)
-        model.eval()
-        model.fill()
-        if use_cuda:
-            model.cuda()
-        scores = topaz.predict.score_stream(model, stream_images(paths), use_cuda=use_cuda
-                                           , batch_size=batch_size)
+        scorer = topaz.predict.Scorer(model, use_cuda=use_cuda, batch_size=batch_size
+                                     , tile_size=tile_size, memory_budget=memory_budget
+                                     , dense_mode=dense_mode, coarse_threshold=coarse_threshold
+                                     , refine_margin=refine_margin, compiled=compiled
+                                     , compiled_dtype=compiled_dtype)
+        pool = None
+        if score_workers > 0:
+            if use_cuda:
+                raise Exception('Scoring workers are only supported for scoring on the CPU (--device -1)')
+            ## fork the workers before loading the model in this process
+            pool = topaz.predict.scoring_pool(score_workers, num_threads=threads_per_worker)
+
+        if store is None:
+            images = stream_images(paths, num_workers=num_workers, depth=depth, stats=load_stats
+                                  , preprocess=preprocess)
+        else:
+            model_hash = hash_model(scorer.model())
+            if coarse_threshold is not None: # coarse to fine score maps differ from dense ones
+                model_hash += ':coarse:{}:{}'.format(coarse_threshold, refine_margin)
+            if preprocess is not None:
+                model_hash += ':preprocess:{}:{}'.format(preprocess.scale, preprocess.affine)
+            lookup = functools.partial(lookup_micrograph, store=store, model_hash=model_hash
+                                      , preprocess=preprocess)
+            images = thread_map(lookup, paths, num_workers=num_workers, depth=depth, stats=load_stats)
+
+        ## carry the paths alongside the images through the batched scoring,
+        ## passing over micrographs that are already in the store
+        entries = deque()
+        def unzip(images):
+            for entry in images:
+                entries.append(entry)
+                if store is None:
+                    yield entry[1]
+                elif entry[2] is None:
+                    yield entry[3]
+        if pool is not None:
+            ## keep every worker busy while results are taken in order
+            mapped = pool_map(scorer, ((None, image) for image in unzip(images)), pool
+                             , depth=depth + score_workers, stats=score_stats, shared=True)
+            scores = (score for _,score in mapped)
+        elif scorer.filled: # batch micrographs of the same shape together
+            scores = topaz.predict.score_stream(scorer.model(), unzip(images), use_cuda=use_cuda
+                                               , batch_size=batch_size, tile_size=tile_size
+                                               , memory_budget=memory_budget)
+            scores = timed(scores, stats=score_stats)
+        else:
+            scores = (scorer((None, image))[1] for image in unzip(images))
+            scores = timed(scores, stats=score_stats)
+
+        scored = deque()
+        exhausted = False
+        try:
+            while True:
+                if len(entries) > 0 and (len(scored) > 0 or (store is not None and entries[0][2] is not None)):
+                    entry = entries.popleft()
+                    if store is None:
+                        yield entry[0], scored.popleft()
+                        continue
+                    path,image_hash,key,_ = entry
+                    if key is None:
+                        name = os.path.splitext(os.path.basename(path))[0]
+                        key = store.add(name, scored.popleft(), model_hash=model_hash, image_hash=image_hash)
+                    yield path, key
+                elif exhausted:
+                    break
+                else:
+                    try:
+                        scored.append(next(scores))
+                    except StopIteration:
+                        exhausted = True
+        finally:
+            if pool is not None:
+                mapped.close() # frees the results in flight before the workers are stopped
+                pool.terminate()
     else: # load scores directly
-        scores = stream_images(paths)
-    for path,score in zip(paths, scores):
-        yield path, score
+        images = stream_images(paths, num_workers=num_workers, depth=depth, stats=load_stats)
+        for path,score in timed(images, stats=score_stats):
+            yield path, score
+
+
+class ParticleWriter:
+    def __init__(self, f, scale=1, per_micrograph=False, suffix='', out_format='coord', journal=None):
+        self.f = f
+        self.journal = journal
+        self.scale = scale
+        self.per_micrograph = per_micrograph
+        self.suffix = suffix
+        self.out_format = out_format
+
+    def __call__(self, args):
+        path,score,coords = args
+        basename = os.path.basename(path)
+        name = os.path.splitext(basename)[0]
+        ## scale the coordinates
+        if self.scale != 1:
+            coords = np.round(coords*self.scale).astype(int)
+
+        if self.per_micrograph:
+            table = pd.DataFrame({'image_name': name, 'x_coord': coords[:,0], 'y_coord': coords[:,1], 'score': score})
+            out_path,ext = os.path.splitext(path)
+            out_path = out_path + self.suffix + '.' + self.out_format
+            with open(out_path, 'w') as f:
+                file_utils.write_table(f, table, format=self.out_format, image_ext=ext)
+        else:
+            for i in range(len(score)):
+                print(name + '\t' + str(coords[i,0]) + '\t' + str(coords[i,1]) + '\t' + str(score[i]), file=self.f)
+            self.f.flush()
+        if self.journal is not None: # record the micrograph as done once its particles are written
+            print(path, file=self.journal)
+            self.journal.flush()
 
 
 def stream_inputs(f):
@@ -222,10 +461,63 @@ def main(args):
     paths = args.paths
     batch_size = args.batch_size
 
-    if len(paths) == 0: # no paths specified, so we read them from stdin
+    journal = None
+    if args.watch is not None:
+        if len(paths) > 0 or args.targets is not None:
+            raise Exception('Micrograph paths and --targets cannot be given with --watch')
+        journal_path = args.journal
+        if journal_path is None:
+            if args.output is not None and not args.per_micrograph:
+                journal_path = args.output + '.journal'
+            else:
+                journal_path = os.path.join(args.watch, 'topaz_extract.journal')
+        processed = set()
+        if os.path.exists(journal_path):
+            with open(journal_path) as f:
+                processed = set(line.rstrip('\n') for line in f)
+        journal = open(journal_path, 'a')
+        paths = watch_micrographs(args.watch, pattern=args.watch_pattern, processed=processed
+                                 , poll=args.poll_interval, settle=args.settle_time
+                                 , timeout=args.watch_timeout)
+        ## micrographs arrive one at a time, so process each one as soon as
+        ## it arrives rather than waiting to fill batches and queues
+        batch_size = 1
+        args.num_readers = 0
+        args.queue_size = 1
+    elif len(paths) == 0: # no paths specified, so we read them from stdin
         paths = stream_inputs(sys.stdin)
 
-    stream = score_images(model, paths, device=device, batch_size=batch_size)
+    stats = None
+    load_stats = score_stats = nms_stats = write_stats = None
+    if args.verbose:
+        stats = PipelineStats()
+        load_stats = stats.stage('load')
+        score_stats = stats.stage('score')
+        nms_stats = stats.stage('extract')
+        write_stats = stats.stage('write')
+
+    memory_budget = args.memory_budget
+    if memory_budget is not None:
+        memory_budget = memory_budget*2**30
+
+    store = None
+    if args.score_cache is not None and model is not None and model != 'none':
+        store = ScoreStore(args.score_cache, dtype=args.cache_dtype)
+
+    preprocess = None
+    if args.preprocess is not None:
+        preprocess = Preprocess(args.preprocess)
+
+    depth = args.queue_size
+    stream = score_images(model, paths, device=device, batch_size=batch_size
+                         , num_workers=args.num_readers, depth=depth
+                         , load_stats=load_stats, score_stats=score_stats
+                         , tile_size=args.tile_size, memory_budget=memory_budget
+                         , store=store, coarse_threshold=args.coarse_threshold
+                         , refine_margin=args.refine_margin, dense_mode=args.dense_mode
+                         , compiled=not args.no_compiled, compiled_dtype=args.compiled_dtype
+                         , preprocess=preprocess, score_workers=args.score_workers
+                         , threads_per_worker=args.num_threads)
 
     # extract coordinates from scored images
     threshold = args.threshold
@@ -239,7 +531,10 @@ def main(args):
     if num_workers < 0:
         num_workers = multiprocessing.cpu_count()
     if num_workers > 0:
-        pool = multiprocessing.Pool(num_workers)
+        pool = process_pool(num_workers)
+        if args.watch is None:
+            ## keep enough micrographs in flight to occupy every worker
+            depth = max(depth, num_workers)
 
     # if no radius is set, we choose the radius based on targets provided
     lo = args.min_radius
@@ -247,26 +542,35 @@ def main(args):
     step = args.step_radius
     match_radius = args.assignment_radius
 
-    if radius < 0 and args.targets is not None: # set the radius to optimize AUPRC of the targets
-        scores = {k:v for k,v in stream} # process all images for this part
+    if args.targets is not None:
+        ## every score map is needed twice, once for matching the targets and
+        ## once for extracting particles, so keep them in the store rather
+        ## than in memory, spilling to a temporary store without a cache
+        if store is None:
+            spill_dir = tempfile.mkdtemp(prefix='topaz-scores-')
+            atexit.register(shutil.rmtree, spill_dir, True)
+            store = ScoreStore(spill_dir, dtype=args.cache_dtype)
+            stream = ((path, store.add(path, score)) for path,score in stream)
+        index = dict(stream)
+        scores = ScoreMaps(store, index)
         stream = scores.items()
 
         targets = pd.read_csv(args.targets, sep='\t')
-        target_scores = {name: scores[name] for name in targets.image_name.unique() if name in scores}
+        names = {os.path.splitext(os.path.basename(path))[0]: path for path in index}
+        target_scores = ScoreMaps(store, {name: index[names[name]] for name in targets.image_name.unique() if name in names})
+    elif store is not None:
+        stream = ((path, store.load(key)) for path,key in stream)
+
+    if radius < 0 and args.targets is not None: # set the radius to optimize AUPRC of the targets
         ## find radius maximizing AUPRC
         radius, auprc = find_opt_radius(targets, target_scores, threshold, lo=lo, hi=hi, step=step
-                                       , match_radius=match_radius, pool=pool)
+                                       , match_radius=match_radius, pool=pool, depth=depth)
 
 
     elif args.targets is not None:
-        scores = {k:v for k,v in stream} # process all images for this part
-        stream = scores.items()
-
-        targets = pd.read_csv(args.targets, sep='\t')
-        target_scores = {name: scores[name] for name in targets.image_name.unique() if name in scores}
         # calculate AUPRC for radius
         au, rmse, recall, n = extract_auprc(targets, target_scores, radius, threshold
-                                           , match_radius=match_radius, pool=pool)
+                                           , match_radius=match_radius, pool=pool, depth=depth)
         print('# radius={}, auprc={}, rmse={}, recall={}, targets={}'.format(radius, au, rmse, recall, n))
     elif radius < 0:
         # must have targets if radius < 0
@@ -280,30 +584,43 @@ def main(args):
         out_format = args.format
 
         f = sys.stdout
+        header = not per_micrograph
         if args.output is not None and not per_micrograph:
-            f = open(args.output, 'w')
+            if journal is not None: # append to the particles picked before a restart
+                f = open(args.output, 'a')
+                header = f.tell() == 0
+            else:
+                f = open(args.output, 'w')
 
         scale = args.up_scale/args.down_scale
 
-        if not per_micrograph:
+        if header:
             print('image_name\tx_coord\ty_coord\tscore', file=f)
-        ## extract coordinates using radius 
-        for path,score,coords in nms_iterator(stream, radius, threshold, pool=pool):
-            basename = os.path.basename(path)
-            name = os.path.splitext(basename)[0]
-            ## scale the coordinates
-            if scale != 1:
-                coords = np.round(coords*scale).astype(int)
-
-            if per_micrograph:
-                table = pd.DataFrame({'image_name': name, 'x_coord': coords[:,0], 'y_coord': coords[:,1], 'score': score})
-                out_path,ext = os.path.splitext(path)
-                out_path = out_path + suffix + '.' + out_format
-                with open(out_path, 'w') as f:
-                    file_utils.write_table(f, table, format=out_format, image_ext=ext)
-            else:
-                for i in range(len(score)):
-                    print(name + '\t' + str(coords[i,0]) + '\t' + str(coords[i,1]) + '\t' + str(score[i]), file=f)
+            f.flush()
+
+        ## extract coordinates using radius, writing each micrograph in order
+        ## in the background while the next ones are scored and extracted
+        write = ParticleWriter(f, scale=scale, per_micrograph=per_micrograph, suffix=suffix
+                              , out_format=out_format, journal=journal)
+        try:
+            with AsyncWriter(write, depth=depth, stats=write_stats) as writer:
+                for particles in nms_iterator(stream, radius, threshold, pool=pool
+                                             , max_peaks=args.max_particles, depth=depth
+                                             , stats=nms_stats):
+                    writer.put(particles)
+        except KeyboardInterrupt:
+            if journal is None:
+                raise
+            ## stopping the watch is expected, everything picked is already
+            ## written and journaled
+
+        if f is not sys.stdout:
+            f.close()
+        if journal is not None:
+            journal.close()
+
+    if stats is not None:
+        stats.report()
 
 
 
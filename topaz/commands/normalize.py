@@ -41,6 +41,7 @@ def add_arguments(parser=None):
     parser.add_argument('-o', '--destdir', help='output directory')
 
     parser.add_argument('--format', dest='format_', default='mrc', help='image format(s) to write. choices are mrc, tiff, and png. images can be written in multiple formats by specifying each in a comma separated list, e.g. mrc,png would write mrc and png format images (default: mrc)')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'], help='data type of mrc output. float16 (mode 12) halves the size of the files (default: float32)')
     
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
 
@@ -48,7 +49,7 @@ def add_arguments(parser=None):
 
 class Normalize:
     def __init__(self, dest, scale, affine, num_iters, alpha, beta
-                , sample, metadata, formats, use_cuda):
+                , sample, metadata, formats, use_cuda, dtype='float32'):
         self.dest = dest
         self.scale = scale
         self.affine = affine
@@ -59,10 +60,11 @@ class Normalize:
         self.metadata = metadata
         self.formats = formats
         self.use_cuda = use_cuda
+        self.dtype = dtype
 
     def __call__(self, path):
         # load the image
-        x = np.array(load_image(path), copy=False).astype(np.float32)
+        x = load_image(path).astype(np.float32, copy=False)
 
         if self.scale > 1:
             x = downsample(x, self.scale)
@@ -78,7 +80,7 @@ class Normalize:
         name,_ = os.path.splitext(os.path.basename(path))
         base = os.path.join(self.dest, name)
         for f in self.formats:
-            save_image(x, base, f=f)
+            save_image(x, base, f=f, dtype=self.dtype)
 
         if self.metadata:
             # save the metadata in json format
@@ -126,7 +128,7 @@ def main(args):
         os.makedirs(dest)
 
     process = Normalize(dest, scale, affine, num_iters, alpha, beta
-                       , sample, metadata, formats, use_cuda)
+                       , sample, metadata, formats, use_cuda, dtype=args.dtype)
 
     if num_workers > 1:
         pool = mp.Pool(num_workers)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+import topaz.utils.files as file_utils
+from topaz.utils.printing import report
+from topaz.utils.data.loader import load_image
+from topaz.utils.data.coordinates import coordinates_table_to_dict
+from topaz.utils.data.packed import PackWriter
+from topaz.utils.picks import as_mask
+from topaz.utils.pipeline import thread_map, StageStats
+from topaz.commands.train import read_image_list, assign_folds
+
+name = 'pack'
+help = 'pack training micrographs, labels and splits into a single file for topaz train --packed'
+
+def add_arguments(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(help)
+
+    parser.add_argument('-o', '--output', required=True, help='path of the packed dataset file')
+    parser.add_argument('--num-readers', type=int, default=8, help='number of threads reading and decoding micrographs (default: 8)')
+
+    data = parser.add_argument_group('training data arguments (required)')
+    data.add_argument('--train-images', required=True, help='path to file listing the training images. also accepts directory path from which all images are loaded.')
+    data.add_argument('--train-targets', required=True, help='path to file listing the training particle coordinates')
+
+    data = parser.add_argument_group('test data arguments (optional)')
+    data.add_argument('--test-images', help='path to file listing the test images. also accepts directory path from which all images are loaded.')
+    data.add_argument('--test-targets', help='path to file listing the testing particle coordinates.')
+
+    data = parser.add_argument_group('data format arguments (optional)')
+    data.add_argument('--format', dest='format_', choices=['auto', 'coord', 'csv', 'star', 'box'], default='auto'
+                     , help='file format of the particle coordinates file (default: detect format automatically based on file extension)')
+    data.add_argument('--image-ext', default='', help='sets the image extension if loading images from directory. should include "." before the extension (e.g. .tiff). (default: find all extensions)')
+
+    data = parser.add_argument_group('label arguments (optional)')
+    data.add_argument('-r', '--radius', default=3, type=int, help='pixel radius around particle centers to consider positive. train --packed with another radius remakes the labels from the packed coordinates (default: 3)')
+    data.add_argument('-k', '--k-fold', default=0, type=int, help='assign the training micrographs to K folds for cross validation, train --packed holds out its --fold (default: not used)')
+    data.add_argument('--cross-validation-seed', default=42, type=int, help='random seed for partitioning data into folds (default: 42)')
+
+    return parser
+
+
+def read_image_set(images, targets, format_='auto', image_ext=''):
+    images = read_image_list(images, image_ext=image_ext)
+    targets = file_utils.read_coordinates(targets, format=format_)
+    if 'source' not in images and 'source' not in targets:
+        images['source'] = 0
+        targets['source'] = 0
+
+    names = set(zip(images.source, images.image_name))
+    check = np.array([key in names for key in zip(targets.source, targets.image_name)], dtype=bool)
+    missing = targets.image_name.loc[~check].unique().tolist()
+    if len(missing) > 0:
+        print('WARNING: {} micrographs listed in the coordinates file are missing from the images. Image names are listed below.'.format(len(missing)), file=sys.stderr)
+        print('WARNING: missing micrographs are: {}'.format(missing), file=sys.stderr)
+    return images, targets.loc[check]
+
+
+def to_json(x):
+    ## numpy scalars, e.g. integer sources, are not JSON serializable
+    return x.item() if hasattr(x, 'item') else x
+
+
+def main(args):
+    sets = [('train', args.train_images, args.train_targets)]
+    if args.test_images is not None:
+        sets.append(('test', args.test_images, args.test_targets))
+
+    micrographs = []
+    counts = {}
+    null_coords = np.zeros((0,2), dtype=np.int32)
+    with PackWriter(args.output) as writer:
+        for split,images,targets in sets:
+            images,targets = read_image_set(images, targets, format_=args.format_
+                                           , image_ext=args.image_ext)
+            coords = coordinates_table_to_dict(targets)
+
+            ## same order as train, grouped by source in order of appearance
+            images = images.iloc[np.argsort(images.source.factorize()[0], kind='stable')]
+
+            stats = StageStats('load {} micrographs'.format(split))
+            loaded = thread_map(load_image, images.path, num_workers=args.num_readers
+                               , depth=2*args.num_readers, stats=stats)
+            for source,image_name,image in zip(images.source, images.image_name, loaded):
+                xy = coords.get(source, {}).get(image_name, null_coords)
+                radii = np.array([args.radius]*len(xy), dtype=np.int32)
+                label = as_mask(image.shape, xy[:,0], xy[:,1], radii)
+                if split == 'train':
+                    counts.setdefault(source, []).append(label.sum())
+
+                micrographs.append({'source': to_json(source), 'image_name': to_json(image_name)
+                                   , 'split': split, 'fold': -1
+                                   , 'image': writer.add(image), 'label': writer.add(label)
+                                   , 'coords': writer.add(xy)})
+            report(stats.summary())
+            report('Packed {} {} micrographs with {} labeled particles'.format(len(images), split, len(targets)))
+
+        if args.k_fold > 1:
+            random = np.random.RandomState(args.cross_validation_seed)
+            ## only the label counts are used for stratifying the folds
+            folds = assign_folds(args.k_fold, [[np.array(c) for c in v] for v in counts.values()]
+                                , random=random)
+            train = [m for m in micrographs if m['split'] == 'train']
+            for m,fold in zip(train, np.concatenate(folds)):
+                m['fold'] = int(fold)
+
+        index = {'version': 1, 'radius': args.radius, 'k_fold': args.k_fold
+                , 'cross_validation_seed': args.cross_validation_seed, 'micrographs': micrographs}
+        writer.close(index)
+
+    report('Wrote', args.output, '({:.1f} MB)'.format(os.path.getsize(args.output)/2**20))
+
+
+if __name__ == '__main__':
+    parser = add_arguments()
+    args = parser.parse_args()
+    main(args)
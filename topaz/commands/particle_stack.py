@@ -54,14 +54,13 @@ def main(args):
 
     print('#', 'Extracting', len(particles), 'particles', file=sys.stderr)
 
-    N = len(particles)
     size = args.size
     resize = args.resize
     if resize < 0:
         resize = size
 
     # 
-    wrote_header = False
+    writer = None
     read_metadata = False
     metadata = []
 
@@ -75,26 +74,19 @@ def main(args):
             # load the micrograph
             image_name = image_name + args.image_ext
             path = os.path.join(args.image_root, image_name) 
-            with open(path, 'rb') as fm:
-                content = fm.read()
-            micrograph, header, extended_header = mrc.parse(content)
+            ## only the regions around the particles are read from the file
+            micrograph, header, extended_header = mrc.open_mmap(path)
             if len(micrograph.shape) < 3:
                 micrograph = micrograph[np.newaxis] # add z dim if micrograph is image
         
-            if not wrote_header: # load a/px and angles from micrograph header and write the stack header
+            if writer is None: # load a/px and angles from micrograph header for the stack header
                 mz = micrograph.shape[0]
 
                 dtype = micrograph.dtype
 
-                cella = (header.xlen, header.ylen, header.zlen)
-                cellb = (header.alpha, header.beta, header.gamma)
-                shape = (N*mz,resize,resize)
-
-                header = mrc.make_header(shape, cella, cellb, mz=mz, dtype=dtype)
-
-                buf = mrc.header_struct.pack(*list(header))
-                f.write(buf)
-                wrote_header = True
+                ## the header is written with the stack statistics once all particles are written
+                writer = mrc.MRCWriter(f, dtype=dtype, mz=mz, ax=header.xlen, ay=header.ylen, az=header.zlen
+                                      , alpha=header.alpha, beta=header.beta, gamma=header.gamma)
 
             _,n,m = micrograph.shape
 
@@ -132,13 +124,16 @@ def main(args):
                     restack = downsample(stack, 0, shape=(resize,resize))
                     #print(restack.shape, restack.mean(), restack.std())
                     restack = (restack - restack.mean())/restack.std()
-                    f.write(restack.tobytes())
+                    writer.write(restack)
                 else:
-                    f.write(stack.tobytes())
+                    writer.write(stack)
 
                 i += 1
                 #print('# wrote', i, 'out of', N, 'particles', end='\r', flush=True)
 
+        if writer is not None:
+            writer.close()
+
 
     ## write the particle stack mrcs
     #with open(args.output, 'wb') as f:
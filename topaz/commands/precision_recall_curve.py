@@ -27,6 +27,7 @@ def add_arguments(parser=None):
     parser.add_argument('--targets', help='path to file specifying target particle coordinates') 
 
     parser.add_argument('-r', '--assignment-radius', required=True, type=int, help='maximum distance between prediction and labeled target allowed for considering them a match')
+    parser.add_argument('--greedy', action='store_true', help='match particles greedily in order of increasing distance instead of solving the optimal assignment')
     parser.add_argument('--images', choices=['target', 'predicted', 'union'], default='target', help='only count particles on micrographs with coordinates labeled in the targets file, the predicted file, or the union of those (default: target)')
 
     return parser
@@ -53,17 +54,21 @@ def main(args):
     matches = []
     scores = []
 
+    ## index the tables by image once instead of scanning them per image
+    target_groups = dict(list(targets.groupby('image_name')))
+    predict_groups = dict(list(predicts.groupby('image_name')))
+
     count = 0
     mae = 0
     for name in image_list:
-        target = targets.loc[targets.image_name == name]
-        predict = predicts.loc[predicts.image_name == name]
+        target = target_groups.get(name, targets.iloc[:0])
+        predict = predict_groups.get(name, predicts.iloc[:0])
 
         target_coords = target[['x_coord', 'y_coord']].values
         predict_coords = predict[['x_coord', 'y_coord']].values
         score = predict.score.values.astype(np.float32)
 
-        match,dist = match_coordinates(target_coords, predict_coords, match_radius)
+        match,dist = match_coordinates(target_coords, predict_coords, match_radius, greedy=args.greedy)
 
         this_mae = np.sum(dist[match==1])
         count += np.sum(match)
@@ -3,16 +3,18 @@ from __future__ import print_function, division
 
 import os
 import sys
+from collections import deque
 
 import numpy as np
 import pandas as pd
 from PIL import Image
 import argparse
 
-import torch
-
 from topaz.utils.data.loader import load_image
+from topaz.utils.scores import ScoreStore, hash_file, hash_model
+from topaz.utils.pipeline import pool_map
 import topaz.cuda
+import topaz.predict
 
 name = 'segment'
 help = 'segment images using a trained region classifier'
@@ -25,9 +27,18 @@ def add_arguments(parser=None):
 
     parser.add_argument('-m', '--model', default='resnet16', help='path to trained classifier. uses the pretrained resnet16 model by default.')
     parser.add_argument('-o', '--destdir', help='output directory')
+    parser.add_argument('--score-cache', help='directory of cached score maps keyed by model and image. images already scored by the model are read from the cache and new score maps are added to it, for reuse by extract --score-cache (default: none)')
+    parser.add_argument('--cache-dtype', default='float32', choices=['float32', 'float16', 'uint8'], help='storage type for new score maps in the cache. uint8 quantizes each score map between its minimum and maximum finite score (default: float32)')
 
     parser.add_argument('-d', '--device', default=0, type=int, help='which device to use, <0 corresponds to CPU (default: GPU if available)')
-    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores. with --score-workers, the number of threads of each worker, where 0 divides the cores evenly among the workers (default: 0)')
+    parser.add_argument('--score-workers', type=int, default=0, help='number of processes scoring images in parallel on the CPU, each with its own copy of the model. images are written in input order (default: 0, score in the main process)')
+
+    parser.add_argument('--dense-mode', default='fill', choices=['fill', 'stitch'], help='how to score every pixel with the strided model. fill dilates the model, stitch runs the strided model on every shifted copy of the image and interleaves the outputs, which gives the same scores and is often faster on CPU. --tile-size and --memory-budget apply to fill only (default: fill)')
+    parser.add_argument('--no-compiled', action='store_true', help='do not use a compiled model from topaz compile-model, even if one is cached for this model and number of threads')
+    parser.add_argument('--compiled-dtype', default='float32', choices=['float32', 'bfloat16'], help='precision of the cached compiled model to use (default: float32)')
+    parser.add_argument('--tile-size', type=int, help='score images in tiles of this size to bound memory use on large images. results are identical to whole image scoring (default: whole images)')
+    parser.add_argument('--memory-budget', type=float, help='choose the tile size so that a tile is expected to fit in this many GB (default: none)')
 
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
 
@@ -45,38 +56,79 @@ def main(args):
     ## set the device
     use_cuda = topaz.cuda.set_device(args.device)
 
-    ## load the model
-    from topaz.model.factory import load_model
-    model = load_model(args.model)
-    model.eval()
-    model.fill()
-
-    if use_cuda:
-        model.cuda()
+    tile_size = args.tile_size
+    memory_budget = args.memory_budget
+    if memory_budget is not None:
+        memory_budget = memory_budget*2**30
+
+    ## the model is loaded on first use, by each worker if scoring in parallel
+    scorer = topaz.predict.Scorer(args.model, use_cuda=use_cuda, tile_size=tile_size
+                                 , memory_budget=memory_budget, dense_mode=args.dense_mode
+                                 , compiled=not args.no_compiled, compiled_dtype=args.compiled_dtype)
+    pool = None
+    if args.score_workers > 0:
+        if use_cuda:
+            raise Exception('Scoring workers are only supported for scoring on the CPU (--device -1)')
+        ## fork the workers before loading the model in this process
+        pool = topaz.predict.scoring_pool(args.score_workers, num_threads=num_threads)
 
     ## make output directory if doesn't exist
     destdir = args.destdir 
-    if not os.path.exists(destdir):
+    if destdir is None and args.score_cache is None:
+        raise Exception('Must specify an output directory or a score cache')
+    if destdir is not None and not os.path.exists(destdir):
         os.makedirs(destdir)
 
-    ## load the images and process with the model
-    for path in args.paths:
-        basename = os.path.basename(path)
-        image_name = os.path.splitext(basename)[0]
-        image = load_image(path)
-
-        ## process image with the model
-        with torch.no_grad():
-            X = torch.from_numpy(np.array(image, copy=False)).unsqueeze(0).unsqueeze(0)
-            if use_cuda:
-                X = X.cuda()
-            score = model(X).data[0,0].cpu().numpy()
-        
-        im = Image.fromarray(score) 
-        path = os.path.join(destdir, image_name) + '.tiff'
-        if verbose:
-            print('# saving:', path)
-        im.save(path, 'tiff')
+    store = None
+    if args.score_cache is not None:
+        store = ScoreStore(args.score_cache, dtype=args.cache_dtype)
+        model_hash = hash_model(scorer.model())
+
+    ## load the images, leaving out those with a score map in the cache
+    entries = deque()
+    def load_images(paths):
+        for path in paths:
+            basename = os.path.basename(path)
+            image_name = os.path.splitext(basename)[0]
+
+            image_hash = key = None
+            if store is not None:
+                image_hash = hash_file(path)
+                key = store.lookup(model_hash, image_hash)
+            entries.append((image_name, image_hash, key))
+
+            image = None
+            if key is None:
+                image = load_image(path)
+            yield image_name, image
+
+    ## process the images with the model, in order
+    if pool is None:
+        scores = map(scorer, load_images(args.paths))
+    else:
+        scores = pool_map(scorer, load_images(args.paths), pool, depth=2*args.score_workers
+                         , shared=True)
+
+    try:
+        for _,score in scores:
+            image_name,image_hash,key = entries.popleft()
+            if key is not None: ## reuse the score map in the cache
+                score = store.load(key)
+            elif store is not None:
+                store.add(image_name, score, model_hash=model_hash, image_hash=image_hash)
+                if verbose:
+                    print('# cached:', image_name)
+
+            if destdir is not None:
+                im = Image.fromarray(np.asarray(score, dtype=np.float32))
+                path = os.path.join(destdir, image_name) + '.tiff'
+                if verbose:
+                    print('# saving:', path)
+                im.save(path, 'tiff')
+    finally:
+        if pool is not None:
+            scores.close() # frees the results in flight before the workers are stopped
+            pool.terminate()
 
 
 
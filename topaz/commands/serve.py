@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import os
+import sys
+import signal
+import argparse
+
+import topaz.cuda
+
+name = 'serve'
+help = 'keep picking and denoising models warm and serve jobs over a Unix socket or HTTP'
+
+def add_arguments(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser('Script for serving picking and denoising jobs with models kept in memory.')
+
+    parser.add_argument('--socket', help='path of the Unix socket to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on for HTTP when no socket is given (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8910, help='port to listen on for HTTP when no socket is given (default: 8910)')
+
+    parser.add_argument('-m', '--model', default='resnet16', help='default picking model for jobs that do not name one. uses the pretrained resnet16 model by default.')
+    parser.add_argument('--denoise-model', default='unet', help='default denoising model for jobs that do not name one (default: unet)')
+    parser.add_argument('--allow-models', nargs='*', default=[], help='other picking models, by name or path, that jobs may use. jobs naming any other model are rejected (default: none)')
+    parser.add_argument('--allow-denoise-models', nargs='*', default=[], help='other denoising models, by name or path, that jobs may use (default: none)')
+    parser.add_argument('--output-root', help='directory denoised micrographs are written in. the "output" of a denoise job is a directory relative to it. denoise jobs are rejected without it (default: none)')
+    parser.add_argument('--warm', nargs='*', default=['pick'], choices=['pick', 'denoise'], help='default models to load before accepting jobs, others are loaded on first use (default: pick)')
+
+    parser.add_argument('--batch-size', type=int, default=8, help='maximum number of queued micrographs scored together (default: 8)')
+    parser.add_argument('--queue-size', type=int, default=4, help='number of micrographs of each job loaded and queued ahead of its results (default: 4)')
+
+    parser.add_argument('-d', '--device', default=0, type=int, help='which device to use, <0 corresponds to CPU (default: GPU if available)')
+    parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log each request')
+
+    return parser
+
+
+def main(args):
+    from topaz.torch import set_num_threads
+    set_num_threads(args.num_threads)
+    use_cuda = topaz.cuda.set_device(args.device)
+
+    from topaz.server import InferenceWorker, make_server
+    worker = InferenceWorker(picker=args.model, denoiser=args.denoise_model
+                            , batch_size=args.batch_size, use_cuda=use_cuda
+                            , pickers=args.allow_models, denoisers=args.allow_denoise_models)
+    if 'pick' in args.warm:
+        worker.warm('pick', args.model).result()
+    if 'denoise' in args.warm:
+        worker.warm('denoise', args.denoise_model).result()
+
+    server = make_server(worker, socket_path=args.socket, host=args.host, port=args.port
+                        , depth=args.queue_size, verbose=args.verbose, output_root=args.output_root)
+    if args.socket is not None:
+        print('# serving on', args.socket, file=sys.stderr)
+    else:
+        print('# serving on http://{}:{}'.format(args.host, args.port), file=sys.stderr)
+    sys.stderr.flush()
+
+    ## exit cleanly on SIGTERM too, so that the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    parser = add_arguments()
+    args = parser.parse_args()
+    main(args)
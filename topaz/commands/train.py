@@ -17,7 +17,9 @@ from torch.autograd import Variable
 
 import topaz.utils.files as file_utils
 from topaz.utils.printing import report
-from topaz.utils.data.loader import load_images_from_list
+from topaz.utils.data.loader import load_images_from_list, cache_images_from_list, ImageCache, CachedImage
+from topaz.utils.catalog import scan
+from topaz.utils.pipeline import StageStats
 from topaz.utils.data.coordinates import match_coordinates_to_images
 import topaz.cuda
 
@@ -34,6 +36,8 @@ def add_arguments(parser=None):
     parser.add_argument('-d', '--device', default=0, type=int, help='which device to use, set to -1 to force CPU (default: 0)')
     parser.add_argument('--num-workers', default=0, type=int, help='number of worker processes for data augmentation, if set to <0, automatically uses all CPUs available (default: 0)')
     parser.add_argument('-j', '--num-threads', type=int, default=0, help='number of threads for pytorch, 0 uses pytorch defaults, <0 uses all cores (default: 0)')
+    parser.add_argument('--num-readers', type=int, default=8, help='number of threads reading and decoding micrographs when loading the training and test sets (default: 8)')
+    parser.add_argument('--cache-size', type=float, default=0, help='keep at most this many GB of decoded micrographs in memory, reading the others from disk when they are needed. minibatches are drawn from the cached micrographs, moving through the training set over the epoch. each data augmentation worker has its own cache and the test micrographs have a separate cache of the same size, so evaluation does not evict the training micrographs. 0 loads all micrographs into memory. not used with --packed, whose micrographs are memory mapped (default: 0)')
 
     # group arguments into sections
 
@@ -41,6 +45,7 @@ def add_arguments(parser=None):
 
     data.add_argument('--train-images', help='path to file listing the training images. also accepts directory path from which all images are loaded.')
     data.add_argument('--train-targets', help='path to file listing the training particle coordinates')
+    data.add_argument('--packed', help='path to a dataset made by topaz pack, used instead of the image, target and split arguments. the micrographs are memory mapped, not loaded')
 
 
 
@@ -55,6 +60,7 @@ def add_arguments(parser=None):
     data.add_argument('--format', dest='format_', choices=['auto', 'coord', 'csv', 'star', 'box'], default='auto'
                        , help='file format of the particle coordinates file (default: detect format automatically based on file extension)')
     data.add_argument('--image-ext', default='', help='sets the image extension if loading images from directory. should include "." before the extension (e.g. .tiff). (default: find all extensions)')
+    data.add_argument('--catalog', help='path to a persistent catalog of image header metadata. images unchanged since they were cataloged are not scanned again (default: none)')
 
     
     data = parser.add_argument_group('cross validation arguments (optional)')
@@ -170,6 +176,30 @@ def calculate_positive_fraction(targets):
     return np.mean(per_source)
 
 
+def assign_folds(k, targets, random=np.random):
+    """
+    Fold of each image in a k-fold partition stratified like the one of
+    cross_validation_split, as a list of arrays per source.
+    """
+    import topaz.utils.data.partition
+    source = []
+    index = []
+    count = []
+    for i in range(len(targets)):
+        for j in range(len(targets[i])):
+            source.append(i)
+            index.append(j)
+            count.append(targets[i][j].sum())
+    counts_table = pd.DataFrame({'source': source, 'image_name': index, 'count': count})
+    partitions = topaz.utils.data.partition.kfold(k, counts_table, random=random)
+
+    folds = [np.zeros(len(t), dtype=int) for t in targets]
+    for fold,(_,validate_table) in enumerate(partitions):
+        for row in validate_table.itertuples():
+            folds[row.source][row.image_name] = fold
+    return folds
+
+
 def cross_validation_split(k, fold, images, targets, random=np.random):
     import topaz.utils.data.partition
     ## calculate number of positives per image for stratified split
@@ -182,21 +212,21 @@ def cross_validation_split(k, fold, images, targets, random=np.random):
             index.append(j)
             count.append(targets[i][j].sum())
     counts_table = pd.DataFrame({'source': source, 'image_name': index, 'count': count})
-    partitions = list(topaz.utils.data.partition.kfold(k, counts_table))
+    partitions = list(topaz.utils.data.partition.kfold(k, counts_table, random=random))
 
     ## make the split from the partition indices
     train_table,validate_table = partitions[fold]
 
-    test_images = [[]*len(images)]
-    test_targets = [[]*len(targets)]
+    test_images = [[] for _ in images]
+    test_targets = [[] for _ in targets]
     for row in validate_table.itertuples():
         i = row.source
         j = row.image_name
         test_images[i].append(images[i][j])
         test_targets[i].append(targets[i][j])
 
-    train_images = [[]*len(images)]
-    train_targets = [[]*len(targets)]
+    train_images = [[] for _ in images]
+    train_targets = [[] for _ in targets]
     for row in train_table.itertuples():
         i = row.source
         j = row.image_name
@@ -205,23 +235,30 @@ def cross_validation_split(k, fold, images, targets, random=np.random):
 
     return train_images, train_targets, test_images, test_targets
 
+def read_image_list(images, image_ext=''):
+    """
+    Table of image_name and path of the images listed in the file at
+    images, or of the .mrc, .tiff and .png images if images is a directory.
+    """
+    if not os.path.isdir(images):
+        return pd.read_csv(images, sep='\t')
+    paths = glob.glob(images + os.sep + '*' + image_ext)
+    valid_paths = []
+    image_names = []
+    for path in paths:
+        name = os.path.basename(path)
+        name,ext = os.path.splitext(name)
+        if ext in ['.mrc', '.tiff', '.png']:
+            image_names.append(name)
+            valid_paths.append(path)
+    return pd.DataFrame({'image_name': image_names, 'path': valid_paths})
+
 def load_data(train_images, train_targets, test_images, test_targets, radius
-             , k_fold=0, fold=0, cross_validation_seed=42, format_='auto', image_ext=''):
+             , k_fold=0, fold=0, cross_validation_seed=42, format_='auto', image_ext=''
+             , catalog=None, num_readers=8, cache=None):
 
     # if train_images is a directory path, map to all images in the directory
-    if os.path.isdir(train_images):
-        paths = glob.glob(train_images + os.sep + '*' + image_ext)
-        valid_paths = []
-        image_names = []
-        for path in paths:
-            name = os.path.basename(path)
-            name,ext = os.path.splitext(name)
-            if ext in ['.mrc', '.tiff', '.png']:
-                image_names.append(name)
-                valid_paths.append(path)
-        train_images = pd.DataFrame({'image_name': image_names, 'path': valid_paths})
-    else:
-        train_images = pd.read_csv(train_images, sep='\t') # training image file list
+    train_images = read_image_list(train_images, image_ext=image_ext) # training image file list
     #train_targets = pd.read_csv(train_targets, sep='\t') # training particle coordinates file
     train_targets = file_utils.read_coordinates(train_targets, format=format_)
 
@@ -229,16 +266,9 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
     if 'source' not in train_images and 'source' not in train_targets:
         train_images['source'] = 0
         train_targets['source'] = 0
-    # load the images and create target masks from the particle coordinates
-    train_images = load_images_from_list(train_images.image_name, train_images.path
-                                        , sources=train_images.source)
-
     # discard coordinates for micrographs not in the set of images
     # and warn the user if any are discarded
-    names = set()
-    for k,d in train_images.items():
-        for name in d.keys():
-            names.add(name)
+    names = set(train_images.image_name)
     check = train_targets.image_name.apply(lambda x: x in names)
     missing = train_targets.image_name.loc[~check].unique().tolist()
     if len(missing) > 0:
@@ -248,15 +278,10 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
 
     # check that the particles roughly fit within the images
     # if they don't, the user may not have scaled the particles/images correctly
-    width = 0
-    height = 0
-    for k,d in train_images.items():
-        for image in d.values():
-            w,h = image.size
-            if w > width:
-                width = w
-            if h > height:
-                height = h
+    # the image sizes are read from the image headers, before loading any pixels
+    info = scan(train_images.path, catalog=catalog)
+    width = info.width.max() if len(info) > 0 else 0
+    height = info.height.max() if len(info) > 0 else 0
     out_of_bounds = (train_targets.x_coord > width) | (train_targets.y_coord > height)
     count = out_of_bounds.sum()
     if count > int(0.1*len(train_targets)): # arbitrary cutoff of more than 10% of particles being out of bounds...
@@ -267,6 +292,19 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
     if x_max < 0.7*width and y_max < 0.7*height: # more arbitrary cutoffs
         print('WARNING: no coordinates are observed with x_coord > {} or y_coord > {}. Did you scale the micrographs and particle coordinates correctly?'.format(x_max, y_max), file=sys.stderr)
 
+    # load the images and create target masks from the particle coordinates
+    # with a cache, the images are only read when they are sampled
+    if cache is not None:
+        train_images = cache_images_from_list(train_images.image_name, train_images.path
+                                             , info.width, info.height, cache
+                                             , sources=train_images.source, dtypes=info.dtype)
+    else:
+        stats = StageStats('load training micrographs')
+        train_images = load_images_from_list(train_images.image_name, train_images.path
+                                            , sources=train_images.source, num_workers=num_readers
+                                            , stats=stats)
+        report(stats.summary())
+
     num_micrographs = sum(len(train_images[k]) for k in train_images.keys())
     num_particles = len(train_targets)
     report('Loaded {} training micrographs with {} labeled particles'.format(num_micrographs, num_particles))
@@ -277,29 +315,31 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
 
     train_images, train_targets = match_images_targets(train_images, train_targets, radius)
 
+    ## test micrographs are read through their own cache, evaluating the
+    ## model would otherwise evict the training micrographs being sampled
+    test_cache = None
+    if cache is not None:
+        test_cache = ImageCache(cache.max_bytes, standardize=cache.standardize)
     
     if test_images is not None:
-        if os.path.isdir(test_images):
-            paths = glob.glob(test_images + os.sep + '*' + image_ext)
-            valid_paths = []
-            image_names = []
-            for path in paths:
-                name = os.path.basename(path)
-                name,ext = os.path.splitext(name)
-                if ext in ['.mrc', '.tiff', '.png']:
-                    image_names.append(name)
-                    valid_paths.append(path)
-            test_images = pd.DataFrame({'image_name': image_names, 'path': valid_paths})
-        else:
-            test_images = pd.read_csv(test_images, sep='\t')
+        test_images = read_image_list(test_images, image_ext=image_ext)
         #test_targets = pd.read_csv(test_targets, sep='\t')
         test_targets = file_utils.read_coordinates(test_targets, format=format_)
         # check for source columns
         if 'source' not in test_images and 'source' not in test_targets:
             test_images['source'] = 0
             test_targets['source'] = 0
-        test_images = load_images_from_list(test_images.image_name, test_images.path
-                                           , sources=test_images.source)
+        if cache is not None:
+            info = scan(test_images.path, catalog=catalog)
+            test_images = cache_images_from_list(test_images.image_name, test_images.path
+                                                , info.width, info.height, test_cache
+                                                , sources=test_images.source, dtypes=info.dtype)
+        else:
+            stats = StageStats('load test micrographs')
+            test_images = load_images_from_list(test_images.image_name, test_images.path
+                                               , sources=test_images.source, num_workers=num_readers
+                                               , stats=stats)
+            report(stats.summary())
 
         # discard coordinates for micrographs not in the set of images
         # and warn the user if any are discarded
@@ -324,6 +364,9 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
         random = np.random.RandomState(cross_validation_seed)
         ## make the split
         train_images, train_targets, test_images, test_targets = cross_validation_split(k_fold, fold, train_images, train_targets, random=random)
+        if test_cache is not None:
+            test_images = [[CachedImage(im.path, im.width, im.height, test_cache, dtype=im.dtype) for im in images]
+                           for images in test_images]
 
         n_train = sum(len(images) for images in train_images)
         n_test = sum(len(images) for images in test_images)
@@ -331,6 +374,64 @@ def load_data(train_images, train_targets, test_images, test_targets, radius
 
     return train_images, train_targets, test_images, test_targets
 
+def load_packed(path, radius, fold=0):
+    """
+    Load the training and test sets from a packed dataset. The images and
+    labels are views of the memory mapped file. The test set is the packed
+    test set or, if the dataset was packed with k folds, the given fold.
+    Labels are remade from the packed coordinates if radius differs from
+    the radius the dataset was packed with.
+    """
+    from topaz.utils.data.packed import PackedFile
+    from topaz.utils.picks import as_mask
+
+    packed = PackedFile(path)
+    index = packed.index
+    micrographs = index['micrographs']
+    has_test = any(m['split'] == 'test' for m in micrographs)
+    k_fold = index['k_fold']
+    if not has_test and k_fold > 1:
+        if not 0 <= fold < k_fold:
+            raise Exception('Fold must be between 0 and {} for a dataset packed with {} folds, got: {}'.format(k_fold-1, k_fold, fold))
+        report('Holding out fold {} of {}'.format(fold, k_fold))
+
+    remake = radius != index['radius']
+    if remake:
+        report('Making labels with radius={} (packed with radius={})'.format(radius, index['radius']))
+
+    sources = []
+    train = {}
+    test = {}
+    for m in micrographs:
+        image = packed.array(m['image'])
+        if remake:
+            xy = packed.array(m['coords'])
+            radii = np.array([radius]*len(xy), dtype=np.int32)
+            label = as_mask(image.shape, xy[:,0], xy[:,1], radii)
+        else:
+            label = packed.array(m['label'])
+
+        source = m['source']
+        if source not in sources:
+            sources.append(source)
+        held_out = m['split'] == 'test' or (not has_test and k_fold > 1 and m['fold'] == fold)
+        images,targets = (test if held_out else train).setdefault(source, ([], []))
+        images.append(image)
+        targets.append(label)
+
+    train_images = [train.get(s, ([], []))[0] for s in sources]
+    train_targets = [train.get(s, ([], []))[1] for s in sources]
+    test_images = test_targets = None
+    if len(test) > 0:
+        test_images = [test.get(s, ([], []))[0] for s in sources]
+        test_targets = [test.get(s, ([], []))[1] for s in sources]
+
+    n_train = sum(len(images) for images in train_images)
+    n_test = sum(len(images) for images in test_images) if test_images is not None else 0
+    report('Loaded {} train and {} test micrographs from {}'.format(n_train, n_test, path))
+
+    return train_images, train_targets, test_images, test_targets
+
 def report_data_stats(train_images, train_targets, test_images, test_targets):
     report('source\tsplit\tp_observed\tnum_positive_regions\ttotal_regions')
     num_positive_regions = 0
@@ -470,7 +571,7 @@ def make_training_step_method(classifier, num_positive_regions, positive_fractio
 
 def make_data_iterators(train_images, train_targets, test_images, test_targets
                        , crop, split, args):
-    from topaz.utils.data.sampler import StratifiedCoordinateSampler
+    from topaz.utils.data.sampler import StratifiedCoordinateSampler, CachedCoordinateSampler
     from torch.utils.data.dataloader import DataLoader
 
     ## training parameters
@@ -496,8 +597,16 @@ def make_data_iterators(train_images, train_targets, test_images, test_targets
 
     ## create minibatch iterators
     labels = train_dataset.data.labels
-    sampler = StratifiedCoordinateSampler(labels, size=epoch_size*minibatch_size
+    if args.cache_size > 0:
+        ## number of the largest micrographs that fit in the cache
+        nbytes = max(im.nbytes for images in train_images for im in images)
+        capacity = int(args.cache_size*2**30//nbytes)
+        report('Caching up to {} micrographs ({} GB)'.format(capacity, args.cache_size))
+        sampler = CachedCoordinateSampler(labels, capacity, size=epoch_size*minibatch_size
                                          , balance=balance, split=split)
+    else:
+        sampler = StratifiedCoordinateSampler(labels, size=epoch_size*minibatch_size
+                                             , balance=balance, split=split)
     train_iterator = DataLoader(train_dataset, batch_size=minibatch_size, sampler=sampler
                                , num_workers=num_workers)
 
@@ -631,18 +740,30 @@ def main(args):
     
     ## load the data
     radius = args.radius # number of pixels around coordinates to label as positive
-    train_images, train_targets, test_images, test_targets = \
-            load_data(args.train_images,
-                      args.train_targets,
-                      args.test_images,
-                      args.test_targets,
-                      radius,
-                      format_=args.format_,
-                      k_fold=args.k_fold,
-                      fold=args.fold,
-                      cross_validation_seed=args.cross_validation_seed,
-                      image_ext=args.image_ext
-                     )
+    cache = None
+    if args.cache_size > 0:
+        if args.packed is not None:
+            raise Exception('--cache-size cannot be used with --packed, packed micrographs are memory mapped')
+        cache = ImageCache(int(args.cache_size*2**30))
+    if args.packed is not None:
+        train_images, train_targets, test_images, test_targets = \
+            load_packed(args.packed, radius, fold=args.fold)
+    else:
+        train_images, train_targets, test_images, test_targets = \
+                load_data(args.train_images,
+                          args.train_targets,
+                          args.test_images,
+                          args.test_targets,
+                          radius,
+                          format_=args.format_,
+                          k_fold=args.k_fold,
+                          fold=args.fold,
+                          cross_validation_seed=args.cross_validation_seed,
+                          image_ext=args.image_ext,
+                          catalog=args.catalog,
+                          num_readers=args.num_readers,
+                          cache=cache
+                         )
     num_positive_regions, total_regions = report_data_stats(train_images, train_targets
                                                            , test_images, test_targets)
 
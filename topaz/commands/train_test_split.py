@@ -2,12 +2,12 @@ from __future__ import print_function,division
 
 import sys
 import os
-import glob
 import pandas as pd
 import numpy as np
 import argparse
 
 import topaz.utils.files as file_utils
+from topaz.utils.data.loader import index_directory
 
 name = 'train_test_split'
 help = 'split micrographs with labeled particles into train/test sets'
@@ -30,9 +30,11 @@ def add_arguments(parser=None):
     return parser
 
 
-def get_image_path(image_name, root, ext):
-    tmp = root + os.sep + image_name + '.' + ext
-    paths = glob.glob(tmp) # candidates...
+def get_image_path(image_name, root, ext, index=None):
+    """ find the image file for image_name, using the index from index_directory(root, ext) if given """
+    if index is None:
+        index = index_directory(root, ext)
+    paths = index.get(image_name, []) # candidates...
     if len(paths) > 1:
         print('WARNING: multiple images detected matching to image_name='+image_name, file=sys.stderr)
         # resolve this by taking #1 .tiff, #2 .mrc, #3 .png
@@ -117,20 +119,27 @@ def main(args):
     root = args.image_dir
     ext = args.image_ext
 
+    ## list the image directory once and look up every image in it
+    index = index_directory(root, ext)
+
+    names_train = []
     paths_train = []
     for image_name in image_names_train:
-        path = get_image_path(image_name, root, ext)
+        path = get_image_path(image_name, root, ext, index=index)
         if path is not None:
+            names_train.append(image_name)
             paths_train.append(path)
 
+    names_test = []
     paths_test = []
     for image_name in image_names_test:
-        path = get_image_path(image_name, root, ext)
+        path = get_image_path(image_name, root, ext, index=index)
         if path is not None:
+            names_test.append(image_name)
             paths_test.append(path)
 
-    image_list_train = pd.DataFrame({'image_name': image_names_train, 'path': paths_train})
-    image_list_test = pd.DataFrame({'image_name': image_names_test, 'path': paths_test})
+    image_list_train = pd.DataFrame({'image_name': names_train, 'path': paths_train})
+    image_list_test = pd.DataFrame({'image_name': names_test, 'path': paths_test})
 
 
     ## write the files to the same location as the original labels
@@ -854,8 +854,7 @@ class PairedImages:
             self.y = [self.load_image(p) for p in y]
 
     def load_image(self, path):
-        x = np.array(load_image(path), copy=False)
-        x = x.astype(np.float32) # make sure dtype is single precision
+        x = load_image(path).astype(np.float32, copy=False) # make sure dtype is single precision
         mu = x.mean()
         std = x.std()
         x = (x - mu)/std
@@ -923,7 +922,7 @@ class NoiseImages:
             x = [self.load_image(p) for p in x]
 
     def load_image(self, path):
-        x = np.array(load_image(path), copy=False)
+        x = load_image(path)
         mu = x.mean()
         std = x.std()
         x = (x - mu)/std
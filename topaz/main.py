@@ -61,6 +61,8 @@ def main():
     import topaz.commands.segment
     import topaz.commands.extract
     import topaz.commands.precision_recall_curve
+    import topaz.commands.compile_model
+    import topaz.commands.serve
 
     import topaz.commands.downsample
     import topaz.commands.normalize
@@ -74,6 +76,7 @@ def main():
     import topaz.commands.split
     import topaz.commands.particle_stack
     import topaz.commands.train_test_split
+    import topaz.commands.pack
 
     # deprecated
     import topaz.commands.scale_coordinates
@@ -89,6 +92,8 @@ def main():
                        topaz.commands.segment,
                        topaz.commands.extract,
                        topaz.commands.precision_recall_curve,
+                       topaz.commands.compile_model,
+                       topaz.commands.serve,
                       ]
                      ),
                      ('Image processing',
@@ -105,6 +110,7 @@ def main():
                        topaz.commands.split,
                        topaz.commands.particle_stack,
                        topaz.commands.train_test_split,
+                       topaz.commands.pack,
                       ]
                      ),
                      ('GUI',
@@ -0,0 +1,131 @@
+from __future__ import print_function, division
+
+import os
+import json
+import hashlib
+import warnings
+
+import torch
+import torch.nn as nn
+
+import topaz
+from topaz.utils.scores import hash_file, hash_model
+
+dtypes = {'float32': torch.float32, 'bfloat16': torch.bfloat16}
+
+
+def default_cache_dir():
+    """ $TOPAZ_CACHE_DIR/compiled, or ~/.cache/topaz/compiled """
+    root = os.environ.get('TOPAZ_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'topaz'))
+    return os.path.join(root, 'compiled')
+
+
+def artifact_key(path, dtype='float32', num_threads=None):
+    """
+    Key of the compiled artifact for a model file or pretrained model name,
+    input dtype and number of pytorch threads (default: current).
+    """
+    if num_threads is None:
+        num_threads = torch.get_num_threads()
+    if os.path.exists(path):
+        source = 'file:' + hash_file(path)
+    else: # pretrained models are identified by name and topaz version
+        source = 'pretrained:' + path + ':' + topaz.__version__
+    key = ':'.join([source, dtype, str(num_threads), torch.__version__])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def artifact_path(path, cache_dir=None, dtype='float32', num_threads=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    return os.path.join(cache_dir, artifact_key(path, dtype=dtype, num_threads=num_threads) + '.pt')
+
+
+class CompiledClassifier(nn.Module):
+    """
+    Filled classifier compiled to TorchScript. Inputs are cast to the
+    compiled dtype and scores are returned as float32. Exposes the width
+    of the model and, through hash_model, the hash of the original model.
+    """
+
+    def __init__(self, module, width, max_channels, dtype='float32', model_hash=''):
+        super(CompiledClassifier, self).__init__()
+        self.module = module
+        self.width = width
+        self.max_channels = max_channels
+        self.dtype = dtype
+        self.model_hash = model_hash
+
+    def forward(self, x):
+        return self.module(x.to(dtypes[self.dtype])).float()
+
+
+def compile_model(model, dtype='float32', example_size=128):
+    """
+    Fill the model and trace it into a frozen TorchScript module. The
+    traced graph does not depend on the input size.
+    """
+    model.eval()
+    model.fill()
+    model = model.to(dtypes[dtype])
+    x = torch.zeros(1, 1, example_size, example_size, dtype=dtypes[dtype])
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore') # tracing warns about the python control flow on fixed attributes
+        module = torch.jit.trace(model, x)
+        module = torch.jit.freeze(module)
+    return module
+
+
+def save_compiled(model, path, dtype='float32'):
+    """ compile the unfilled model and save it with the metadata needed to score with it """
+    width = model.width
+    max_channels = max(mod.out_channels for mod in model.modules() if hasattr(mod, 'out_channels'))
+    model_hash = hash_model(model)
+    if dtype != 'float32':
+        model_hash += ':' + dtype
+    module = compile_model(model, dtype=dtype)
+
+    metadata = {'width': width, 'max_channels': max_channels, 'dtype': dtype, 'model_hash': model_hash}
+    dirname = os.path.dirname(path)
+    if dirname != '' and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_path = path + '.tmp'
+    torch.jit.save(module, tmp_path, _extra_files={'topaz.json': json.dumps(metadata)})
+    os.replace(tmp_path, path)
+    return load_compiled(path)
+
+
+def load_compiled(path):
+    """
+    Load a compiled artifact. The CPU specific graph optimizations, such as
+    folding and fusing the convolutions, are applied after loading because
+    optimized graphs cannot be saved.
+    """
+    extra_files = {'topaz.json': ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    module = torch.jit.optimize_for_inference(module)
+    metadata = json.loads(extra_files['topaz.json'])
+    return CompiledClassifier(module, **metadata)
+
+
+def load_filled_model(path, use_cuda=False, compiled=True, cache_dir=None, dtype='float32'):
+    """
+    Load the model at path, or the pretrained model with that name, ready
+    for dense scoring. On CPU, a compiled artifact made by
+    `topaz compile-model` for this model, dtype and thread count is used
+    when it is in the cache, which skips unpickling and filling the model.
+    Otherwise the model is loaded and filled as usual.
+    """
+    if compiled and not use_cuda:
+        artifact = artifact_path(path, cache_dir=cache_dir, dtype=dtype)
+        if os.path.exists(artifact):
+            return load_compiled(artifact)
+
+    from topaz.model.factory import load_model
+    model = load_model(path)
+    model.eval()
+    model.fill()
+    if use_cuda:
+        model.cuda()
+    return model
+
@@ -1,5 +1,7 @@
 from __future__ import print_function, division
 
+import inspect
+
 import torch
 
 import topaz
@@ -29,6 +31,16 @@ def get_feature_extractor(model, *args, **kwargs):
     return constructor(*args, **kwargs)
      
 
+def load_pickled(path):
+    """
+    torch.load a whole pickled model. torch>=2.6 only loads weights by
+    default, so unpickling is asked for explicitly where torch supports it.
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, weights_only=False)
+    return torch.load(path)
+
+
 def load_model(path):
     if path == 'resnet16':
         name = 'resnet16_u64.sav'
@@ -51,7 +63,7 @@ def load_model(path):
 
 
     else: # load model using torch load
-        model = torch.load(path)
+        model = load_pickled(path)
         return model
 
     # load the pretrained model
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, print_function
 
+import os
 import numpy as np
 import struct
 from collections import namedtuple
@@ -105,6 +106,26 @@ names += ' nlabl labels'
 header_struct = struct.Struct(fstr)
 MRCHeader = namedtuple('MRCHeader', names)
 
+def get_dtype(mode):
+    if mode == 0:
+        return np.int8
+    elif mode == 1:
+        return np.int16
+    elif mode == 2:
+        return np.float32
+    elif mode == 3:
+        return np.dtype('2h') # complex number from 2 shorts
+    elif mode == 4:
+        return np.complex64
+    elif mode == 6:
+        return np.uint16
+    elif mode == 16:
+        return np.dtype('3B') # RGB values
+    elif mode == 12:
+        return np.float16
+
+    raise Exception('Unknown dtype mode:' + str(mode))
+
 def parse(content):
     ## parse the header
     header = content[0:1024]
@@ -116,24 +137,7 @@ def parse(content):
     extended_header = content[1024:start]
 
     content = content[start:]
-    if header.mode == 0:
-        dtype = np.int8
-    elif header.mode == 1:
-        dtype = np.int16
-    elif header.mode == 2:
-        dtype = np.float32
-    elif header.mode == 3:
-        dtype = '2h' # complex number from 2 shorts
-    elif header.mode == 4:
-        dtype = np.complex64
-    elif header.mode == 6:
-        dtype = np.uint16
-    elif header.mode == 16:
-        dtype = '3B' # RGB values
-    elif header.mode == 12:
-        dtype = np.float16
-    else:
-        raise Exception('Unknown dtype mode:' + str(header.mode))
+    dtype = get_dtype(header.mode)
 
     array = np.frombuffer(content, dtype=dtype) 
     # clip array to first nz*ny*nx elements
@@ -145,7 +149,32 @@ def parse(content):
 
     return array, header, extended_header
 
+def read_header(f):
+    """ read the header and extended header from the start of an open file """
+    header = MRCHeader._make(header_struct.unpack(f.read(1024)))
+    extended_header = f.read(header.next)
+    return header, extended_header
+
+def open_mmap(path, mode='r'):
+    """
+    Open the MRC file at path without reading its image data. Returns
+    (array, header, extended_header) like parse, but array is a np.memmap
+    of the file, so indexing a section (array[i]) or a slab (array[i:j])
+    only reads that part of the file. mode is the np.memmap mode.
+    """
+    with open(path, 'rb') as f:
+        header, extended_header = read_header(f)
+
+    dtype = get_dtype(header.mode)
+    shape = (header.nz, header.ny, header.nx)
+    array = np.memmap(path, dtype=dtype, mode=mode, offset=1024+header.next, shape=shape)
+    if header.nz == 1:
+        array = array[0]
+
+    return array, header, extended_header
+
 def get_mode(dtype):
+    dtype = np.dtype(dtype)
     if dtype == np.int8:
         return 0
     elif dtype == np.int16:
@@ -160,8 +189,10 @@ def get_mode(dtype):
         return 6
     elif dtype == np.dtype('3B'):
         return 16
+    elif dtype == np.float16:
+        return 12
     
-    raise "MRC incompatible dtype: " + str(dtype)
+    raise Exception('MRC incompatible dtype: ' + str(dtype))
     
 
 def make_header(shape, cella, cellb, mz=1, dtype=np.float32, order=(1,2,3), dmin=0, dmax=-1, dmean=-2, rms=-1
@@ -191,14 +222,15 @@ def make_header(shape, cella, cellb, mz=1, dtype=np.float32, order=(1,2,3), dmin
 
 
 
-def write(f, array, header=None, extended_header=b'', ax=1, ay=1, az=1, alpha=0, beta=0, gamma=0):
-    # make sure the array contains float32
-    array = array.astype(np.float32)
+def write(f, array, header=None, extended_header=b'', ax=1, ay=1, az=1, alpha=0, beta=0, gamma=0
+         , dtype=np.float32):
+    # make sure the array contains float32, or float16 (mode 12) if requested
+    array = array.astype(dtype, copy=False)
 
     exthd_size = len(extended_header)
     if header is None:
         header = MRCHeader( array.shape[2], array.shape[1], array.shape[0], # nx, ny, nz
-                            2, # mode = 32-bit signed real
+                            get_mode(dtype), # mode = 32-bit signed real by default
                             0, 0, 0, # nxstart, nystart, nzstart
                             1, 1, 1, # mx, my, mz
                             ax, ay, az, # cella
@@ -227,3 +259,144 @@ def write(f, array, header=None, extended_header=b'', ax=1, ay=1, az=1, alpha=0,
 
 
 
+class RunningStats:
+    """
+    Min, max, mean and standard deviation of arrays seen one block at a
+    time. Each block is summarized in float64 and merged with the running
+    mean and sum of squared deviations by Chan et al.'s pairwise update,
+    which stays accurate for large data far from zero.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.amin = np.inf
+        self.amax = -np.inf
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        x = np.asarray(x)
+        if x.size == 0:
+            return
+        x = x.astype(np.float64)
+        n = x.size
+        mean = float(x.mean())
+        m2 = float(np.square(x - mean).sum())
+        self.amin = min(self.amin, float(x.min()))
+        self.amax = max(self.amax, float(x.max()))
+
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += m2 + delta**2*self.n*n/total
+        self.n = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2/self.n) if self.n > 0 else 0.0
+
+
+class MRCWriter:
+    """
+    Write an MRC file incrementally, one section (ny, nx) or slab
+    (n, ny, nx) at a time, so that files larger than memory can be written.
+    The header is written when the writer is closed, with nz, the min, max,
+    mean and rms (standard deviation) accumulated over everything written.
+
+    f is a path or a seekable binary file. Data are written as dtype, or in
+    the dtype of the first section if dtype is None. If a header is given,
+    it is kept except for the shape, mode, statistics and extended header
+    size. Otherwise one is made with make_header from mz and the cell
+    dimensions.
+
+    If the body of a with block raises, no header is written and a file
+    opened by the writer is removed, so a partial file is never mistaken
+    for a complete one.
+    """
+
+    def __init__(self, f, header=None, extended_header=b'', dtype=np.float32, mz=1
+                , ax=1, ay=1, az=1, alpha=0, beta=0, gamma=0):
+        self.own = not hasattr(f, 'write')
+        self.path = None
+        if self.own:
+            self.path = f
+            f = open(f, 'wb')
+        self.f = f
+        self.header = header
+        self.extended_header = extended_header
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.mz = mz
+        self.cella = (ax, ay, az)
+        self.cellb = (alpha, beta, gamma)
+
+        self.nz = 0
+        self.shape = None
+        self.stats = RunningStats()
+
+        ## reserve the header, which is written on close
+        self.start = f.tell()
+        f.write(b'\x00'*1024)
+        f.write(extended_header)
+
+    def write(self, x):
+        x = np.asarray(x)
+        if x.ndim == 2:
+            x = x[np.newaxis]
+        if self.shape is None:
+            self.shape = x.shape[1:]
+            if self.dtype is None:
+                self.dtype = x.dtype
+        elif x.shape[1:] != self.shape:
+            raise Exception('Section shape {} does not match {}'.format(x.shape[1:], self.shape))
+
+        x = x.astype(self.dtype, copy=False)
+        self.stats.update(x)
+        self.nz += len(x)
+        self.f.write(np.ascontiguousarray(x).tobytes())
+
+    def close(self):
+        if self.f is None:
+            return
+        ny,nx = self.shape if self.shape is not None else (0, 0)
+        dtype = self.dtype if self.dtype is not None else np.dtype(np.float32)
+        amin,amax,amean,rms = 0, 0, 0, 0
+        if self.stats.n > 0:
+            amin,amax = self.stats.amin, self.stats.amax
+            amean,rms = self.stats.mean, self.stats.std
+
+        if self.header is None:
+            header = make_header((self.nz, ny, nx), self.cella, self.cellb, mz=self.mz, dtype=dtype
+                                , dmin=amin, dmax=amax, dmean=amean, rms=rms
+                                , exthd_size=len(self.extended_header))
+        else:
+            header = self.header._replace(nx=nx, ny=ny, nz=self.nz, mode=get_mode(dtype)
+                                         , amin=amin, amax=amax, amean=amean, rms=rms
+                                         , next=len(self.extended_header))
+
+        end = self.f.tell()
+        self.f.seek(self.start)
+        self.f.write(header_struct.pack(*list(header)))
+        self.f.seek(end)
+        if self.own:
+            self.f.close()
+        self.f = None
+
+    def abort(self):
+        """ stop writing without a header, removing the file if the writer opened it """
+        if self.f is None:
+            return
+        if self.own:
+            self.f.close()
+            os.remove(self.path)
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
@@ -1,12 +1,27 @@
 from __future__ import absolute_import, print_function, division
 
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
 import torch
+import torch.nn.functional as F
+
+from topaz.utils.pipeline import process_pool
 
 
 def batches(X, batch_size=1):
+    """
+    Stack consecutive images into batches of up to batch_size. A batch is
+    cut short whenever the image shape changes, so mixed sizes never fail.
+    """
     batch = []
     for x in X:
-        batch.append(torch.from_numpy(x).float())
+        x = torch.from_numpy(x).float()
+        if len(batch) > 0 and x.shape != batch[0].shape:
+            yield torch.stack(batch, 0)
+            batch = []
+        batch.append(x)
         if len(batch) >= batch_size:
             batch = torch.stack(batch, 0)
             yield batch
@@ -16,25 +31,412 @@ def batches(X, batch_size=1):
         yield batch
 
 
-def score_stream(model, images, use_cuda=False, batch_size=1):
+def bucketed_batches(X, batch_size=1, max_pending=None, pin_memory=False):
+    """
+    Group images by shape into batches of up to batch_size, yielding
+    (indices, batch) where indices are the positions of the batched images
+    in X.
+
+    Images are copied into a preallocated input buffer for their shape, which
+    is reused for the next batch of that shape once the consumer asks for
+    more. At most max_pending images (default 4*batch_size) are held waiting
+    for their bucket to fill. Beyond that, the bucket holding the oldest
+    image is flushed as a partial batch so that results can be returned in
+    input order with bounded delay.
+    """
+    if max_pending is None:
+        max_pending = 4*batch_size
+    max_pending = max(max_pending, batch_size)
+
+    buffers = {} # shape -> (batch_size, *shape) float32 tensor
+    buckets = OrderedDict() # shape -> pending indices, ordered by oldest pending image
+    pending = 0
+
+    def flush(shape):
+        indices = buckets.pop(shape)
+        return indices, buffers[shape][:len(indices)]
+
+    for i,x in enumerate(X):
+        shape = x.shape
+        if shape not in buffers:
+            if len(buffers) >= 8: # release buffers for shapes no longer in flight
+                for key in [key for key in buffers if key not in buckets]:
+                    del buffers[key]
+            buffers[shape] = torch.empty((batch_size,) + shape, pin_memory=pin_memory)
+        indices = buckets.setdefault(shape, [])
+        buffers[shape].numpy()[len(indices)] = x
+        indices.append(i)
+        pending += 1
+
+        if len(indices) >= batch_size:
+            pending -= len(indices)
+            yield flush(shape)
+        elif pending > max_pending:
+            oldest = next(iter(buckets))
+            pending -= len(buckets[oldest])
+            yield flush(oldest)
+
+    while len(buckets) > 0:
+        yield flush(next(iter(buckets)))
+
+
+def tile_size_for_budget(model, memory_budget, batch_size=1, halo=None):
+    """
+    Choose the largest tile size, excluding the halo, for which a batch of
+    batch_size tiles is expected to fit in memory_budget bytes. The estimate
+    assumes a few live float32 activations with the channel count of the
+    widest layer of the model at every pixel of the tile.
+    """
+    if halo is None:
+        halo = model.width//2
+    channels = getattr(model, 'max_channels', None)
+    if channels is None:
+        channels = max([mod.out_channels for mod in model.modules() if hasattr(mod, 'out_channels')] + [1])
+    bytes_per_pixel = 4*4*channels
+    crop = int(np.sqrt(memory_budget/(bytes_per_pixel*batch_size)))
+    tile_size = crop - 2*halo
+    if tile_size < 1:
+        raise ValueError('Memory budget of {} bytes is too small to score even a single pixel tile with a halo of {} pixels'.format(memory_budget, halo))
+    return tile_size
+
+
+def tile_regions(n, tile_size, halo):
+    """
+    Split an axis of length n into tiles of tile_size, yielding the
+    (start, end) of each tile together with the start of its input crop.
+    Every crop has the same length, min(n, tile_size + 2*halo), and is
+    shifted inward at the edges so that the tile keeps at least halo pixels
+    of context on each side that is not an edge of the image.
+    """
+    crop = min(n, tile_size + 2*halo)
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        crop_start = min(max(start - halo, 0), n - crop)
+        yield start, end, crop_start
+
+
+def score_tiled(model, image, tile_size=None, memory_budget=None, halo=None
+               , use_cuda=False, batch_size=1):
+    """
+    Score an image with the filled model one tile at a time. Each tile is
+    scored with a halo of model.width//2 pixels of context, which covers the
+    receptive field of every output pixel in the tile, so the stitched score
+    map is the same as scoring the whole image at once. Tiles are scored in
+    batches of batch_size.
+
+    Either tile_size is given directly or it is chosen to fit memory_budget
+    bytes with tile_size_for_budget.
+    """
+    if halo is None:
+        halo = model.width//2
+    if tile_size is None:
+        tile_size = tile_size_for_budget(model, memory_budget, batch_size=batch_size, halo=halo)
+
+    h,w = image.shape
+    scores = np.empty((h, w), dtype=np.float32)
+    _score_tiles(model, image, scores, tile_size, halo, use_cuda=use_cuda, batch_size=batch_size)
+    return scores
+
+
+def _score_tiles(model, image, scores, tile_size, halo, selected=None, use_cuda=False, batch_size=1):
+    """ score the tiles of image into scores, only those marked in the selected tile grid if given """
+    h,w = image.shape
+    rows = list(tile_regions(h, tile_size, halo))
+    cols = list(tile_regions(w, tile_size, halo))
+    crop_h = min(h, tile_size + 2*halo)
+    crop_w = min(w, tile_size + 2*halo)
+
+    regions = [(r, c) for i,r in enumerate(rows) for j,c in enumerate(cols)
+               if selected is None or selected[i,j]]
+    crops = (image[r[2]:r[2]+crop_h, c[2]:c[2]+crop_w] for r,c in regions)
+
+    with torch.no_grad():
+        for indices,x in bucketed_batches(crops, batch_size=batch_size, pin_memory=use_cuda):
+            x = x.unsqueeze(1)
+            if use_cuda:
+                x = x.cuda()
+            logits = model(x).squeeze(1).cpu().numpy()
+            for k,logit in zip(indices, logits):
+                (i0,i1,a),(j0,j1,b) = regions[k]
+                scores[i0:i1,j0:j1] = logit[i0-a:i1-a,j0-b:j1-b]
+    return len(regions)
+
+
+def score_coarse(model, image, use_cuda=False):
+    """
+    Score an image with the unfilled, strided model. The image is padded by
+    model.width//2 like the filled model pads its input, so entry (i,j) of
+    the coarse score map equals entry (i*stride, j*stride) of the dense
+    score map.
+    """
+    p = model.width//2
+    with torch.no_grad():
+        x = torch.from_numpy(np.asarray(image, dtype=np.float32))
+        x = F.pad(x.unsqueeze(0).unsqueeze(0), (p,p,p,p))
+        if use_cuda:
+            x = x.cuda()
+        return model(x)[0,0].cpu().numpy()
+
+
+def model_stride(model):
+    """ total stride of an unfilled model, the factor by which fill() densifies its output """
+    stride = model.fill()
+    model.unfill()
+    return stride
+
+
+def _space_to_batch(x, stride):
+    """ split x into its stride**2 shifted subsamplings, stacked along the batch """
+    b,c,h,w = x.shape
+    n = (h + stride - 1)//stride
+    m = (w + stride - 1)//stride
+    x = F.pad(x, (0, m*stride - w, 0, n*stride - h))
+    x = x.view(b, c, n, stride, m, stride).permute(3, 5, 0, 1, 2, 4)
+    return x.reshape(stride*stride*b, c, n, m)
+
+
+def _batch_to_space(x, stride):
+    """ interleave the stride**2 shifted subsamplings stacked by _space_to_batch """
+    _,c,n,m = x.shape
+    x = x.view(stride, stride, -1, c, n, m).permute(2, 3, 4, 0, 5, 1)
+    return x.reshape(-1, c, n*stride, m*stride)
+
+
+def score_shift_stitch(model, image, use_cuda=False):
+    """
+    Score every pixel of an image with the unfilled, strided model by
+    shift and stitch. Each strided layer is run without its stride and its
+    output is split into the stride**2 shifted subsamplings, stacked along
+    the batch, so that every following layer runs as an ordinary
+    convolution over all of the shifted copies. The copies are interleaved
+    back into a dense score map at the end.
+
+    This gives the same scores as the filled model, which instead dilates
+    every layer after a stride. The model must be unfilled.
+    """
+    ## the layers that carry a stride, the innermost modules with fill()
+    layers = [mod for mod in model.modules() if hasattr(mod, 'fill')
+              and not any(hasattr(child, 'fill') for child in list(mod.modules())[1:])]
+
+    if not all(hasattr(layer, 'stride') for layer in layers):
+        ## strides are not exposed per layer, so score with the filled model
+        model.fill()
+        try:
+            with torch.no_grad():
+                x = torch.from_numpy(np.asarray(image, dtype=np.float32)).unsqueeze(0).unsqueeze(0)
+                if use_cuda:
+                    x = x.cuda()
+                return model(x)[0,0].cpu().numpy()
+        finally:
+            model.unfill()
+
+    layer_strides = {layer: layer.stride for layer in layers}
+    strides = []
+    def split(layer, inputs, output):
+        stride = layer_strides[layer]
+        if stride > 1:
+            strides.append(stride)
+            return _space_to_batch(output, stride)
+
+    handles = [layer.register_forward_hook(split) for layer in layers]
+    try:
+        for layer in layers:
+            layer.fill(1) # remove the stride without dilating
+
+        p = model.width//2
+        h,w = image.shape
+        with torch.no_grad():
+            x = torch.from_numpy(np.asarray(image, dtype=np.float32))
+            x = F.pad(x.unsqueeze(0).unsqueeze(0), (p,p,p,p))
+            if use_cuda:
+                x = x.cuda()
+            y = model(x)
+            for stride in strides[::-1]:
+                y = _batch_to_space(y, stride)
+            y = y[0,0,:h,:w].cpu().numpy()
+    finally:
+        for handle in handles:
+            handle.remove()
+        for layer in layers:
+            layer.unfill()
+
+    return np.ascontiguousarray(y)
+
+
+def score_coarse_to_fine(model, image, threshold, margin=None, tile_size=None
+                        , use_cuda=False, batch_size=1):
+    """
+    Score an image in two stages. The unfilled, strided model first scores
+    the image on a grid of stride pixels. The filled model then scores, at
+    every pixel, only the tiles within margin pixels (default: stride) of a
+    grid point scoring above threshold. Pixels outside the refined tiles are
+    set to -inf. Tiles are tile_size pixels (default: 4*(model.width//2)).
+    If scoring the refined tiles with their halos would cost more than
+    scoring the whole image, the whole image is scored instead.
+
+    The threshold should be looser than the extraction threshold, since a
+    dense peak can sit up to stride/2 pixels from the nearest grid point.
+    The model must be unfilled when called and is left unfilled.
+
+    Returns the score map and the fraction of tiles that were refined.
+    """
+    stride = model_stride(model)
+    if margin is None:
+        margin = stride
+    halo = model.width//2
+    if tile_size is None:
+        tile_size = 4*halo
+
+    coarse = score_coarse(model, image, use_cuda=use_cuda)
+
+    ## mark the tiles covering a window of margin pixels around every candidate
+    h,w = image.shape
+    selected = np.zeros(((h + tile_size - 1)//tile_size, (w + tile_size - 1)//tile_size), dtype=bool)
+    ii,jj = np.nonzero(coarse > threshold)
+    ii = ii*stride
+    jj = jj*stride
+    for i0,i1,j0,j1 in zip(np.maximum(ii - margin, 0)//tile_size, np.minimum(ii + margin, h - 1)//tile_size
+                          , np.maximum(jj - margin, 0)//tile_size, np.minimum(jj + margin, w - 1)//tile_size):
+        selected[i0:i1+1,j0:j1+1] = True
+
+    scores = np.full((h, w), -np.inf, dtype=np.float32)
+    crop_size = min(h, tile_size + 2*halo)*min(w, tile_size + 2*halo)
+    model.fill()
+    try:
+        if selected.sum()*crop_size < h*w:
+            _score_tiles(model, image, scores, tile_size, halo, selected=selected
+                        , use_cuda=use_cuda, batch_size=batch_size)
+        else:
+            selected[:] = True
+            with torch.no_grad():
+                x = torch.from_numpy(np.asarray(image, dtype=np.float32)).unsqueeze(0).unsqueeze(0)
+                if use_cuda:
+                    x = x.cuda()
+                scores = model(x)[0,0].cpu().numpy()
+    finally:
+        model.unfill()
+
+    return scores, selected.mean()
+
+
+def score_stream(model, images, use_cuda=False, batch_size=1, max_pending=None
+                , tile_size=None, memory_budget=None):
+    """
+    Score images with the model, batching images of the same shape together.
+    Score maps are yielded in the order of the input images.
+
+    If tile_size or memory_budget is given, each image is instead scored
+    tile by tile with score_tiled and the tiles are batched.
+    """
+    if tile_size is not None or memory_budget is not None:
+        for image in images:
+            yield score_tiled(model, image, tile_size=tile_size, memory_budget=memory_budget
+                             , use_cuda=use_cuda, batch_size=batch_size)
+        return
+
+    results = {}
+    n = 0
     with torch.no_grad():
-        for x in batches(images, batch_size=batch_size):
+        for indices,x in bucketed_batches(images, batch_size=batch_size, max_pending=max_pending
+                                         , pin_memory=use_cuda):
             x = x.unsqueeze(1)
             if use_cuda:
                 x = x.cuda()
             logits = model(x).squeeze(1).cpu().numpy()
-            for i in range(len(logits)):
-                yield logits[i]
+            for i,logit in zip(indices, logits):
+                results[i] = logit
+            while n in results:
+                yield results.pop(n)
+                n += 1
 
 
-def score(model, images, use_cuda=False, batch_size=1):
+def score(model, images, use_cuda=False, batch_size=1, tile_size=None, memory_budget=None):
     scores = []
-    for y in score_stream(model, images, use_cuda=use_cuda, batch_size=batch_size):
+    for y in score_stream(model, images, use_cuda=use_cuda, batch_size=batch_size
+                         , tile_size=tile_size, memory_budget=memory_budget):
         scores.append(y)
     return scores
 
 
+class Scorer:
+    """
+    Callable scoring (name, image) pairs with the classifier at path model,
+    or the pretrained model of that name, and returning (name, score).
+    Images are scored densely with the filled model, or its compiled
+    artifact if one is cached, in tiles if tile_size or memory_budget is
+    given. dense_mode='stitch' scores them with score_shift_stitch instead
+    and a coarse_threshold scores them with score_coarse_to_fine.
+
+    Only the options are pickled, so each worker process of a pool loads
+    its own copy of the model on first use. Images given as None are passed
+    through unscored.
+    """
+
+    def __init__(self, model, use_cuda=False, batch_size=1, tile_size=None, memory_budget=None
+                , dense_mode='fill', coarse_threshold=None, refine_margin=None
+                , compiled=True, compiled_dtype='float32'):
+        self.path = model
+        self.use_cuda = use_cuda
+        self.batch_size = batch_size
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+        self.dense_mode = dense_mode
+        self.coarse_threshold = coarse_threshold
+        self.refine_margin = refine_margin
+        self.compiled = compiled
+        self.compiled_dtype = compiled_dtype
+        self._model = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_model'] = None
+        return state
+
+    @property
+    def filled(self):
+        """ whether images are scored with the filled model """
+        return self.coarse_threshold is None and self.dense_mode == 'fill'
 
+    def model(self):
+        if self._model is None:
+            if self.filled:
+                from topaz.model.compiled import load_filled_model
+                model = load_filled_model(self.path, use_cuda=self.use_cuda, compiled=self.compiled
+                                         , dtype=self.compiled_dtype)
+            else:
+                from topaz.model.factory import load_model
+                model = load_model(self.path)
+                model.eval()
+                if self.use_cuda:
+                    model.cuda()
+            self._model = model
+        return self._model
 
+    def __call__(self, args):
+        name,image = args
+        if image is None:
+            return name, None
+        model = self.model()
+        if self.coarse_threshold is not None:
+            score,_ = score_coarse_to_fine(model, image, self.coarse_threshold, margin=self.refine_margin
+                                          , use_cuda=self.use_cuda, batch_size=self.batch_size)
+        elif self.dense_mode == 'stitch':
+            score = score_shift_stitch(model, image, use_cuda=self.use_cuda)
+        else:
+            score, = score_stream(model, [image], use_cuda=self.use_cuda, batch_size=self.batch_size
+                                 , tile_size=self.tile_size, memory_budget=self.memory_budget)
+        return name, score
 
 
+def scoring_pool(num_workers, num_threads=0):
+    """
+    Pool of num_workers processes for scoring with a Scorer, each with its
+    own budget of num_threads pytorch threads. With num_threads=0, the
+    cores are divided evenly among the workers and with num_threads < 0,
+    every worker uses all of them.
+    """
+    if num_threads < 0:
+        num_threads = multiprocessing.cpu_count()
+    elif num_threads == 0:
+        num_threads = max(multiprocessing.cpu_count()//num_workers, 1)
+    return process_pool(num_workers, initializer=torch.set_num_threads, initargs=(num_threads,))
@@ -0,0 +1,338 @@
+"""
+Warm inference server for picking and denoising. Jobs are JSON objects
+sent over a Unix socket (one JSON line per connection) or HTTP (POST to /),
+and results are streamed back as one JSON line per micrograph followed by
+a final {"done": true, ...} line.
+
+A pick job looks like
+    {"command": "pick", "paths": [...], "radius": 14, "threshold": -6}
+with optional "model", "max_particles" and "scale". Each result
+line has the image_name and x_coord, y_coord and score lists.
+
+A denoise job looks like
+    {"command": "denoise", "paths": [...], "output": "dir"}
+with optional "model", "suffix", "format", "patch_size", "padding",
+"lowpass" and "normalize". Each result line has the output path.
+
+Models are only loaded from the names and paths the server was started
+with, and denoised micrographs are only written inside the server's
+output root, "output" being a directory relative to it.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from topaz.utils.data.loader import load_image
+from topaz.algorithms import non_maximum_suppression
+
+
+class InferenceWorker:
+    """
+    Single thread owning the warm models. Jobs that are waiting when the
+    thread becomes free are taken together, and pick jobs for the same
+    model are scored as one batched stream.
+    """
+
+    def __init__(self, picker='resnet16', denoiser='unet', batch_size=8, use_cuda=False
+                , pickers=(), denoisers=()):
+        self.picker = picker
+        self.denoiser = denoiser
+        ## models that jobs may use, the defaults and any others given
+        self.allowed = {'pick': set(_model_key(m) for m in [picker] + list(pickers))
+                       , 'denoise': set(_model_key(m) for m in [denoiser] + list(denoisers))}
+        self.batch_size = batch_size
+        self.use_cuda = use_cuda
+        self.models = {}
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_allowed(self, kind, name):
+        return _model_key(name) in self.allowed.get(kind, ())
+
+    def model(self, kind, name):
+        """ load models on first use and keep them for later jobs """
+        if not self.is_allowed(kind, name):
+            raise Exception('Model not allowed: {}'.format(name))
+        key = (kind, _model_key(name))
+        if key not in self.models:
+            self.models[key] = self.load(kind, name)
+        return self.models[key]
+
+    def load(self, kind, name):
+        if kind == 'pick':
+            from topaz.model.compiled import load_filled_model
+            return load_filled_model(name, use_cuda=self.use_cuda)
+        import topaz.denoise as dn
+        model = dn.load_model(name)
+        model.eval()
+        if self.use_cuda:
+            model.cuda()
+        return model
+
+    def warm(self, kind, name):
+        """ load a model in the worker thread ahead of the first job """
+        return self.submit(kind, name, None, {})
+
+    def submit(self, kind, name, image, params):
+        future = Future()
+        self.jobs.put((kind, name, image, params, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for job in batch:
+                groups.setdefault(job[:2], []).append(job)
+            for (kind,name),jobs in groups.items():
+                try:
+                    model = self.model(kind, name)
+                    jobs = [job for job in jobs if not self._warmed(job)]
+                    if kind == 'pick':
+                        self._pick(model, jobs)
+                    else:
+                        self._denoise(model, jobs)
+                except Exception as e:
+                    for job in jobs:
+                        if not job[4].done():
+                            job[4].set_exception(e)
+
+    @staticmethod
+    def _warmed(job):
+        if job[2] is None:
+            job[4].set_result(None)
+            return True
+        return False
+
+    def _pick(self, model, jobs):
+        import topaz.predict
+        images = [job[2] for job in jobs]
+        scores = topaz.predict.score_stream(model, images, use_cuda=self.use_cuda
+                                           , batch_size=self.batch_size)
+        for job,score in zip(jobs, scores):
+            job[4].set_result(score)
+
+    def _denoise(self, model, jobs):
+        from topaz.commands.denoise import denoise_image
+        for _,_,image,params,future in jobs:
+            try:
+                future.set_result(denoise_image(image, [model], use_cuda=self.use_cuda, **params))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def _model_key(name):
+    """ model files are identified by their absolute path, pretrained models by name """
+    if os.path.exists(name):
+        return os.path.realpath(name)
+    return name
+
+
+def _image_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _inside(path, root):
+    root = os.path.realpath(root)
+    return os.path.commonpath([os.path.realpath(path), root]) == root
+
+
+save_formats = ['mrc', 'tiff', 'tif', 'png', 'jpg', 'jpeg']
+
+
+def run_job(job, worker, write, depth=4, output_root=None):
+    """
+    Run a job on the worker, calling write with each result as it is ready.
+    Up to depth micrographs of a job are loaded and queued ahead, so they
+    can be batched with each other and with other jobs. Denoised
+    micrographs are written inside output_root, denoise jobs are rejected
+    if it is None.
+    """
+    command = job.get('command', 'pick')
+    paths = job.get('paths', [])
+    if command not in ['pick', 'denoise']:
+        write({'done': True, 'error': 'Unknown command: {}'.format(command)})
+        return
+
+    name = job.get('model', worker.picker if command == 'pick' else worker.denoiser)
+    if not worker.is_allowed(command, name):
+        write({'done': True, 'error': 'Model not allowed: {}'.format(name)})
+        return
+
+    if command == 'pick':
+        radius = job.get('radius')
+        if radius is None:
+            write({'done': True, 'error': 'pick jobs require a radius'})
+            return
+        threshold = job.get('threshold', -6)
+        max_particles = job.get('max_particles')
+        scale = job.get('scale', 1)
+        params = {}
+    else:
+        params = {'lowpass': job.get('lowpass', 1), 'patch_size': job.get('patch_size', 1024)
+                 , 'padding': job.get('padding', 500), 'normalize': job.get('normalize', False)}
+        suffix = job.get('suffix', '')
+        format_ = job.get('format', 'mrc')
+        if output_root is None:
+            write({'done': True, 'error': 'denoise jobs require the server to have an output root'})
+            return
+        output = os.path.join(output_root, job.get('output', ''))
+        if not _inside(output, output_root) or os.sep in suffix:
+            write({'done': True, 'error': 'output must be inside the output root'})
+            return
+        if format_ not in save_formats:
+            write({'done': True, 'error': 'Unknown format: {}'.format(format_)})
+            return
+        if not os.path.exists(output):
+            os.makedirs(output)
+
+    def finish(path, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            return {'path': path, 'error': str(e)}
+
+        if command == 'pick':
+            score,coords = non_maximum_suppression(result, radius, threshold=threshold
+                                                  , max_peaks=max_particles)
+            if scale != 1:
+                coords = np.round(coords*scale).astype(int)
+            return {'path': path, 'image_name': _image_name(path)
+                   , 'x_coord': coords[:,0].tolist(), 'y_coord': coords[:,1].tolist()
+                   , 'score': score.tolist()}
+
+        from topaz.utils.image import save_image
+        out_path = os.path.join(output, _image_name(path) + suffix + '.' + format_)
+        save_image(result, out_path)
+        return {'path': path, 'output': out_path}
+
+    tic = time.time()
+    count = 0
+    pending = deque()
+    for path in paths:
+        try:
+            image = load_image(path).astype(np.float32, copy=False)
+            pending.append((path, worker.submit(command, name, image, params)))
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            pending.append((path, future))
+        while len(pending) > depth or (len(pending) > 0 and pending[0][1].done()):
+            write(finish(*pending.popleft()))
+            count += 1
+    while len(pending) > 0:
+        write(finish(*pending.popleft()))
+        count += 1
+
+    write({'done': True, 'count': count, 'time': time.time() - tic})
+
+
+def _line(result):
+    return (json.dumps(result) + '\n').encode()
+
+
+class UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            job = json.loads(line.decode())
+        except ValueError as e:
+            self.log_message('invalid job: %s', e)
+            self.wfile.write(_line({'done': True, 'error': 'Invalid job: {}'.format(e)}))
+            return
+        self.log_message('%s job with %d paths', job.get('command', 'pick'), len(job.get('paths', [])))
+        def write(result):
+            self.wfile.write(_line(result))
+            self.wfile.flush()
+        run_job(job, self.server.worker, write, depth=self.server.depth
+               , output_root=self.server.output_root)
+
+    def log_message(self, format, *args):
+        ## same format as the HTTP log, there is no client address on a Unix socket
+        if self.server.verbose:
+            sys.stderr.write('unix - - [%s] %s\n' % (time.strftime('%d/%b/%Y %H:%M:%S'), format % args))
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            job = json.loads(self.rfile.read(length).decode())
+        except ValueError as e:
+            self.send_error(400, 'Invalid job: {}'.format(e))
+            return
+        ## stream the results line by line until the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        def write(result):
+            self.wfile.write(_line(result))
+            self.wfile.flush()
+        run_job(job, self.server.worker, write, depth=self.server.depth
+               , output_root=self.server.output_root)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(worker, socket_path=None, host='127.0.0.1', port=None, depth=4, verbose=False
+               , output_root=None):
+    """
+    Serve jobs on a Unix socket if socket_path is given, otherwise over
+    HTTP on host:port. Denoised micrographs are written inside output_root.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixServer(socket_path, UnixHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), HTTPHandler)
+    server.worker = worker
+    server.depth = depth
+    server.verbose = verbose
+    server.output_root = output_root
+    return server
+
+
+def request(job, socket_path):
+    """ send a job to a server on a Unix socket, yielding the results as they arrive """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall(_line(job))
+        with sock.makefile('rb') as f:
+            for line in f:
+                yield json.loads(line.decode())
+    finally:
+        sock.close()
+
@@ -0,0 +1,99 @@
+from __future__ import print_function,division
+
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import topaz.mrc as mrc
+from topaz.utils.pipeline import thread_map
+from topaz.utils.data.loader import is_mrc
+
+ImageInfo = namedtuple('ImageInfo', 'path size mtime width height depth dtype mode pixel_size')
+
+columns = list(ImageInfo._fields)
+
+## numpy dtypes of the PIL image modes
+pil_dtypes = {'1': 'bool', 'L': 'uint8', 'P': 'uint8', 'I;16': 'uint16', 'I;16B': 'uint16'
+             , 'I': 'int32', 'F': 'float32', 'RGB': 'uint8', 'RGBA': 'uint8'}
+
+
+def read_info(path):
+    """
+    Read the shape, dtype, mode and pixel size of an image from the MRC
+    header or the TIFF/PNG header tags, without decoding any pixels. The
+    pixel size (in the units of the MRC cell, usually Angstroms) is NaN
+    when the file does not record one.
+    """
+    st = os.stat(path)
+    if is_mrc(path):
+        with open(path, 'rb') as f:
+            header,_ = mrc.read_header(f)
+        width,height,depth = header.nx, header.ny, header.nz
+        dtype = str(np.dtype(mrc.get_dtype(header.mode)))
+        mode = str(header.mode)
+        pixel_size = np.nan
+        if header.mx > 0 and header.xlen > 0:
+            pixel_size = header.xlen/header.mx
+    else:
+        with Image.open(path) as im: # only the header is parsed until pixels are accessed
+            width,height = im.size
+            depth = getattr(im, 'n_frames', 1)
+            mode = im.mode
+        dtype = pil_dtypes.get(mode, '')
+        pixel_size = np.nan
+    return ImageInfo(path, st.st_size, st.st_mtime, width, height, depth, dtype, mode, pixel_size)
+
+
+def load_catalog(path):
+    """ read a catalog written by save_catalog, indexed by image path """
+    ## modification times are compared exactly, so they must parse back to the same floats
+    table = pd.read_csv(path, sep='\t', dtype={'mode': str, 'dtype': str}, float_precision='round_trip')
+    return table.set_index('path', drop=False)
+
+
+def save_catalog(table, path):
+    """ write the catalog, replacing any existing one in a single step """
+    dirname = os.path.dirname(path)
+    if dirname != '' and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_path = path + '.tmp'
+    table.to_csv(tmp_path, sep='\t', index=False, columns=columns)
+    os.replace(tmp_path, path)
+
+
+def scan(paths, num_workers=8, catalog=None):
+    """
+    Read the header metadata of each image in paths with num_workers
+    threads, returning a DataFrame with one ImageInfo row per path in
+    order. If catalog is the path of a persistent catalog, images whose
+    size and modification time match their entry are not read again and
+    the catalog is updated with the new entries.
+    """
+    paths = list(paths)
+    known = None
+    if catalog is not None and os.path.exists(catalog):
+        known = load_catalog(catalog)
+
+    def info(path):
+        if known is not None and path in known.index:
+            entry = known.loc[path]
+            if isinstance(entry, pd.DataFrame): # duplicated path, use the last entry
+                entry = entry.iloc[-1]
+            st = os.stat(path)
+            if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                return ImageInfo(*[entry[c] for c in columns])
+        return read_info(path)
+
+    infos = list(thread_map(info, paths, num_workers=num_workers, depth=2*num_workers))
+    table = pd.DataFrame(infos, columns=columns)
+
+    if catalog is not None:
+        merged = table
+        if known is not None: # keep the entries of images that were not scanned this time
+            merged = pd.concat([known.loc[~known.index.isin(table.path)], table], ignore_index=True)
+        save_catalog(merged.drop_duplicates('path', keep='last'), catalog)
+
+    return table
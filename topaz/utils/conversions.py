@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 
 def mirror_y_axis(coords, n):
-    coords = coords.clone()
+    coords = coords.copy()
     coords['y_coord'] = n-1-coords['y_coord']
     return coords
 
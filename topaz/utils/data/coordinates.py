@@ -36,7 +36,7 @@ def match_coordinates_to_images(coords, images, radius=-1):
                 xy = this_coords.get(name, null_coords)
                 if radius >= 0:
                     radii = np.array([radius]*len(xy), dtype=np.int32)
-                    shape = (im.height, im.width)
+                    shape = im.shape
                     xy = as_mask(shape, xy[:,0], xy[:,1], radii)
                 this_matched[name] = (im,xy)
     else:
@@ -45,7 +45,7 @@ def match_coordinates_to_images(coords, images, radius=-1):
             xy = coords.get(name, null_coords)
             if radius >= 0:
                 radii = np.array([radius]*len(xy), dtype=np.int32)
-                shape = (im.height, im.width)
+                shape = im.shape
                 xy = as_mask(shape, xy[:,0], xy[:,1], radii)
             matched[name] = (im,xy)
 
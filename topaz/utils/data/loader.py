@@ -1,7 +1,9 @@
 from __future__ import print_function, division
 
 import os
-import glob
+import fnmatch
+import functools
+from collections import OrderedDict
 
 import numpy as np
 from PIL import Image
@@ -9,6 +11,7 @@ import torch
 
 import topaz.mrc as mrc
 from topaz.utils.image import unquantize
+from topaz.utils.pipeline import thread_map
 
 class ImageDirectoryLoader:
     def __init__(self, rootdir, pathspec=os.path.join('{source}', '{image_name}'), format='tiff'
@@ -22,21 +25,8 @@ class ImageDirectoryLoader:
         ext = self.pathspec.format(*args, **kwargs) + '.' + self.format
         path = os.path.join(self.rootdir, ext)
         if self.format == 'mrc':
-            with open(path, 'rb') as f:
-                content = f.read()
-            image, header, extended_header = mrc.parse(content)
-            if self.standardize:
-                image = image - header.amean
-                image /= header.rms
-        else:
-            image = Image.open(path)
-            fp = image.fp
-            image.load()
-            fp.close()
-            image = np.array(image, copy=False)
-            if self.standardize:
-                image = (image - image.mean())/image.std()
-        return Image.fromarray(image)
+            return load_mrc(path, standardize=self.standardize)
+        return load_tiff(path, standardize=self.standardize)
 
 class ImageTree:
     def __init__(self, images):
@@ -45,51 +35,40 @@ class ImageTree:
     def get(self, source, name):
         return self.images[source][name]
 
+## images are loaded as numpy arrays of shape (height, width)
+
 def load_mrc(path, standardize=False):
-    with open(path, 'rb') as f:
-        content = f.read()
-    image, header, extended_header = mrc.parse(content)
-    if image.dtype == np.float16:
-        image = image.astype(np.float32)
+    image, header, extended_header = mrc.open_mmap(path)
+    ## read the memory map into memory, float16 images become float32 in the same copy
+    dtype = np.float32 if image.dtype == np.float16 else image.dtype
+    image = np.array(image, dtype=dtype)
     if standardize:
-        image = image - header.amean
+        image = image.astype(np.float32, copy=False)
+        image -= header.amean
         image /= header.rms
-    return Image.fromarray(image)
+    return image
+
+def read_pil(path):
+    with Image.open(path) as image:
+        return np.array(image)
 
 def load_tiff(path, standardize=False):
-    image = Image.open(path)
-    fp = image.fp
-    image.load()
-    fp.close()
+    image = read_pil(path)
     if standardize:
-        image = np.array(image, copy=False)
         image = (image - image.mean())/image.std()
-        image = Image.fromarray(image)
     return image
 
 def load_png(path, standardize=False):
-    image = Image.open(path)
-    fp = image.fp
-    image.load()
-    fp.close()
-    x = np.array(image, copy=False)
-    x = unquantize(x)
+    x = unquantize(read_pil(path))
     if standardize:
         x = (x - x.mean())/x.std()
-    image = Image.fromarray(x)
-    return image
+    return x
 
 def load_jpeg(path, standardize=False):
-    image = Image.open(path)
-    fp = image.fp
-    image.load()
-    fp.close()
-    x = np.array(image, copy=False)
-    x = unquantize(x)
+    x = unquantize(read_pil(path))
     if standardize:
         x = (x - x.mean())/x.std()
-    image = Image.fromarray(x)
-    return image
+    return x
 
 def load_pil(path, standardize=False):
     if path.endswith('.png'):
@@ -98,46 +77,196 @@ def load_pil(path, standardize=False):
         return load_jpeg(path, standardize=standardize)
     return load_tiff(path, standardize=standardize)
 
+def is_mrc(path):
+    """ whether path is an MRC file by its extension, .mrc or .mrcs in any case """
+    return os.path.splitext(path)[1].lower() in ('.mrc', '.mrcs')
+
 def load_image(path, standardize=False):
-    ## this might be more stable as path.endswith('.mrc')
-    ext = os.path.splitext(path)[1]
-    if ext == '.mrc':
+    if is_mrc(path):
         image = load_mrc(path, standardize=standardize)
     else:
         image = load_pil(path, standardize=standardize)
     return image
 
 
-def load_images_from_directory(names, rootdir, sources=None, standardize=False):
-    images = {}
+def index_directory(rootdir, ext='*'):
+    """
+    Map image names to the sorted paths of the files in rootdir named
+    image_name.ext, listing the directory only once. ext may be a glob
+    pattern, '*' matches any extension.
+    """
+    index = {}
+    pattern = '*.' + ext
+    for entry in os.scandir(rootdir):
+        if not fnmatch.fnmatch(entry.name, pattern):
+            continue
+        name = os.path.splitext(entry.name)[0]
+        index.setdefault(name, []).append(os.path.join(rootdir, entry.name))
+    for paths in index.values():
+        paths.sort()
+    return index
+
+
+def find_image(index, name, rootdir):
+    """ first path of the image called name in the index_directory of rootdir """
+    if name not in index:
+        raise Exception('Image not found: no file named {}.* in {}'.format(name, rootdir))
+    return index[name][0]
+
+
+def load_images_from_directory(names, rootdir, sources=None, standardize=False, num_workers=8, stats=None):
+    ## list each directory once rather than globbing for every image
     if sources is not None:
+        indices = {}
+        paths = []
         for source,name in zip(sources, names):
-            path = os.path.join(rootdir, source, name) + '.*'
-            path = glob.glob(path)[0]
-            im = load_image(path, standardize=standardize)
+            if source not in indices:
+                indices[source] = index_directory(os.path.join(rootdir, source))
+            paths.append(find_image(indices[source], name, os.path.join(rootdir, source)))
+    else:
+        index = index_directory(rootdir)
+        paths = [find_image(index, name, rootdir) for name in names]
+    return load_images_from_list(names, paths, sources=sources, standardize=standardize
+                                , num_workers=num_workers, stats=stats)
+
+
+def load_images_from_list(names, paths, sources=None, standardize=False, num_workers=8, stats=None):
+    """
+    Load the images at paths into a dictionary keyed by name, or by source
+    and then name if sources are given. Images are read and decoded by
+    num_workers threads, and stats records the time spent on each image.
+    """
+    load = functools.partial(load_image, standardize=standardize)
+    loaded = list(thread_map(load, paths, num_workers=num_workers, depth=2*num_workers, stats=stats))
+    images = {}
+    if sources is not None:
+        for source,name,im in zip(sources, names, loaded):
             images.setdefault(source, {})[name] = im
     else:
-        for name in names:
-            path = os.path.join(rootdir, name) + '.*'
-            path = glob.glob(path)[0]
-            im = load_image(path, standardize=standardize)
+        for name,im in zip(names, loaded):
             images[name] = im
-    return images 
+    return images
+
 
+class ImageCache:
+    """
+    LRU of decoded micrographs holding at most max_bytes of pixels. Images
+    are (re)loaded from their paths on a miss, MRC files through a memory
+    map so evicted images are cheap to read again. The cache is not shared
+    between DataLoader worker processes, each worker keeps its own.
+    """
 
-def load_images_from_list(names, paths, sources=None, standardize=False):
+    def __init__(self, max_bytes, standardize=False):
+        self.max_bytes = max_bytes
+        self.standardize = standardize
+        self.images = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        ## copies sent to other processes start empty
+        state = self.__dict__.copy()
+        state['images'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+    def __contains__(self, path):
+        return path in self.images
+
+    def get(self, path):
+        if path in self.images:
+            self.images.move_to_end(path)
+            self.hits += 1
+            return self.images[path]
+
+        self.misses += 1
+        im = load_image(path, standardize=self.standardize)
+        ## evict the least recently used images, always keeping the newest
+        while len(self.images) > 0 and self.nbytes + im.nbytes > self.max_bytes:
+            _,evicted = self.images.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        self.images[path] = im
+        self.nbytes += im.nbytes
+        return im
+
+
+def decoded_dtype(path, dtype, standardize=False):
+    """
+    dtype of the array load_image returns for the image at path, stored
+    as dtype in the file, e.g. the dtype of a catalog scan
+    """
+    ext = os.path.splitext(path)[1].lower()
+    ## unknown dtypes, empty or missing in a catalog, are taken as float32
+    if standardize or not isinstance(dtype, str) or dtype in ('', 'float16') or ext in ('.png', '.jpeg', '.jpg'):
+        return np.dtype(np.float32)
+    return np.dtype(dtype)
+
+
+class CachedImage:
+    """
+    Stand in for an image array loaded through an ImageCache. The width,
+    height and dtype are known up front, so labels can be made and the
+    cache sized without reading the image, and the pixels are only loaded
+    when the image is converted to an array with np.asarray.
+    """
+
+    def __init__(self, path, width, height, cache, dtype=np.float32):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.cache = cache
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def nbytes(self):
+        """ bytes of the decoded image in the cache """
+        return self.width*self.height*self.dtype.itemsize
+
+    def load(self):
+        return self.cache.get(self.path)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.load(), dtype=dtype)
+
+
+def cache_images_from_list(names, paths, widths, heights, cache, sources=None, dtypes=None):
+    """
+    Like load_images_from_list, but the images are CachedImages read
+    through cache when they are used. The image sizes and, if given, the
+    dtypes stored in the files are known, usually from a catalog scan, so
+    nothing is read here.
+    """
+    if dtypes is None:
+        dtypes = ['float32']*len(paths)
+    dtypes = [decoded_dtype(path, dtype, standardize=cache.standardize) for path,dtype in zip(paths, dtypes)]
     images = {}
-    if sources is not None:
-        for source,name,path in zip(sources, names, paths):
-            im = load_image(path, standardize=standardize)
-            images.setdefault(source, {})[name] = im
+    if sources is None:
+        for name,path,width,height,dtype in zip(names, paths, widths, heights, dtypes):
+            images[name] = CachedImage(path, width, height, cache, dtype=dtype)
     else:
-        for name,path in zip(names, paths):
-            im = load_image(path, standardize=standardize)
-            images[name] = im
+        for source,name,path,width,height,dtype in zip(sources, names, paths, widths, heights, dtypes):
+            images.setdefault(source, {})[name] = CachedImage(path, width, height, cache, dtype=dtype)
     return images
 
 
+def crop(x, xmi, ymi, xma, yma):
+    """ the [ymi:yma, xmi:xma] region of x, padded with zeros where it extends past the edges """
+    n,m = x.shape[:2]
+    if xmi >= 0 and ymi >= 0 and xma <= m and yma <= n:
+        return x[ymi:yma, xmi:xma]
+    region = np.zeros((yma-ymi, xma-xmi) + x.shape[2:], dtype=x.dtype)
+    i0,j0 = max(ymi, 0), max(xmi, 0)
+    i1,j1 = min(yma, n), min(xma, m)
+    if i0 < i1 and j0 < j1:
+        region[i0-ymi:i1-ymi, j0-xmi:j1-xmi] = x[i0:i1, j0:j1]
+    return region
+
+
 class LabeledRegionsDataset:
     def __init__(self, images, labels, crop):
         self.images = images
@@ -146,8 +275,8 @@ class LabeledRegionsDataset:
 
         # precalculate the number of regions
         n = len(self.images)
-        im = self.images[0]
-        self.size = im.width*im.height
+        height,width = self.images[0].shape[:2]
+        self.size = width*height
         self.n = n*self.size
 
     def __len__(self):
@@ -155,20 +284,21 @@ class LabeledRegionsDataset:
 
     def __getitem__(self, k):
         i = k//self.size
-        im = self.images[i]
+        im = np.asarray(self.images[i])
 
         j = k % self.size
 
         label = self.labels[i].ravel()[j]
 
         ## crop the image
-        x = j % im.width
-        y = j // im.width
+        width = im.shape[1]
+        x = j % width
+        y = j // width
         xmi = x - self.crop//2
         xma = xmi + self.crop
         ymi = y - self.crop//2
         yma = ymi + self.crop
-        im = im.crop((xmi, ymi, xma, yma))
+        im = crop(im, xmi, ymi, xma, yma)
 
         return im, label
 
@@ -193,18 +323,19 @@ class LabeledImageCropDataset:
 
         #g, (i, coord) = idx
 
-        im = self.images[g][i]
+        im = np.asarray(self.images[g][i])
         L = torch.from_numpy(self.labels[g][i].ravel()).unsqueeze(1)
         label = L[coord].float()
 
         ## crop the image
-        x = coord % im.width
-        y = coord // im.width
+        width = im.shape[1]
+        x = coord % width
+        y = coord // width
         xmi = x - self.crop//2
         xma = xmi + self.crop
         ymi = y - self.crop//2
         yma = ymi + self.crop
-        im = im.crop((xmi, ymi, xma, yma))
+        im = crop(im, xmi, ymi, xma, yma)
 
         return im, label
 
@@ -227,8 +358,8 @@ class SegmentedImageDataset:
         label = self.labels[j][i]
 
         if self.to_tensor:
-            im = torch.from_numpy(np.array(im, copy=False))
-            label = torch.from_numpy(np.array(label, copy=False)).float()
+            im = torch.from_numpy(np.asarray(im))
+            label = torch.from_numpy(np.asarray(label)).float()
 
         return im, label
 
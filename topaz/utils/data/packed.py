@@ -0,0 +1,89 @@
+from __future__ import print_function,division
+
+import os
+import json
+import struct
+
+import numpy as np
+
+"""
+Single file datasets made by topaz pack. The file starts with a 64 byte
+header holding the magic string, the offset and the length of the index,
+followed by the arrays, each starting on a 64 byte boundary, and finally
+the JSON index. The index is written last so that micrographs can be
+packed one at a time.
+"""
+
+MAGIC = b'TOPAZPK1'
+ALIGN = 64
+header_struct = struct.Struct('<8sQQ')
+
+
+class PackWriter:
+    """
+    Writes arrays to a packed file. add returns the index entry of the
+    array and close writes the index with the given metadata. The file is
+    written next to path and moved into place on close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.f = open(self.tmp_path, 'wb')
+        self.f.write(b'\0'*ALIGN)
+        self.offset = ALIGN
+
+    def add(self, x):
+        x = np.ascontiguousarray(x)
+        self.f.write(x.tobytes())
+        entry = {'offset': self.offset, 'shape': list(x.shape), 'dtype': x.dtype.str}
+        self.offset += x.nbytes
+        ## pad to the alignment of the next array
+        pad = -self.offset % ALIGN
+        self.f.write(b'\0'*pad)
+        self.offset += pad
+        return entry
+
+    def close(self, index):
+        data = json.dumps(index).encode()
+        self.f.write(data)
+        self.f.seek(0)
+        self.f.write(header_struct.pack(MAGIC, self.offset, len(data)))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            return
+        ## discard the partial file
+        self.f.close()
+        os.remove(self.tmp_path)
+
+
+class PackedFile:
+    """
+    Packed file opened as one copy-on-write memory map. Arrays are views
+    into the map, so nothing is read until the array is used and writing
+    to an array never changes the file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic,offset,length = header_struct.unpack(f.read(header_struct.size))
+            if magic != MAGIC:
+                raise Exception('Not a packed dataset: ' + path)
+            f.seek(offset)
+            self.index = json.loads(f.read(length).decode())
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='c')
+
+    def array(self, entry):
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        start = entry['offset']
+        end = start + int(np.prod(shape))*dtype.itemsize
+        return self.buffer[start:end].view(dtype).reshape(shape)
+
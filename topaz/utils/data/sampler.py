@@ -3,59 +3,87 @@ from __future__ import print_function, division
 import os
 
 import numpy as np
-from PIL import Image
 
 import torch
+import torch.nn.functional as F
 import torch.utils.data
 
-def enumerate_pn_coordinates(Y):
+coordinate_dtype = [('image', np.uint32), ('coord', np.uint32)]
+
+def positive_coordinates(Y):
     """
-    Given a list of 2d arrays containing labels, enumerate the positive and negative coordinates as (image,coordinate) pairs.
+    Given a list of 2d arrays containing labels, the sorted flat indices of the positive coordinates of each.
     """
+    return [np.flatnonzero(np.asarray(y)) for y in Y]
 
-    P_size = int(sum(y.sum() for y in Y)) # number of positive coordinates
-    N_size = sum(y.size for y in Y) - P_size # number of negative coordinates
-
-    P = np.zeros(P_size, dtype=[('image', np.uint32), ('coord', np.uint32)])
-    N = np.zeros(N_size, dtype=[('image', np.uint32), ('coord', np.uint32)])
-
-    i = 0 # P index
-    j = 0 # N index
-    for image in range(len(Y)):
-        y = Y[image].ravel()
-        for coord in range(len(y)):
-            if y[coord]:
-                P[i] = (image, coord)
-                i += 1
-            else:
-                N[j] = (image, coord)
-                j += 1
+def as_coordinates(indices):
+    """
+    Given a list of flat coordinate indices per image, the (image,coordinate) pairs.
+    """
+    counts = [len(idx) for idx in indices]
+    X = np.zeros(sum(counts), dtype=coordinate_dtype)
+    if len(X) > 0:
+        X['image'] = np.repeat(np.arange(len(indices)), counts)
+        X['coord'] = np.concatenate(indices)
+    return X
 
+def enumerate_pn_coordinates(Y):
+    """
+    Given a list of 2d arrays containing labels, enumerate the positive and negative coordinates as (image,coordinate) pairs.
+    """
+    P = as_coordinates(positive_coordinates(Y))
+    N = as_coordinates([np.flatnonzero(np.asarray(y) == 0) for y in Y])
     return P, N
 
 def enumerate_pu_coordinates(Y):
     """
     Given a list of 2d arrays containing labels, enumerate the positive and unlabeled(all) coordinates as (image,coordinate) pairs.
     """
+    P = as_coordinates(positive_coordinates(Y))
+    U = as_coordinates([np.arange(np.size(y)) for y in Y])
+    return P, U
 
-    P_size = int(sum(y.sum() for y in Y)) # number of positive coordinates
-    size = sum(y.size for y in Y)
+class CoordinateSampler:
+    """
+    Samples (image,coordinate) pairs uniformly, with replacement, from all
+    coordinates of images with the given numbers of pixels, except the
+    sorted flat indices in exclude, without enumerating the coordinates.
+    A draw picks the k-th remaining coordinate and finds it by offset
+    arithmetic over the excluded indices, so memory and time depend only
+    on the number of excluded coordinates.
+    """
 
-    P = np.zeros(P_size, dtype=[('image', np.uint32), ('coord', np.uint32)])
-    U = np.zeros(size, dtype=[('image', np.uint32), ('coord', np.uint32)])
+    def __init__(self, sizes, exclude=None, random=np.random):
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        if exclude is None:
+            exclude = [np.zeros(0, dtype=np.int64) for _ in self.sizes]
+        ## the k-th remaining coordinate of image i is k plus the number of
+        ## excluded indices whose count of remaining coordinates before them is <= k
+        self.gaps = [e - np.arange(len(e)) for e in exclude]
+        self.counts = self.sizes - np.array([len(e) for e in exclude], dtype=np.int64)
+        self.offsets = np.cumsum(self.counts)
+        self.random = random
 
-    i = 0 # P index
-    j = 0 # U index
-    for image in range(len(Y)):
-        y = Y[image].ravel()
-        for coord in range(len(y)):
-            if y[coord]:
-                P[i] = (image, coord)
-                i += 1
-            U[j] = (image, coord)
-            j += 1
+    def __len__(self):
+        return int(self.offsets[-1]) if len(self.offsets) > 0 else 0
 
-    return P, U
+    def sample(self, image):
+        """ draw a coordinate of the given image """
+        k = self.random.randint(self.counts[image])
+        return image, k + np.searchsorted(self.gaps[image], k, side='right')
+
+    def __next__(self):
+        k = self.random.randint(len(self))
+        image = np.searchsorted(self.offsets, k, side='right')
+        if image > 0:
+            k -= self.offsets[image-1]
+        return image, k + np.searchsorted(self.gaps[image], k, side='right')
+
+    # for python 2.7 compatability
+    next = __next__
+
+    def __iter__(self):
+        return self
 
 class ShuffledSampler(torch.utils.data.sampler.Sampler):
     def __init__(self, x, random=np.random):
@@ -88,19 +116,20 @@ class StratifiedCoordinateSampler(torch.utils.data.sampler.Sampler):
         proportions = np.zeros((len(labels), 2))
         i = 0
         for group in labels:
+            ## only the positive coordinates are enumerated, the negative or
+            ## unlabeled coordinates are drawn from CoordinateSamplers
+            positives = positive_coordinates(group)
+            num_pixels = [np.size(y) for y in group]
+            P = ShuffledSampler(as_coordinates(positives), random=random)
             if split == 'pn':
-                P,N = enumerate_pn_coordinates(group)
-                P = ShuffledSampler(P, random=random)
-                N = ShuffledSampler(N, random=random)
+                N = CoordinateSampler(num_pixels, exclude=positives, random=random)
                 groups.append(P)
                 groups.append(N)
 
                 proportions[i//2,0] = len(N)/(len(N)+len(P))
                 proportions[i//2,1] = len(P)/(len(N)+len(P))
             elif split  == 'pu':
-                P,U = enumerate_pu_coordinates(group)
-                P = ShuffledSampler(P, random=random)
-                U = ShuffledSampler(U, random=random)
+                U = CoordinateSampler(num_pixels, random=random)
                 groups.append(P)
                 groups.append(U)
 
@@ -129,7 +158,11 @@ class StratifiedCoordinateSampler(torch.utils.data.sampler.Sampler):
     def __len__(self):
         return self.size
 
-    def __next__(self):
+    def choose_group(self, available=None):
+        """
+        choose the next (source, label) group, keeping the draws close to the group weights.
+        if given, only groups where available is True are chosen.
+        """
         n = self.history.sum()
         weights = self.weights
         if n > 0:
@@ -140,17 +173,27 @@ class StratifiedCoordinateSampler(torch.utils.data.sampler.Sampler):
                 weights /= n
             else:
                 weights = np.ones_like(weights)/len(weights)
+        if available is not None:
+            weights = weights*available
+            n = weights.sum()
+            if n > 0:
+                weights = weights/n
+            else:
+                weights = available/available.sum()
 
         i = self.random.choice(len(weights), p=weights)
         self.history[i] += 1
         if np.all(self.history/self.history.sum() == self.weights):
             self.history[:] = 0
+        return i
 
+    def __next__(self):
+        i = self.choose_group()
         g = self.groups[i]
         sample = next(g)
 
         i = i//2
-        j,c = sample
+        j,c = int(sample[0]), int(sample[1])
 
         # code as integer
         # unfortunate hack required because pytorch converts index to integer...
@@ -166,13 +209,134 @@ class StratifiedCoordinateSampler(torch.utils.data.sampler.Sampler):
             yield next(self)
 
 
+class CachedCoordinateSampler(StratifiedCoordinateSampler):
+    """
+    StratifiedCoordinateSampler that only draws from a window of at most
+    capacity micrographs at a time, so the micrographs of an ImageCache
+    that holds capacity images stay resident. Each pass visits the
+    micrographs of every source in a new random order, interleaved so
+    each window has the sources in proportion, and gives each window a
+    share of the draws proportional to its number of micrographs. Within
+    a window, coordinates of the chosen group are drawn uniformly.
+    """
+
+    def __init__(self, labels, capacity, balance=0.5, size=None, random=np.random, split='pn'):
+        super(CachedCoordinateSampler, self).__init__(labels, balance=balance, size=size
+                                                     , random=random, split=split)
+        self.capacity = max(1, capacity)
+        self.num_images = [len(group) for group in labels]
+
+        ## split the positive coordinates of each source by micrograph,
+        ## the CoordinateSamplers draw from a given micrograph directly
+        self.image_groups = []
+        self.image_counts = []
+        for i,g in enumerate(self.groups):
+            if isinstance(g, CoordinateSampler):
+                self.image_groups.append(None)
+                self.image_counts.append(g.counts)
+                continue
+            x = g.x[np.argsort(g.x['image'], kind='stable')]
+            counts = np.bincount(x['image'], minlength=self.num_images[i//2])
+            splits = np.split(x, np.cumsum(counts)[:-1])
+            self.image_groups.append([ShuffledSampler(y, random=random) for y in splits])
+            self.image_counts.append(counts)
+
+        self.windows = []
+        self.remaining = 0
+
+    def make_windows(self):
+        keys = []
+        for source,n in enumerate(self.num_images):
+            order = self.random.permutation(n)
+            keys += [((k + 0.5)/n, source, j) for k,j in enumerate(order)]
+        keys.sort()
+        windows = []
+        for start in range(0, len(keys), self.capacity):
+            window = {}
+            for _,source,j in keys[start:start+self.capacity]:
+                window.setdefault(source, []).append(j)
+            windows.append((start, {k: np.array(v) for k,v in window.items()}))
+        total = len(keys)
+        ## allot the draws of a pass to the windows
+        self.windows = [(int(np.round(self.size*(start + sum(map(len, w.values())))/total))
+                         - int(np.round(self.size*start/total)), w) for start,w in windows]
+
+    def __next__(self):
+        while self.remaining <= 0:
+            if len(self.windows) == 0:
+                self.make_windows()
+            self.remaining,self.window = self.windows.pop(0)
+
+        self.remaining -= 1
+        ## only groups with coordinates in the window, the group history
+        ## makes up for the others in later windows
+        counts = [None]*len(self.weights)
+        for i in range(len(counts)):
+            images = self.window.get(i//2)
+            if images is not None:
+                counts[i] = self.image_counts[i][images]
+        available = np.array([c is not None and c.sum() > 0 for c in counts], dtype=float)
+        i = self.choose_group(available=available)
+        source = i//2
+
+        images = self.window[source]
+        counts = counts[i]
+        j = images[self.random.choice(len(images), p=counts/counts.sum())]
+        if self.image_groups[i] is None:
+            sample = self.groups[i].sample(j)
+        else:
+            sample = next(self.image_groups[i][j])
+        j,c = int(sample[0]), int(sample[1])
+
+        h = source*2**56 + j*2**32 + c
+        return h
+
+    next = __next__
+
+
+def rotate_crop(x, angle, box=None, mode='bilinear'):
+    """
+    Rotate the image x by angle degrees about its center, like PIL's
+    Image.rotate, and return the box=(xmi, ymi, xma, yma) region of the
+    rotated image, padded with zeros. Only the pixels of the region are
+    interpolated, with grid_sample's bilinear or nearest mode.
+    """
+    n,m = x.shape
+    if box is None:
+        box = (0, 0, m, n)
+    xmi,ymi,xma,yma = box
+
+    theta = np.deg2rad(angle)
+    c,s = np.cos(theta), np.sin(theta)
+    cy,cx = (n-1)/2, (m-1)/2
+    i = (np.arange(ymi, yma) - cy)[:,np.newaxis]
+    j = (np.arange(xmi, xma) - cx)[np.newaxis]
+    ## positions in the original image, in the [-1,1] coordinates of grid_sample
+    grid = np.zeros((1, yma-ymi, xma-xmi, 2), dtype=np.float32)
+    if m > 1:
+        grid[...,0] = (c*j - s*i)/cx
+    if n > 1:
+        grid[...,1] = (c*i + s*j)/cy
+
+    x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+    y = F.grid_sample(x[None,None], torch.from_numpy(grid), mode=mode
+                     , padding_mode='zeros', align_corners=True)
+    return y[0,0].numpy()
+
+
 class RandomImageTransforms:
-    def __init__(self, data, rotate=True, flip=True, crop=None, resample=Image.BILINEAR, to_tensor=False):
+    """
+    Random rotation, center crop and mirroring of the (image, label) pairs
+    of data. The images are arrays, labels that are 2d arrays are
+    transformed with the images.
+    """
+
+    def __init__(self, data, rotate=True, flip=True, crop=None, mode='bilinear', to_tensor=False):
         self.data = data
         self.rotate = rotate
         self.flip = flip
         self.crop = crop
-        self.resample = resample
+        self.mode = mode
         self.to_tensor = to_tensor
         self.seeded = False
 
@@ -186,48 +350,47 @@ class RandomImageTransforms:
             self.seeded = True
 
         X, Y = self.data[i]
+        X = np.asarray(X)
+        transform_y = isinstance(Y, np.ndarray) and Y.ndim == 2
 
-        ## random rotation
-        if self.rotate:
-            angle = self.random.uniform(0, 360)
-            X = X.rotate(angle, resample=self.resample)
-            if type(Y) is Image.Image:
-                Y = Y.rotate(angle, resample=Image.NEAREST)
-
-        ## crop down if requested
+        box = None
         if self.crop is not None:
-            width,height = X.size
+            height,width = X.shape
             xmi = (width-self.crop)//2
             xma = xmi+self.crop
             ymi = (height-self.crop)//2
             yma = ymi+self.crop
-            
-            X = X.crop((xmi,ymi,xma,yma))
-            if type(Y) is Image.Image:
-                Y = Y.crop((xmi,ymi,xma,yma))
+            box = (xmi, ymi, xma, yma)
+
+        ## random rotation, cropped down if requested
+        if self.rotate:
+            angle = self.random.uniform(0, 360)
+            X = rotate_crop(X, angle, box=box, mode=self.mode)
+            if transform_y:
+                Y = rotate_crop(Y, angle, box=box, mode='nearest')
+        elif box is not None:
+            X = X[ymi:yma, xmi:xma]
+            if transform_y:
+                Y = Y[ymi:yma, xmi:xma]
 
         ## random mirror of the image
         if self.flip:
             if self.random.uniform() > 0.5:
-                X = X.transpose(Image.FLIP_LEFT_RIGHT)
-                if type(Y) is Image.Image:
-                    Y = Y.transpose(Image.FLIP_LEFT_RIGHT)
+                X = X[:, ::-1]
+                if transform_y:
+                    Y = Y[:, ::-1]
             if self.random.uniform() > 0.5:
-                X = X.transpose(Image.FLIP_TOP_BOTTOM)
-                if type(Y) is Image.Image:
-                    Y = Y.transpose(Image.FLIP_TOP_BOTTOM)
+                X = X[::-1]
+                if transform_y:
+                    Y = Y[::-1]
+
+        X = np.ascontiguousarray(X)
+        if transform_y:
+            Y = np.ascontiguousarray(Y)
 
         if self.to_tensor:
-            X = torch.from_numpy(np.array(X, copy=False))
-            if type(Y) is Image.Image:
-                Y = torch.from_numpy(np.array(Y, copy=False)).float()
+            X = torch.from_numpy(X)
+            if transform_y:
+                Y = torch.from_numpy(Y).float()
 
         return X, Y
-
-
-
-
-
-        
-
-
@@ -20,7 +20,7 @@ def downsample(x, factor=1, shape=None):
     m,n = shape
     A = F[...,0:m//2,0:n//2+1]
     B = F[...,-m//2:,0:n//2+1]
-    F = np.concatenate([A,B], axis=0)
+    F = np.concatenate([A,B], axis=-2)
 
     ## scale the signal from downsampling
     a = n*m
@@ -50,7 +50,8 @@ def unquantize(x, mi=-3, ma=3, dtype=np.float32):
     y = x*(ma-mi)/255 + mi
     return y
 
-def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
+def save_image(x, path, mi=-3, ma=3, f=None, verbose=False, dtype=np.float32):
+    """ save an image in the format given by f or the path extension. dtype is the data type of mrc files """
     if f is None:
         f = os.path.splitext(path)[1]
         f = f[1:] # remove the period
@@ -61,7 +62,7 @@ def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
         print('# saving:', path)
 
     if f == 'mrc':
-        save_mrc(x, path)
+        save_mrc(x, path, dtype=dtype)
     elif f == 'tiff' or f == 'tif':
         save_tiff(x, path)
     elif f == 'png':
@@ -69,10 +70,10 @@ def save_image(x, path, mi=-3, ma=3, f=None, verbose=False):
     elif f == 'jpg' or f == 'jpeg':
         save_jpeg(x, path, mi=mi, ma=ma)
 
-def save_mrc(x, path):
+def save_mrc(x, path, dtype=np.float32):
     with open(path, 'wb') as f:
         x = x[np.newaxis] # need to add z-axis for mrc write
-        mrc.write(f, x)
+        mrc.write(f, x, dtype=dtype)
 
 def save_tiff(x, path):
     im = Image.fromarray(x) 
@@ -0,0 +1,355 @@
+from __future__ import print_function, division
+
+import sys
+import mmap
+import time
+import queue
+import threading
+from collections import deque
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from topaz.utils.printing import report
+
+
+class StageStats:
+    """ Running throughput and queue depth statistics for one pipeline stage """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.start = time.time()
+
+    def record(self, busy, depth):
+        self.count += 1
+        self.busy += busy
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        rate = self.count/elapsed if elapsed > 0 else 0
+        depth = self.depth_total/self.count if self.count > 0 else 0
+        return '{}: items={}, throughput={:.3g}/s, busy={:.3g}s, mean_queue_depth={:.3g}, max_queue_depth={}'.format(
+                self.name, self.count, rate, self.busy, depth, self.depth_max)
+
+
+class PipelineStats:
+    """ Collection of StageStats, reported in the order the stages were created """
+
+    def __init__(self):
+        self.stages = []
+
+    def stage(self, name):
+        stats = StageStats(name)
+        self.stages.append(stats)
+        return stats
+
+    def report(self):
+        for stats in self.stages:
+            report(stats.summary())
+
+
+class _Timed:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, x):
+        tic = time.time()
+        y = self.fn(x)
+        return y, time.time() - tic
+
+
+def _ordered(submit, iterable, depth, stats):
+    """ keep up to depth submitted items in flight and yield their results in input order """
+    pending = deque()
+    for x in iterable:
+        pending.append(submit(x))
+        if len(pending) >= depth:
+            y,busy = pending.popleft()()
+            if stats is not None:
+                stats.record(busy, len(pending))
+            yield y
+    while len(pending) > 0:
+        y,busy = pending.popleft()()
+        if stats is not None:
+            stats.record(busy, len(pending))
+        yield y
+
+
+def thread_map(fn, iterable, num_workers=1, depth=2, stats=None):
+    """
+    Map fn over iterable with a pool of num_workers threads, prefetching
+    up to depth results ahead of the consumer. Results are yielded in input
+    order. With num_workers=0, fn runs lazily in the calling thread.
+    """
+    fn = _Timed(fn)
+    if num_workers <= 0:
+        for x in iterable:
+            y,busy = fn(x)
+            if stats is not None:
+                stats.record(busy, 0)
+            yield y
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        submit = lambda x: executor.submit(fn, x).result
+        for y in _ordered(submit, iterable, max(depth, num_workers), stats):
+            yield y
+
+
+class SharedArray:
+    """
+    Picklable handle to a copy of an array in shared memory. The process
+    that creates the handle owns the memory and frees it with release.
+    Processes receiving the handle map the array with open, without copying,
+    and unmap it with close.
+    """
+
+    def __init__(self, x):
+        x = np.ascontiguousarray(x)
+        self.shape = x.shape
+        self.dtype = x.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+        self.name = self.shm.name
+        np.ndarray(x.shape, dtype=x.dtype, buffer=self.shm.buf)[...] = x
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype, 'shm': None}
+
+    def open(self):
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    def release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class MappedArray:
+    """ Picklable handle to an array memory mapped from a file, which is mapped again on open """
+
+    def __init__(self, x):
+        self.filename = x.filename
+        self.offset = x.offset
+        self.shape = x.shape
+        self.dtype = x.dtype
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+    def close(self):
+        pass
+
+    def release(self):
+        pass
+
+
+def share(x, min_bytes=2**16):
+    """
+    Handle to array x that pickles without its data. Arrays memory mapped
+    from a file in full are mapped again from the file, other arrays of at
+    least min_bytes are copied to shared memory. Anything else is returned
+    unchanged.
+    """
+    if not isinstance(x, np.ndarray) or x.nbytes < min_bytes:
+        return x
+    if isinstance(x, np.memmap) and isinstance(x.base, mmap.mmap) and x.flags.c_contiguous:
+        return MappedArray(x)
+    return SharedArray(x)
+
+
+def _receive(y):
+    """ copy the arrays out of the SharedArray handles in a result tuple and free them """
+    if not isinstance(y, tuple):
+        return y
+    received = []
+    for v in y:
+        if isinstance(v, (SharedArray, MappedArray)):
+            x = v.open()
+            received.append(np.array(x))
+            del x
+            v.release()
+        else:
+            received.append(v)
+    return tuple(received)
+
+
+def _discard(y):
+    """ free the shared memory of a result tuple that will not be received """
+    if not isinstance(y, tuple):
+        return
+    for v in y:
+        if isinstance(v, SharedArray):
+            v.open()
+            v.release()
+
+
+class _Shared:
+    """
+    call fn on a tuple with the array handles in it opened, returning the
+    large arrays of a tuple result as handles
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, x):
+        handles = [v for v in x if isinstance(v, (SharedArray, MappedArray))]
+        x = tuple(v.open() if isinstance(v, (SharedArray, MappedArray)) else v for v in x)
+        try:
+            y = self.fn(x)
+        finally:
+            del x # drop the views before unmapping
+            for handle in handles:
+                handle.close()
+        if isinstance(y, tuple):
+            y = tuple(share(v) for v in y)
+            for v in y: # the receiving process frees the memory
+                if isinstance(v, SharedArray):
+                    v.close()
+        return y
+
+
+def process_pool(num_workers, initializer=None, initargs=()):
+    """ multiprocessing pool whose workers can be sent SharedArray handles """
+    ## start the resource tracker before forking so the workers share it.
+    ## otherwise each worker tracks the shared memory it opens with its own
+    ## tracker, which reports it as leaked when the worker exits
+    resource_tracker.ensure_running()
+    return multiprocessing.Pool(num_workers, initializer=initializer, initargs=initargs)
+
+
+def pool_map(fn, iterable, pool, depth=2, stats=None, shared=False):
+    """
+    Map fn over iterable with a multiprocessing pool, keeping at most depth
+    items in flight. Results are yielded in input order. fn must be picklable.
+
+    With shared=True, items must be tuples and the large arrays in them are
+    sent to the workers as SharedArray or MappedArray handles instead of
+    being pickled. The shared memory of an item is freed once its result
+    is received. Large arrays in tuple results are returned the same way.
+    The pool should come from process_pool. Closing the generator early
+    waits for the items in flight to free their results, so close it
+    before terminating the pool.
+    """
+    fn = _Timed(_Shared(fn) if shared else fn)
+    if not shared:
+        submit = lambda x: pool.apply_async(fn, (x,)).get
+        for y in _ordered(submit, iterable, depth, stats):
+            yield y
+        return
+
+    in_flight = set()
+    unreceived = []
+    def submit(x):
+        x = tuple(share(v) for v in x)
+        handles = [v for v in x if isinstance(v, SharedArray)]
+        in_flight.update(handles)
+        result = pool.apply_async(fn, (x,))
+        unreceived.append(result)
+        def get():
+            unreceived.remove(result)
+            try:
+                y,busy = result.get()
+                return _receive(y), busy
+            finally:
+                for handle in handles:
+                    handle.release()
+                    in_flight.discard(handle)
+        return get
+
+    try:
+        for y in _ordered(submit, iterable, depth, stats):
+            yield y
+    finally:
+        ## when stopped early, wait for the items still in flight so that
+        ## the shared memory of their results is freed too
+        for result in unreceived:
+            try:
+                y,_ = result.get()
+            except Exception:
+                continue
+            _discard(y)
+        for handle in in_flight:
+            handle.release()
+
+
+def timed(iterable, stats=None):
+    """ pass items through, recording the time spent producing each one """
+    iterator = iter(iterable)
+    while True:
+        tic = time.time()
+        try:
+            x = next(iterator)
+        except StopIteration:
+            return
+        if stats is not None:
+            stats.record(time.time() - tic, 0)
+        yield x
+
+
+class AsyncWriter:
+    """
+    Consume items in a background thread through a bounded queue, so that
+    writing overlaps with producing the next items. Items are written in the
+    order they are put. Errors in the writer are raised on put or close.
+    """
+
+    _done = object()
+
+    def __init__(self, write, depth=2, stats=None):
+        self.write = write
+        self.stats = stats
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._done:
+                return
+            if self.error is not None:
+                continue
+            tic = time.time()
+            try:
+                self.write(item)
+            except BaseException:
+                self.error = sys.exc_info()[1]
+                continue
+            if self.stats is not None:
+                self.stats.record(time.time() - tic, self.queue.qsize())
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self._check()
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(self._done)
+        self.thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,161 @@
+from __future__ import print_function,division
+
+import os
+import hashlib
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def hash_file(path, chunk_size=2**20):
+    """ sha1 hex digest of the contents of a file """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while len(chunk) > 0:
+            h.update(chunk)
+            chunk = f.read(chunk_size)
+    return h.hexdigest()
+
+
+def hash_model(model):
+    """ sha1 hex digest of the parameters and buffers of a torch model """
+    if hasattr(model, 'model_hash'): # compiled models carry the hash of their source model
+        return model.model_hash
+    h = hashlib.sha1()
+    h.update(type(model).__name__.encode())
+    for name,tensor in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class ScoreStore:
+    """
+    Directory of per-micrograph score maps keyed by model hash and image hash.
+
+    Each score map is saved as a .npy file and read back as a memory map, so
+    score maps are only paged in when they are used. An index.txt file lists
+    the stored maps and is appended to as maps are added.
+
+    Score maps can be stored as float32, float16 or uint8. uint8 maps are
+    linearly quantized to codes 1 to 255 between the minimum and maximum
+    finite score of each map and are dequantized to float32 when loaded.
+    Code 0 is reserved for -inf, which marks the pixels that coarse to fine
+    scoring did not refine.
+    """
+
+    columns = ['key', 'image_name', 'model_hash', 'image_hash', 'dtype', 'scale', 'offset']
+    dtypes = ['float32', 'float16', 'uint8']
+
+    def __init__(self, root, dtype='float32'):
+        if dtype not in self.dtypes:
+            raise ValueError('Score store dtype must be one of {}, got: {}'.format(', '.join(self.dtypes), dtype))
+        self.root = root
+        self.dtype = dtype
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+        self.index_path = os.path.join(root, 'index.txt')
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    tokens = line.rstrip('\n').split('\t')
+                    if len(tokens) != len(self.columns) or tokens[0] == 'key':
+                        continue
+                    entry = dict(zip(self.columns, tokens))
+                    ## drop entries whose score map has gone missing
+                    if os.path.exists(self._path(entry['key'])):
+                        self.entries[entry['key']] = entry
+        else:
+            with open(self.index_path, 'w') as f:
+                print('\t'.join(self.columns), file=f)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(model_hash='', image_hash='', image_name=''):
+        """ score maps without an image hash are keyed by image name """
+        if image_hash == '':
+            image_hash = 'name:' + image_name
+        return hashlib.sha1((model_hash + ':' + image_hash).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def lookup(self, model_hash='', image_hash='', image_name=''):
+        """ key of the score map stored under these hashes, or None if there is none """
+        key = self.key(model_hash, image_hash, image_name)
+        if key not in self.entries:
+            return None
+        return key
+
+    def load(self, key):
+        """ load a stored score map, memory mapped unless it was quantized """
+        entry = self.entries[key]
+        x = np.load(self._path(key), mmap_mode='r')
+        if entry['dtype'] == 'uint8':
+            codes = x
+            x = codes.astype(np.float32)*np.float32(entry['scale']) + np.float32(entry['offset'])
+            x[codes == 0] = -np.inf
+        return x
+
+    def add(self, image_name, score, model_hash='', image_hash=''):
+        """ store a score map and return its key """
+        key = self.key(model_hash, image_hash, image_name)
+        if key in self.entries:
+            return key
+
+        scale,offset = 1, 0
+        if self.dtype == 'uint8':
+            score = np.asarray(score, dtype=np.float32)
+            finite = np.isfinite(score)
+            lo,hi = 0.0, 0.0
+            if finite.any():
+                lo,hi = float(score[finite].min()), float(score[finite].max())
+            ## finite scores map to codes 1 to 255, code 0 is -inf
+            scale = (hi - lo)/254 or 1
+            offset = lo - scale
+            codes = np.clip(np.round((score - offset)/scale), 1, 255)
+            codes[score == -np.inf] = 0
+            score = codes
+        score = np.asarray(score).astype(self.dtype)
+
+        ## write to a temporary file first so an interrupted write never
+        ## leaves a truncated score map behind under its key
+        path = self._path(key)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, score)
+        os.replace(tmp_path, path)
+
+        entry = {'key': key, 'image_name': image_name, 'model_hash': model_hash
+                , 'image_hash': image_hash, 'dtype': self.dtype
+                , 'scale': repr(scale), 'offset': repr(offset)}
+        with open(self.index_path, 'a') as f:
+            print('\t'.join(entry[c] for c in self.columns), file=f)
+        self.entries[key] = entry
+
+        return key
+
+
+class ScoreMaps(Mapping):
+    """ read-only mapping from names to score maps that are loaded from a ScoreStore on access """
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.store.load(self.index[name])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+